@@ -13,8 +13,10 @@ if os.getenv("BITCART_OTEL_ENABLED", "false").lower() == "true":
     initialize()
 
 import asyncio
+import contextlib
 import json
 import weakref
+from collections import defaultdict
 
 from aiohttp import WSCloseCode, WSMsgType, web
 from decouple import AutoConfig
@@ -22,6 +24,29 @@ from logger import configure_logging
 from utils import JsonResponse, authenticate, load_spec, maybe_update_key, noop_cast, parse_params
 
 
+class WebsocketSubscriber:
+    def __init__(self, ws, queue_size):
+        self.ws = ws
+        self.xpub = None
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    def send(self, message):
+        """Queue an already encoded message, returns False if the client doesn't keep up"""
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def run_sender(self):
+        try:
+            while not self.ws.closed:
+                await self.ws.send_str(await self.queue.get())
+        except ConnectionError:
+            # the connection is gone, closing it ends the handler's receive loop, which unsubscribes us
+            await self.ws.close()
+
+
 class BaseDaemon:
     # Coin name (symbol), used for coin identification across Bitcart
     name: str
@@ -36,6 +61,7 @@ class BaseDaemon:
         self.env_name = self.name.upper()
         self.env_names = set()
         self.config_getter = AutoConfig(search_path="conf")
+        self.sync_waiters = 0
         self.load_env()
         configure_logging(debug=self.VERBOSE)
         self.load_spec()
@@ -101,43 +127,68 @@ class BaseDaemon:
         if isinstance(xpub, dict):
             return xpub.pop("xpub", None), xpub.pop("contract", None), xpub
 
-    async def get_handle_request_params(self, request):
-        try:
-            data = await request.json()
-        except json.decoder.JSONDecodeError:
-            return None, None, None, None, None, None, None, JsonResponse(code=-32700, error="Parse error")
+    def parse_request_data(self, data):
+        if not isinstance(data, dict):
+            return None, None, None, None, None, None, None, JsonResponse(code=-32600, error="Invalid Request")
         method, req_id, params = data.get("method"), data.get("id", None), data.get("params", [])
         error = None if method else JsonResponse(code=-32601, error="Procedure not found", id=req_id)
         args, kwargs = parse_params(params)
         xpub, contract, extra_params = self.parse_xpub(kwargs.pop("xpub", None))
         return req_id, method, xpub, contract, extra_params, args, kwargs, error
 
-    @authenticate
-    async def handle_request(self, request):
-        req_id, req_method, xpub, contract, extra_params, req_args, req_kwargs, error = await self.get_handle_request_params(
-            request
-        )
+    async def execute_request_data(self, data):
+        req_id, req_method, xpub, contract, extra_params, req_args, req_kwargs, error = self.parse_request_data(data)
         if error:
             return error.send()
         return await self.execute_method(req_id, req_method, xpub, contract, extra_params, req_args, req_kwargs)
 
+    async def handle_batch_request(self, batch):
+        if not batch:
+            return JsonResponse(code=-32600, error="Invalid Request").send()
+        # entries run concurrently, execute_method takes care of per-wallet locking
+        responses = await asyncio.gather(*(self.execute_request_data(data) for data in batch))
+        # notifications (requests without an id) are executed but get no response entry
+        bodies = [
+            response.body
+            for data, response in zip(batch, responses, strict=True)
+            if not isinstance(data, dict) or "id" in data
+        ]
+        if not bodies:
+            return web.Response(status=204)
+        return web.Response(body=b"[" + b",".join(bodies) + b"]", content_type="application/json")
+
+    @authenticate
+    async def handle_request(self, request):
+        try:
+            data = await request.json()
+        except json.decoder.JSONDecodeError:
+            return JsonResponse(code=-32700, error="Parse error").send()
+        if isinstance(data, list):
+            return await self.handle_batch_request(data)
+        return await self.execute_request_data(data)
+
     @authenticate
     async def handle_websocket(self, request):
         ws = web.WebSocketResponse()
         await ws.prepare(request)
-        ws.config = {"xpub": None}
+        subscriber = WebsocketSubscriber(ws, self.WS_QUEUE_SIZE)
         request.app["websockets"].add(ws)
+        self.subscribe_websocket(subscriber, None)
+        sender = asyncio.ensure_future(subscriber.run_sender())
         try:
             async for msg in ws:
                 if msg.type == WSMsgType.TEXT:
                     try:
                         data = msg.json()
                         if data.get("xpub"):
-                            ws.config["xpub"] = data["xpub"]
+                            self.subscribe_websocket(subscriber, data["xpub"])
                     except json.JSONDecodeError:
                         pass
         finally:
+            self.unsubscribe_websocket(subscriber)
             request.app["websockets"].discard(ws)
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
         return ws
 
     @authenticate
@@ -146,6 +197,7 @@ class BaseDaemon:
 
     def configure_app(self):
         self.app["websockets"] = weakref.WeakSet()
+        self.ws_subscribers = defaultdict(set)  # xpub -> subscribers, None for subscribers to all wallets
         self.app.router.add_post("/", self.handle_request)
         self.app.router.add_get("/ws", self.handle_websocket)
         self.app.router.add_get("/spec", self.handle_spec)
@@ -162,18 +214,67 @@ class BaseDaemon:
     def build_notification(self, data, xpub):
         return {"updates": [data], "wallet": xpub, "currency": self.name}
 
+    def subscribe_websocket(self, subscriber, xpub):
+        self.unsubscribe_websocket(subscriber)
+        subscriber.xpub = xpub
+        self.ws_subscribers[xpub].add(subscriber)
+
+    def unsubscribe_websocket(self, subscriber):
+        subscribers = self.ws_subscribers.get(subscriber.xpub)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            self.ws_subscribers.pop(subscriber.xpub, None)
+
     async def notify_websockets(self, data, xpub):
-        notification = self.build_notification(data, xpub)
+        # encoded once for all subscribers, sending is done by per-connection tasks so slow clients don't block us
+        notification = json.dumps(self.build_notification(data, xpub))
         # If xpub is None, send global notification to all wallets regardless of notification settings
         # If xpub is not None (scoped to a specific wallet), we follow the notification settings
-        coros = [
-            ws.send_json(notification)
-            for ws in set(self.app["websockets"])
-            if not ws.closed and (not xpub or not ws.config["xpub"] or ws.config["xpub"] == xpub)
-        ]
-        await asyncio.gather(*coros)
+        if xpub:
+            subscribers = self.ws_subscribers.get(None, set()) | self.ws_subscribers.get(xpub, set())
+        else:
+            subscribers = set().union(*self.ws_subscribers.values())
+        for subscriber in subscribers:
+            if subscriber.ws.closed:
+                continue
+            if not subscriber.send(notification):
+                # the client can't keep up, disconnect it so that it reconnects and re-syncs
+                self.unsubscribe_websocket(subscriber)
+                asyncio.ensure_future(subscriber.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b"Too slow"))
         return True
 
+    ######################
+    # Sync waiting support
+    ######################
+
+    async def wait_for_sync(self, is_synced, event, recheck_interval=None):
+        """Wait until is_synced() becomes true
+
+        The condition is re-checked each time the event is set, and every recheck_interval seconds if provided.
+        Waits for SYNC_TIMEOUT seconds at max if it is set.
+
+        Args:
+            is_synced (Callable[[], bool]): sync condition
+            event (asyncio.Event): event set when sync state might have changed
+            recheck_interval (float, optional): fallback polling interval. Defaults to None.
+        """
+        if is_synced():
+            return
+        self.sync_waiters += 1
+        try:
+            async with asyncio.timeout(self.SYNC_TIMEOUT or None):
+                while not is_synced():
+                    with contextlib.suppress(TimeoutError):
+                        await asyncio.wait_for(event.wait(), recheck_interval)
+                    if not is_synced():
+                        event.clear()  # woken up too early, wait for the next change
+        except TimeoutError:
+            raise Exception("Timed out waiting for synchronization") from None
+        finally:
+            self.sync_waiters -= 1
+
     #################################################
     # Overridable methods for completely custom coins
     #################################################
@@ -193,6 +294,8 @@ class BaseDaemon:
         self.NET = self.env("NETWORK", default="mainnet")
         self.DEFAULT_CURRENCY = self.env("FIAT_CURRENCY", default="USD")
         self.POLLING_CAP = self.env("POLLING_CAP", cast=int, default=100)
+        self.WS_QUEUE_SIZE = self.env("WS_QUEUE_SIZE", cast=int, default=1000)
+        self.SYNC_TIMEOUT = self.env("SYNC_TIMEOUT", cast=float, default=0)
 
     async def on_startup(self, app):
         """Create essential objects for daemon operation here
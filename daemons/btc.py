@@ -8,7 +8,6 @@ import inspect
 import os
 import sys
 import traceback
-from collections import deque
 from decimal import Decimal
 from types import ModuleType
 from urllib.parse import urlparse
@@ -16,6 +15,7 @@ from urllib.parse import urlparse
 from logger import configure_logging, get_logger
 from utils import (
     JsonResponse,
+    UpdatesLog,
     async_partial,
     cached,
     format_satoshis,
@@ -28,6 +28,8 @@ from utils import (
 
 logger = get_logger(__name__)
 
+SYNC_RECHECK_INTERVAL = 1  # not every sync state change is reported through events
+
 
 class BTCDaemon(BaseDaemon):
     name = "BTC"
@@ -77,12 +79,14 @@ class BTCDaemon(BaseDaemon):
         self.setup_config_and_logging()
         # initialize wallet storages
         self.wallets = {}
-        self.wallets_updates = {}
+        self.wallet_keys = {}  # id(wallet object) -> wallet key, to route electrum callbacks without scanning
+        self.updates_log = UpdatesLog(self.POLLING_CAP)
         self.contracts = {}
         # initialize not yet created network
         self.loop = None
         self.network = None
         self.daemon = None
+        self.sync_state_changed = asyncio.Event()
 
     def load_env(self):
         super().load_env()
@@ -263,7 +267,8 @@ class BTCDaemon(BaseDaemon):
         self.init_wallet(wallet)
         self.load_cmd_wallet(command_runner, wallet)
         self.wallets[wallet_key] = {"wallet": wallet, "cmd": command_runner, "contract": contract}
-        self.wallets_updates[wallet_key] = deque(maxlen=self.POLLING_CAP)
+        self.wallet_keys[id(wallet)] = wallet_key
+        self.updates_log.add_wallet(wallet_key)
         await self.add_contract(contract, wallet)
         return wallet, command_runner
 
@@ -283,8 +288,9 @@ class BTCDaemon(BaseDaemon):
         wallet = cmd = error = None
         try:
             wallet, cmd = await self.load_wallet(xpub, config=self.electrum_config, diskless=diskless, contract=contract)
-            while self.is_still_syncing(wallet):
-                await asyncio.sleep(0.1)
+            await self.wait_for_sync(
+                lambda: not self.is_still_syncing(wallet), self.sync_state_changed, recheck_interval=SYNC_RECHECK_INTERVAL
+            )
         except Exception as e:
             logger.error(traceback.format_exc())
             if req_method not in self.supported_methods or self.supported_methods[req_method].requires_wallet:
@@ -357,11 +363,10 @@ class BTCDaemon(BaseDaemon):
             return JsonResponse(code=self.get_error_code(error_message), error=error_message, id=req_id).send()
 
     def _find_matching_wallet_key(self, wallet):
-        for wallet_key in self.wallets:
-            if wallet == self.wallets[wallet_key]["wallet"]:
-                return wallet_key
+        return self.wallet_keys.get(id(wallet))
 
     async def _process_events(self, event, *args):
+        self.sync_state_changed.set()
         mapped_event = self.EVENT_MAPPING.get(event)
         data = {"event": mapped_event}
         data_got = None
@@ -379,11 +384,14 @@ class BTCDaemon(BaseDaemon):
             await self.notify_websockets(data, None)
             if self.POLLING_CAP == 0:
                 return
-        for i in self.wallets:
-            if not wallet or wallet == self.wallets[i]["wallet"]:
-                if wallet == self.wallets[i]["wallet"]:
-                    await self.notify_websockets(data, i)
-                self.wallets_updates[i].append(data)
+        if not wallet:
+            self.updates_log.add(data)
+            return
+        wallet_key = self._find_matching_wallet_key(wallet)
+        if wallet_key is None:
+            return
+        await self.notify_websockets(data, wallet_key)
+        self.updates_log.add(data, wallet_key)
 
     def _process_events_sync(self, event, *args):
         # NOTE: for sync clients it might not guarantee the right execution order because of event loop nature
@@ -509,9 +517,7 @@ class BTCDaemon(BaseDaemon):
 
     @rpc(requires_wallet=True)
     def get_updates(self, wallet):
-        updates = self.wallets_updates[wallet]
-        self.wallets_updates[wallet] = deque(maxlen=self.POLLING_CAP)
-        return list(updates)
+        return self.updates_log.pop_updates(wallet)
 
     async def _verify_transaction(self, tx_hash, tx_height):
         merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
@@ -627,6 +633,7 @@ class BTCDaemon(BaseDaemon):
     async def getinfo(self, wallet=None):
         data = await self.create_commands(config=self.electrum_config).getinfo()
         data["synchronized"] = not self.is_still_syncing()
+        data["sync_waiters"] = self.sync_waiters
         data["total_wallets"] = len(self.wallets)
         return data
 
@@ -727,7 +734,8 @@ class BTCDaemon(BaseDaemon):
                 self.daemon.stop_wallet(path)
         else:
             await self.wallets[key]["wallet"].stop() if self.ASYNC_CLIENT else self.wallets[key]["wallet"].stop_threads()
-        del self.wallets_updates[key]
+        self.updates_log.remove_wallet(key)
+        self.wallet_keys.pop(id(self.wallets[key]["wallet"]), None)
         del self.wallets[key]
         return True
 
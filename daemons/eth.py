@@ -1,9 +1,10 @@
 import asyncio
 import contextlib
+import functools
+import itertools
 import json
 import os
 import traceback
-from collections import deque, namedtuple
 from contextvars import ContextVar
 from dataclasses import dataclass
 from decimal import Decimal
@@ -14,12 +15,13 @@ from aiolimiter import AsyncLimiter
 from eth_account import Account
 from eth_account.messages import encode_defunct
 from eth_keys.datatypes import PrivateKey, PublicKey
+from eth_utils import function_abi_to_4byte_selector
 from genericprocessor import (
     NOOP_PATH,
     BlockchainFeatures,
     BlockProcessorDaemon,
+    ResponseCache,
     Transaction,
-    WalletDB,
     daemon_ctx,
     from_wei,
     str_to_bool,
@@ -31,10 +33,11 @@ from hexbytes import HexBytes
 from logger import get_logger
 from mnemonic import Mnemonic
 from storage import JSONEncoder as StorageJSONEncoder
-from storage import Storage, decimal_to_string
+from storage import StoredProperty, decimal_to_string, get_encoder, to_jsonable
 from utils import (
     AbstractRPCProvider,
     MultipleProviderRPC,
+    PoolMetrics,
     exception_retry_middleware,
     load_json_dict,
     modify_payment_url,
@@ -42,7 +45,6 @@ from utils import (
     try_cast_num,
 )
 from web3 import AsyncWeb3
-from web3._utils.events import get_event_data
 from web3._utils.rpc_abi import RPC as ETHRPC
 from web3.contract import AsyncContract
 from web3.datastructures import AttributeDict
@@ -63,11 +65,53 @@ FEE_PARAMS = EIP1559_PARAMS + ("gasPrice", "gas")
 
 TX_DEFAULT_GAS = 21000
 
+LOGS_MAX_RECIPIENT_TOPICS = 500  # above that, filter by contracts only to keep eth_getLogs requests reasonable
+
+TRACE_ATTEMPTS = 6
+TRACE_RETRY_DELAY = 1  # doubled after each failed attempt
+TRACE_MAX_RETRY_DELAY = 30
+
 RPC_SOURCE = "Infura"
 
 TRANSFER_TOPIC = AsyncWeb3.keccak(text="Transfer(address,address,uint256)").to_0x_hex()
 
 
+def is_log_entry(data):
+    return "logIndex" in data
+
+
+def is_transfer_log(log):
+    topics = log.get("topics", [])
+    return len(topics) == 3 and topics[0] == TRANSFER_TOPIC
+
+
+@functools.lru_cache(maxsize=65536)
+def to_checksum_address(address):
+    # the same senders, recipients and token contracts repeat a lot, so avoid re-hashing them
+    return AsyncWeb3.to_checksum_address(address)
+
+
+def address_to_topic(address):
+    return "0x" + address[2:].lower().rjust(64, "0")
+
+
+@dataclass(frozen=True)
+class LogsFilter:
+    """What blocks are fetched with in logs ingestion mode"""
+
+    full_blocks: bool
+    contracts: frozenset
+    recipients: frozenset | None  # None when Transfer logs are not filtered by recipient
+
+    def covers(self, other):
+        """Whether blocks fetched with this filter contain everything fetched with the other one"""
+        return (
+            (self.full_blocks or not other.full_blocks)
+            and self.contracts >= other.contracts
+            and (self.recipients is None or (other.recipients is not None and self.recipients >= other.recipients))
+        )
+
+
 class JSONEncoder(StorageJSONEncoder):
     def default(self, obj):
         if isinstance(obj, AttributeDict):
@@ -85,21 +129,41 @@ class MultipleRPCEthereumProvider(AsyncWeb3.AsyncHTTPProvider):
     async def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
         return await self.rpc.send_request(method, params)
 
+    async def make_batch_request(self, batch_requests: list[tuple[RPCEndpoint, Any]]) -> list[RPCResponse] | RPCResponse:
+        return await self.rpc.send_batch_request(batch_requests)
+
 
 class EthereumRPCProvider(AbstractRPCProvider, AsyncWeb3.AsyncHTTPProvider):
     web3: AsyncWeb3 = None  # patched later when it's created
     cooked_func = None
+    cooked_batch_func = None
+    client_session = None
 
     async def prepare_for_requests(self):
         custom_onion = MiddlewareOnion([AsyncHTTPRetryMiddleware])
         self.cooked_func = await self.request_func(self.web3, custom_onion)
+        self.cooked_batch_func = await self.batch_request_func(self.web3, custom_onion)
 
     async def send_single_request(self, *args, **kwargs):
         return await self.cooked_func(*args, **kwargs)
 
+    async def send_batch_request(self, requests):
+        return await self.cooked_batch_func(requests)
+
     async def send_ping_request(self):
         return await self.send_single_request(ETHRPC.web3_clientVersion, [])
 
+    def is_read_request(self, method, *args, **kwargs):
+        return not str(method).startswith("eth_send")
+
+    async def use_session(self, connector_settings):
+        self.pool_metrics = PoolMetrics()
+        self.client_session = await self.cache_async_session(connector_settings.create_session(self.pool_metrics))
+
+    async def close(self):
+        if self.client_session is not None:
+            await self.client_session.close()
+
 
 class ETHFeatures(BlockchainFeatures):
     web3: AsyncWeb3
@@ -107,6 +171,7 @@ class ETHFeatures(BlockchainFeatures):
 
     def __init__(self, web3):
         self.web3 = web3
+        self._chain_id = None
         self.get_block_safe = exception_retry_middleware(self.get_block, (BlockNotFound,))
         self.get_block_receipts_safe = exception_retry_middleware(self.get_block_receipts, (BlockNotFound,))
         self.get_tx_receipt_safe = exception_retry_middleware(self.get_tx_receipt, (TransactionNotFound,))
@@ -135,10 +200,50 @@ class ETHFeatures(BlockchainFeatures):
     async def get_block_receipts(self, block):
         return await self.web3.manager.coro_request("eth_getBlockReceipts", [hex(block)])
 
-    async def get_block_txes(self, block):
+    async def get_blocks_receipts(self, blocks):
+        responses = await self.web3.provider.make_batch_request(
+            [(RPCEndpoint("eth_getBlockReceipts"), [hex(block)]) for block in blocks]
+        )
+        if not isinstance(responses, list):  # the whole batch was rejected
+            raise Web3Exception(responses.get("error"))
+        return [response.get("result") for response in responses]
+
+    async def get_block_txes(self, block, receipts=True):
         txes = (await self.get_block_safe(block, full_transactions=True))["transactions"]
+        if not receipts:
+            return txes
+        return await self.add_block_receipts(block, txes)
+
+    async def get_blocks_txes(self, blocks, receipts=True):
+        # N blocks and their receipts are fetched in 2 JSON-RPC batch requests instead of 2*N requests
+        results = None
+        # some providers don't support batches, and a single missing block fails the whole batch
+        if len(blocks) > 1:
+            with contextlib.suppress(Exception):
+                async with self.web3.batch_requests() as batch:
+                    for block in blocks:
+                        batch.add(self.web3.eth.get_block(block, full_transactions=True))
+                    results = await batch.async_execute()
+        if results is not None:
+            return await self._add_blocks_receipts(blocks, results, receipts)
+        return await asyncio.gather(*(self.get_block_txes(block, receipts) for block in blocks), return_exceptions=True)
+
+    async def _add_blocks_receipts(self, blocks, results, receipts):
+        if not receipts:
+            return [result["transactions"] for result in results]
+        try:
+            receipts = await self.get_blocks_receipts(blocks)
+        except Exception:
+            receipts = [None] * len(blocks)
+        return [
+            await self.add_block_receipts(block, result["transactions"], block_receipts)
+            for block, result, block_receipts in zip(blocks, results, receipts, strict=True)
+        ]
+
+    async def add_block_receipts(self, block, txes, block_receipts=None):
         try:
-            block_receipts = await self.get_block_receipts_safe(block)
+            if block_receipts is None:
+                block_receipts = await self.get_block_receipts_safe(block)
             block_receipts = {x["transactionHash"]: x for x in block_receipts}
         except Exception:
             return txes
@@ -149,14 +254,25 @@ class ETHFeatures(BlockchainFeatures):
                 tx["logs"] = block_receipts[tx_hash]["logs"]
         return txes
 
+    async def get_transfer_logs(self, from_block, to_block, contracts, recipients=None):
+        topics = [TRANSFER_TOPIC]
+        if recipients:
+            topics.extend([None, [address_to_topic(address) for address in recipients]])
+        return await self.web3.manager.coro_request(
+            "eth_getLogs",
+            [{"fromBlock": hex(from_block), "toBlock": hex(to_block), "address": list(contracts), "topics": topics}],
+        )
+
     async def chain_id(self):
-        return await self.web3.eth.chain_id
+        if self._chain_id is None:
+            self._chain_id = await self.web3.eth.chain_id
+        return self._chain_id
 
     def is_address(self, address):
         return AsyncWeb3.is_address(address) or AsyncWeb3.is_checksum_address(address)
 
     def normalize_address(self, address):
-        return AsyncWeb3.to_checksum_address(address)
+        return to_checksum_address(address)
 
     async def get_payment_uri(self, address, amount, divisibility, contract=None):
         chain_id = await self.chain_id()
@@ -177,74 +293,92 @@ class ETHFeatures(BlockchainFeatures):
             [hex(block_number), {"tracer": "callTracer", "timeout": "10s"}],
         )
 
+    def parse_transfer_log(self, tx_hash, log):
+        # logs of not watched contracts are discarded before decoding anything
+        contract = daemon_ctx.get().contracts.get(to_checksum_address(log["address"]))
+        if not contract:
+            return None
+        # Transfer(address indexed from, address indexed to, uint256 value) is decoded right from the raw log,
+        # addresses are the last 20 bytes of the topics and value is the only 32-byte word of data
+        topics, data = log["topics"], log["data"]
+        if len(data) != 66:
+            raise ValueError(f"Invalid Transfer event data: {data}")
+        return Transaction(
+            tx_hash,
+            to_checksum_address(f"0x{topics[1][-40:]}"),
+            to_checksum_address(f"0x{topics[2][-40:]}"),
+            int(data, 16),
+            contract.address,
+            contract.divisibility,
+        )
+
     async def process_tx_data(self, data):
+        if is_log_entry(data):  # logs ingestion mode
+            if not is_transfer_log(data):
+                return
+            with contextlib.suppress(Exception):
+                return self.parse_transfer_log(data["transactionHash"], data)
+            return
         if "to" not in data:
             return
         if "status" in data and data["status"] == "0x0":
             return
         if "input" in data and data["input"].to_0x_hex() != "0x":
             txes = []
-            transfer_event = daemon_ctx.get().transfer_event
             for log in data.get("logs", []):
-                topics = log.get("topics", [])
-                if len(topics) != 3 or topics[0] != TRANSFER_TOPIC:
-                    continue
-                contract_address = self.normalize_address(log["address"])
-                contract = daemon_ctx.get().contracts.get(contract_address)
-                if not contract:
+                if not is_transfer_log(log):
                     continue
                 try:
-                    decoded = get_event_data(self.web3.codec, transfer_event.abi, log)
+                    tx = self.parse_transfer_log(str(data["hash"].to_0x_hex()), log)
                 except Exception:
                     return  # non-matching event, ignore
-                args = decoded["args"]
-                txes.append(
-                    Transaction(
-                        str(data["hash"].to_0x_hex()),
-                        args[transfer_event.from_addr],
-                        args[transfer_event.to],
-                        args[transfer_event.value],
-                        contract.address,
-                        contract.divisibility,
-                    )
-                )
+                if tx is not None:
+                    txes.append(tx)
             return txes
         return Transaction(str(data["hash"].to_0x_hex()), data["from"], data["to"], data["value"])
 
     def find_all_trace_outputs(self, debug_data):
         return self._find_all_trace_outputs_geth(debug_data)
 
-    def _find_all_trace_tx_outputs_geth(self, tx_hash, from_addr, debug_data, depth=0):
-        if depth >= self.MAX_TRACE_DEPTH:
-            return []
+    def _find_all_trace_tx_outputs_geth(self, tx_hash, from_addr, debug_data, watched):
+        # walk the call tree depth-first with an explicit stack, in the same order as callTracer reports calls
         result = []
-        to_addr = debug_data.get("to")
-        call_type = debug_data.get("type", "CALL").upper()
-        if call_type == "CALL" and debug_data["input"] == "0x" and to_addr:
-            result.append((tx_hash, from_addr, self.normalize_address(to_addr), int(debug_data.get("value", "0x0"), 16)))
-        child_from_addr = from_addr if call_type == "DELEGATECALL" else to_addr
-        for call in debug_data.get("calls", []):
-            result.extend(self._find_all_trace_tx_outputs_geth(tx_hash, child_from_addr, call, depth + 1))
+        stack = [(from_addr, debug_data, 0)]
+        while stack:
+            from_addr, call, depth = stack.pop()
+            to_addr = call.get("to")
+            call_type = call.get("type", "CALL").upper()
+            # only calls to watched addresses are decoded
+            if call_type == "CALL" and call["input"] == "0x" and to_addr and to_addr.lower() in watched:
+                result.append((tx_hash, from_addr, self.normalize_address(to_addr), int(call.get("value", "0x0"), 16)))
+            if depth + 1 >= self.MAX_TRACE_DEPTH:
+                continue
+            child_from_addr = from_addr if call_type == "DELEGATECALL" else to_addr
+            stack.extend((child_from_addr, child, depth + 1) for child in reversed(call.get("calls", [])))
         return result
 
     def _find_all_trace_outputs_geth(self, debug_data):
+        daemon = daemon_ctx.get()
+        watched = {address.lower() for address in itertools.chain(daemon.addresses, daemon.evicted_addresses)}
+        if not watched:
+            return []
         result = []
         for tx in debug_data:
-            if tx["result"]["input"] != "0x" and tx["result"].get("to") is not None:
-                try:
-                    self.web3.eth.contract(
-                        address=self.normalize_address(tx["result"]["to"]), abi=daemon_ctx.get().ABI
-                    ).decode_function_input(tx["result"]["input"])
-                except Exception:
-                    if "txHash" in tx:
-                        result.extend(self._find_all_trace_tx_outputs_geth(tx["txHash"], tx["result"]["from"], tx["result"]))
+            tx_input = tx["result"]["input"]
+            # token contract calls are detected from transfer events, so skip them
+            if tx_input == "0x" or tx["result"].get("to") is None or tx_input[:10].lower() in daemon.abi_selectors:
+                continue
+            if "txHash" in tx:
+                result.extend(self._find_all_trace_tx_outputs_geth(tx["txHash"], tx["result"]["from"], tx["result"], watched))
         return result
 
     def get_tx_hash(self, tx_data):
+        if is_log_entry(tx_data):
+            return tx_data["transactionHash"]
         return tx_data["hash"].to_0x_hex()
 
     def to_dict(self, obj):
-        return json.loads(JSONEncoder(precision=daemon_ctx.get().DIVISIBILITY).encode(obj))
+        return to_jsonable(obj, get_encoder(JSONEncoder, daemon_ctx.get().DIVISIBILITY))
 
     def get_wallet_key(self, xpub, contract=None, **extra_params):
         key = xpub
@@ -254,12 +388,15 @@ class ETHFeatures(BlockchainFeatures):
 
     async def get_confirmations(self, tx_hash, data=None) -> int:
         data = data or await self.get_tx_receipt_safe(tx_hash)
-        height = await self.get_block_number()
+        height = await self.get_cached_block_number()
         return max(0, height - (data["blockNumber"] or height + 1) + 1)
 
     def current_server(self):
         return self.web3.provider.rpc.current_rpc.endpoint_uri
 
+    def provider_stats(self):
+        return self.web3.provider.rpc.get_stats()
+
 
 with open("daemons/abi/erc20.json") as f:
     ERC20_ABI = json.loads(f.read())
@@ -284,6 +421,8 @@ RPC_DEST = "internal"
 class KeyStore(BaseKeyStore):
     account: Account = None
 
+    DERIVED_FIELDS = (*BaseKeyStore.DERIVED_FIELDS, "account")
+
     def load_contract(self):
         if not self.contract:
             return
@@ -363,9 +502,6 @@ class Wallet(BaseWallet):
         return await self.coin.get_balance(address)
 
 
-TransferEventParams = namedtuple("TransferEventParams", ["abi", "from_addr", "to", "value"])
-
-
 class ETHDaemon(BlockProcessorDaemon):
     name = "ETH"
     BASE_SPEC_FILE = "daemons/spec/eth.json"
@@ -381,6 +517,7 @@ class ETHDaemon(BlockProcessorDaemon):
     # Disabled for now due to unpredictable gasPrice
     EIP1559_SUPPORTED = False
     DEFAULT_MAX_SYNC_BLOCKS = 300  # (60/12)=5*60 (a block every 12 seconds, max normal expiry time 60 minutes)
+    DEFAULT_FETCH_BATCH_SIZE = 10
 
     UNIT = "wei"
 
@@ -391,20 +528,29 @@ class ETHDaemon(BlockProcessorDaemon):
 
     ARCHIVE_SUPPORTED = True
 
+    trace_backlog_from = StoredProperty("trace_backlog_from", None)  # first block to trace once the trace queue is drained
+    INGESTION_MODES = ("blocks", "logs")
+
     def __init__(self):
         self._should_archive_seed_server = False
         super().__init__()
         self.env_update_hooks = {"server": self.update_server, "archive_server": self.update_archive_server}
         self.contracts = {}
         self.contract_cache = {"decimals": {}, "symbol": {}}
-        self.transfer_event = self.parse_transfer_event_abi()
+        self.abi_selectors = self.parse_abi_selectors()
+        self.trace_available = False
+        self.trace_queue = asyncio.Queue(maxsize=self.TRACE_QUEUE_SIZE)
+        self.trace_height = None
+        self.trace_committed_height = self.latest_height
+        self.logs_filters = {}  # block number -> LogsFilter it was fetched with, until it is committed
 
-    def parse_transfer_event_abi(self):
-        for obj in self.ABI:
-            if obj.get("name") == "Transfer" and obj["type"] == "event":
-                inputs = obj["inputs"]
-                return TransferEventParams(obj, inputs[0]["name"], inputs[1]["name"], inputs[2]["name"])
-        raise Exception("Transfer event not found in ABI")
+    def parse_abi_selectors(self):
+        # type defaults to function in ABI json, but selectors are only computed for explicitly typed entries
+        return {
+            "0x" + function_abi_to_4byte_selector({**obj, "type": "function"}).hex()
+            for obj in self.ABI
+            if obj.get("type", "function") == "function"
+        }
 
     async def update_archive_server(self, start_new=True):
         self.ARCHIVE_SERVER = self.ARCHIVE_SERVER.split(",")
@@ -415,8 +561,6 @@ class ETHDaemon(BlockProcessorDaemon):
 
     async def on_startup(self, app):
         await self.maybe_update_seed_server(start_new=False)
-        self.trace_available = False
-        self.trace_queue = asyncio.Queue()
         await self.create_coin(archive=True)
         with contextlib.suppress(Exception):
             await self.archive_coin.debug_trace_block(1)
@@ -424,7 +568,7 @@ class ETHDaemon(BlockProcessorDaemon):
         await super().on_startup(app)
         if self.trace_available:
             self.archive_limiter = AsyncLimiter(1, 1 / self.ARCHIVE_RATE_LIMIT)
-            asyncio.gather(*[self.run_trace_queue() for _ in range(self.ARCHIVE_CONCURRENCY)])
+            self.loop.create_task(self.run_trace_queue())
 
     def load_env(self):
         super().load_env()
@@ -432,40 +576,141 @@ class ETHDaemon(BlockProcessorDaemon):
         self._should_archive_seed_server = len(self.ARCHIVE_SERVER) == 1 and self.ARCHIVE_SERVER[0] == self.SEED_SERVER
         self.ARCHIVE_CONCURRENCY = self.env("ARCHIVE_CONCURRENCY", default=20, cast=int)
         self.ARCHIVE_RATE_LIMIT = self.env("ARCHIVE_RATE_LIMIT", default=5, cast=int)
+        self.TRACE_QUEUE_SIZE = self.env("TRACE_QUEUE_SIZE", default=1000, cast=int)
+        self.INGESTION_MODE = self.env("INGESTION_MODE", cast=str, default="blocks").lower()
+        if self.INGESTION_MODE not in self.INGESTION_MODES:
+            raise ValueError(f"Invalid INGESTION_MODE: {self.INGESTION_MODE}. Valid values: {', '.join(self.INGESTION_MODES)}")
 
     @rpc
     async def getinfo(self, wallet=None):
         result = await super().getinfo(wallet)
         result["trace_enabled"] = self.trace_available
+        if self.trace_available:
+            result["trace_queue_size"] = self.trace_queue.qsize()
+            result["trace_lag"] = None if self.trace_height is None else max(0, self.latest_height - self.trace_height)
+            result["trace_backlog_from"] = self.trace_backlog_from
         return result
 
+    def get_watched_addresses(self):
+        has_native_wallets = False
+        token_addresses = set()
+        for wallet in self.wallets.values():
+            if wallet.contract_addr:
+                token_addresses.add(wallet.address)
+            else:
+                has_native_wallets = True
+        for address, evicted in self.evicted_addresses.items():
+            for _, contract, _ in evicted.values():
+                if contract:
+                    token_addresses.add(address)
+                else:
+                    has_native_wallets = True
+        return has_native_wallets, token_addresses
+
+    def get_logs_filter(self):
+        has_native_wallets, token_addresses = self.get_watched_addresses()
+        # while catching up after startup, or without wallets, nothing is known about wallets to be loaded later, which
+        # replay recent blocks: fetch them unfiltered
+        unfiltered = not self.synchronized or not (has_native_wallets or token_addresses)
+        return LogsFilter(
+            full_blocks=unfiltered or has_native_wallets,
+            contracts=frozenset(self.contracts),
+            recipients=None if unfiltered or len(token_addresses) > LOGS_MAX_RECIPIENT_TOPICS else frozenset(token_addresses),
+        )
+
+    async def fetch_blocks(self, block_numbers):
+        if self.INGESTION_MODE != "logs":
+            return await super().fetch_blocks(block_numbers)
+        # token transfers are found with eth_getLogs over the whole range, full blocks are only needed for native coin
+        logs_filter = self.get_logs_filter()
+        blocks = [[] for _ in block_numbers]
+        if logs_filter.full_blocks:
+            blocks = await self.coin.get_blocks_txes(block_numbers, receipts=False)
+        if logs_filter.contracts:
+            try:
+                logs = await self.coin.get_transfer_logs(
+                    block_numbers[0], block_numbers[-1], logs_filter.contracts, logs_filter.recipients
+                )
+            except Exception as e:
+                return [e] * len(block_numbers)
+            for log in logs:
+                block = blocks[int(log["blockNumber"], 16) - block_numbers[0]]
+                if not isinstance(block, BaseException):
+                    block.append(log)
+        for block_number in block_numbers:
+            self.logs_filters[block_number] = logs_filter
+        return blocks
+
+    async def prepare_block(self, block_number, block):
+        fetched_with = self.logs_filters.pop(block_number, None)
+        if fetched_with is not None and not fetched_with.covers(self.get_logs_filter()):
+            # wallets were loaded since the block was fetched, it might miss their transactions
+            block = (await self.fetch_blocks([block_number]))[0]
+            self.logs_filters.pop(block_number, None)
+            if isinstance(block, BaseException):
+                raise block
+        return block
+
+    async def trace_block(self, block_number):
+        delay = TRACE_RETRY_DELAY
+        for attempt in range(TRACE_ATTEMPTS):
+            async with self.archive_limiter:
+                with contextlib.suppress(Exception):
+                    debug_data = await self.archive_coin.debug_trace_block(block_number)
+                    if debug_data:
+                        return [Transaction(*x) for x in self.coin.find_all_trace_outputs(debug_data)]
+            if attempt < TRACE_ATTEMPTS - 1:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, TRACE_MAX_RETRY_DELAY)
+        raise Exception(f"Error getting debug trace for {block_number}")
+
+    def enqueue_trace(self, block_number):
+        if not self.trace_available:
+            return
+        self.trace_committed_height = block_number
+        if self.trace_backlog_from is not None:
+            return
+        try:
+            self.trace_queue.put_nowait(block_number)
+        except asyncio.QueueFull:
+            # the tracer doesn't keep up: remember where it has to resume from instead of holding back ingestion
+            logger.warning(f"Trace queue is full, tracing blocks from {block_number} from backlog")
+            self.trace_backlog_from = block_number
+
+    async def next_trace_block(self):
+        # queued blocks are older than the backlog, so it is only traced once the queue is drained
+        if self.trace_backlog_from is not None and self.trace_queue.empty():
+            block_number = self.trace_backlog_from
+            if block_number <= self.trace_committed_height:
+                self.trace_backlog_from = block_number + 1
+                return block_number
+            self.trace_backlog_from = None
+        return await self.trace_queue.get()
+
     async def run_trace_queue(self):
+        # up to ARCHIVE_CONCURRENCY blocks are traced in parallel, but results are processed in block order
+        traces = asyncio.Queue(maxsize=self.ARCHIVE_CONCURRENCY)
+        self.loop.create_task(self.process_traces(traces))
+        while self.running:
+            block_number = await self.next_trace_block()
+            await traces.put((block_number, asyncio.ensure_future(self.trace_block(block_number))))
+
+    async def process_traces(self, traces):
         while self.running:
-            block_number = await self.trace_queue.get()
+            block_number, task = await traces.get()
             try:
-                debug_data = None
-                for _ in range(5):
-                    async with self.archive_limiter:
-                        with contextlib.suppress(Exception):
-                            debug_data = await self.archive_coin.debug_trace_block(block_number)
-                    if debug_data:
-                        break
-                    await asyncio.sleep(5)
-                if not debug_data:
-                    raise Exception(f"Error getting debug trace for {block_number}")
-                txes = [
-                    Transaction(
-                        x[0],
-                        x[1],
-                        x[2],
-                        x[3],
-                    )
-                    for x in self.coin.find_all_trace_outputs(debug_data)
-                ]
-                [asyncio.ensure_future(self.process_transaction(tx)) for tx in txes]
+                txes = await task
             except Exception:
                 logger.error(f"Error processing debug trace for {block_number}:")
                 logger.error(traceback.format_exc())
+                txes = []
+            for tx in txes:
+                try:
+                    await self.process_transaction(tx)
+                except Exception:
+                    logger.error(f"Error processing transaction {tx.hash}:")
+                    logger.error(traceback.format_exc())
+            self.trace_height = block_number
 
     async def create_coin(self, archive=False):
         server_providers = []
@@ -475,7 +720,7 @@ class ETHDaemon(BlockProcessorDaemon):
             provider = EthereumRPCProvider(
                 server,
                 request_kwargs={
-                    "timeout": 5 * 60,
+                    "timeout": self.connector_settings.timeout,
                     "headers": {
                         f"{RPC_SOURCE}-Source": f"{RPC_ORIGIN}/{RPC_DEST}",
                         "Content-Type": "application/json",
@@ -497,12 +742,13 @@ class ETHDaemon(BlockProcessorDaemon):
                 },
             )
             server_providers.append(provider)
-        provider = MultipleProviderRPC(server_providers)
+        provider = MultipleProviderRPC(server_providers, hedge_requests=self.HEDGE_REQUESTS)
         await provider.start()
         web3 = AsyncWeb3(MultipleRPCEthereumProvider(provider))
         web3.middleware_onion.clear()
         for provider in web3.provider.rpc.providers:
             provider.web3 = web3
+            await provider.use_session(self.connector_settings)
             await provider.prepare_for_requests()  # required to call retry middlewares individually
         web3.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
         if archive:
@@ -570,22 +816,23 @@ class ETHDaemon(BlockProcessorDaemon):
         if not xpub:
             return None
 
-        if diskless:
-            wallet = self.restore_wallet_from_text(xpub, contract, path=NOOP_PATH, **extra_params)
-        else:
-            wallet_dir = self.get_wallet_path()
-            wallet_path = os.path.join(wallet_dir, wallet_key)
-            if not os.path.exists(wallet_path):
-                self.restore(xpub, wallet_path=wallet_path, contract=contract, **extra_params)
-            storage = Storage(wallet_path)
-            db = WalletDB(storage.read())
-            wallet = self.WALLET_CLASS(self.coin, db, storage)
+        with self.derived_keys.use(diskless or extra_params.get("one_time", False)):
+            if diskless:
+                wallet = self.restore_wallet_from_text(xpub, contract, path=NOOP_PATH, **extra_params)
+            else:
+                wallet_dir = self.get_wallet_path()
+                wallet_path = os.path.join(wallet_dir, wallet_key)
+                if not self.wallet_exists(wallet_path):
+                    self.restore(xpub, wallet_path=wallet_path, contract=contract, **extra_params)
+                storage = self.create_storage(wallet_path)
+                db = self.load_wallet_db(storage)
+                wallet = self.WALLET_CLASS(self.coin, db, storage)
         self.process_extra_params(wallet, extra_params)
         self.wallets[wallet_key] = wallet
-        self.wallets_updates[wallet_key] = deque(maxlen=self.POLLING_CAP)
+        self.updates_log.add_wallet(wallet_key)
         self.addresses[wallet.address].add(wallet_key)
         await self.add_contract(contract, wallet_key)
-        await wallet.start(self.latest_blocks.copy())
+        await wallet.start(self.get_replay_transactions(wallet))
         return wallet
 
     #########
@@ -662,8 +909,11 @@ class ETHDaemon(BlockProcessorDaemon):
 
     @rpc(requires_network=True)
     async def gettransaction(self, tx, wallet=None):
-        data = self.coin.to_dict(await self.coin.get_transaction(tx))
-        data["confirmations"] = await self.coin.get_confirmations(tx, data)
+        async def fetch():
+            return self.coin.to_dict(await self.coin.get_transaction(tx))
+
+        data, confirmations = await self.get_final_tx_data("gettransaction", tx, fetch)
+        data["confirmations"] = confirmations
         return data
 
     @rpc(requires_wallet=True)
@@ -769,14 +1019,32 @@ class ETHDaemon(BlockProcessorDaemon):
 
     @rpc(requires_network=True)
     async def readcontract(self, address, function, *args, **kwargs):
+        block_identifier = try_cast_num(kwargs.pop("block_identifier", "latest"))
         cacheable_function = function in ("decimals", "symbol")
         cache_key = self._get_contract_cache_key(address) if cacheable_function else None
         if cacheable_function and (value := self.contract_cache[function].get(cache_key)) is not None:
             return value
+        # calls pinned to a block deep enough can't change anymore
+        final_key = None
+        if isinstance(block_identifier, int) and not cacheable_function:
+            height = await self.coin.get_cached_block_number()
+            if height - block_identifier + 1 >= self.RESPONSE_CACHE_CONFIRMATIONS:
+                final_key = (
+                    "readcontract",
+                    self._get_contract_cache_key(address),
+                    function,
+                    block_identifier,
+                    repr(args),
+                    repr(sorted((k, v) for k, v in kwargs.items() if k != "wallet")),
+                )
+                if (value := self.response_cache.get(final_key)) is not ResponseCache.MISSING:
+                    return value
         exec_function = await self.load_contract_exec_function(address, function, *args, **kwargs)
-        result = await exec_function.call()
+        result = await exec_function.call(block_identifier=block_identifier)
         if cacheable_function:
             self.contract_cache[function][cache_key] = result
+        if final_key is not None:
+            self.response_cache.set(final_key, result)
         return result
 
     @rpc(requires_wallet=True)
@@ -1,15 +1,18 @@
 from base import BaseDaemon  # isort: skip
 
 import asyncio
+import contextlib
 import functools
+import hashlib
 import inspect
+import itertools
 import json
 import os
 import secrets
 import time
 import traceback
 from abc import ABCMeta, abstractmethod
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
 from contextvars import ContextVar
 from dataclasses import dataclass, field
 from decimal import Decimal
@@ -17,10 +20,31 @@ from decimal import Decimal
 from aiohttp import ClientSession
 from logger import get_logger
 from storage import ConfigDB as StorageConfigDB
+from storage import (
+    JournaledStorage,
+    SQLiteStorage,
+    SQLiteWalletStore,
+    Storage,
+    StoredDBProperty,
+    StoredObject,
+    StoredProperty,
+    decimal_to_string,
+    get_encoder,
+    to_jsonable,
+)
 from storage import JSONEncoder as StorageJSONEncoder
-from storage import Storage, StoredDBProperty, StoredObject, StoredProperty, decimal_to_string
 from storage import WalletDB as StorageWalletDB
-from utils import CastingDataclass, JsonResponse, get_exception_message, get_function_header, hide_logging_errors, rpc
+from utils import (
+    CastingDataclass,
+    ConnectorSettings,
+    JsonResponse,
+    UpdatesLog,
+    get_exception_message,
+    get_function_header,
+    hide_logging_errors,
+    periodic_task,
+    rpc,
+)
 
 logger = get_logger(__name__)
 
@@ -33,8 +57,10 @@ NO_MASTER_KEYS_MESSAGE = "As we use only one address per wallet, address keys ar
 
 NOOP_PATH = object()
 
-CHUNK_SIZE = 30
 AMOUNTGEN_LIMIT = 10**9
+MAX_BLOCK_FETCH_ATTEMPTS = 3
+MAX_BLOCK_RETRY_DELAY = 5 * 60
+EVICTION_SCAN_LIMIT = 100
 
 
 # statuses of payment requests
@@ -57,6 +83,9 @@ class Transaction:
 
 
 class BlockchainFeatures(metaclass=ABCMeta):
+    _block_number = None
+    _block_number_ts = 0.0
+
     def __init__(self, rpc):
         self.rpc = rpc
 
@@ -64,6 +93,17 @@ class BlockchainFeatures(metaclass=ABCMeta):
     def get_block_number(self) -> int:
         pass
 
+    def update_block_number(self, block_number):
+        self._block_number = block_number
+        self._block_number_ts = time.monotonic()
+        return block_number
+
+    async def get_cached_block_number(self) -> int:
+        # chain tip is refreshed by process_pending every block time, so hot paths don't need a network round trip
+        if self._block_number is not None and time.monotonic() - self._block_number_ts < daemon_ctx.get().BLOCK_TIME:
+            return self._block_number
+        return self.update_block_number(await self.get_block_number())
+
     @abstractmethod
     async def is_connected(self) -> bool:
         pass
@@ -92,6 +132,10 @@ class BlockchainFeatures(metaclass=ABCMeta):
     async def get_block_txes(self, block) -> list:
         pass
 
+    async def get_blocks_txes(self, blocks) -> list:
+        # failed blocks are returned as exceptions, so that one bad block doesn't fail the whole batch
+        return await asyncio.gather(*(self.get_block_txes(block) for block in blocks), return_exceptions=True)
+
     @abstractmethod
     def is_address(self, address) -> bool:
         pass
@@ -116,6 +160,16 @@ class BlockchainFeatures(metaclass=ABCMeta):
             return result
         return [result]
 
+    async def parse_block(self, block) -> list[Transaction]:
+        transactions = []
+        for tx_data in block:
+            try:
+                transactions.extend(await self.parse_transactions(tx_data))
+            except Exception:
+                logger.error(f"Error processing transaction {self.get_tx_hash(tx_data)}:")
+                logger.error(traceback.format_exc())
+        return transactions
+
     @abstractmethod
     def get_tx_hash(self, tx_data) -> str:
         pass
@@ -131,16 +185,280 @@ class BlockchainFeatures(metaclass=ABCMeta):
         return xpub
 
     def to_dict(self, obj):
-        return json.loads(StorageJSONEncoder(precision=daemon_ctx.get().DIVISIBILITY).encode(obj))
+        return to_jsonable(obj, get_encoder(StorageJSONEncoder, daemon_ctx.get().DIVISIBILITY))
 
     @abstractmethod
     def current_server(self):
         pass
 
+    def provider_stats(self):
+        return []
+
 
 pr_tooltips = {PR_UNPAID: "Unpaid", PR_PAID: "Paid", PR_EXPIRED: "Expired", PR_UNCONFIRMED: "Unconfirmed"}
 
 
+class RecentBlocks:
+    """Parsed transactions of the latest blocks, indexed by recipient address
+
+    Newly loaded wallets replay only the transactions sent to them instead of every recent block
+    """
+
+    def __init__(self, max_blocks):
+        self.max_blocks = max_blocks
+        self.blocks = deque()
+        self.by_address = defaultdict(deque)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def append(self, transactions):
+        if self.max_blocks <= 0:
+            return
+        if len(self.blocks) >= self.max_blocks:
+            self.evict_oldest()
+        self.blocks.append(transactions)
+        for tx in transactions:
+            self.by_address[tx.to].append(tx)
+
+    def evict_oldest(self):
+        # transactions are indexed in block order, so the oldest block's ones are at the front of each address deque
+        for tx in self.blocks.popleft():
+            address_txes = self.by_address[tx.to]
+            address_txes.popleft()
+            if not address_txes:
+                del self.by_address[tx.to]
+
+    def get_address_transactions(self, address):
+        return list(self.by_address.get(address, ()))
+
+    def get_all_transactions(self):
+        return [tx for block in self.blocks for tx in block]
+
+
+class ResponseCache:
+    """Bounded LRU cache of upstream results which can no longer change"""
+
+    MISSING = object()  # sentinel
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return self.MISSING
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class DerivedKeyCache:
+    """Bounded cache of accounts derived by keystores, keyed by a hash of the key material
+
+    Deriving an account from a mnemonic runs PBKDF2 and BIP32, which dominates loading diskless and one-time wallets.
+    The cache is only consulted inside ``use()`` blocks, entries expire after ``ttl`` seconds and ``wipe()`` drops
+    all derived secrets at once.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # digest -> (expires_at, derived fields)
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+
+    @contextlib.contextmanager
+    def use(self, enabled=True):
+        # only wraps synchronous code, so the flag can't leak to other tasks
+        prev_enabled, self.enabled = self.enabled, enabled and self.max_size > 0
+        try:
+            yield
+        finally:
+            self.enabled = prev_enabled
+
+    @staticmethod
+    def get_key(material):
+        return hashlib.sha256("\0".join(str(part) for part in material).encode()).hexdigest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value):
+        now = time.monotonic()
+        for expired_key in [k for k, (expires_at, _) in self.entries.items() if expires_at <= now]:
+            del self.entries[expired_key]
+        self.entries[key] = (now + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def load(self, keystore):
+        if not self.enabled:
+            keystore.load_account_from_key()
+            return
+        key = self.get_key(keystore.get_key_material())
+        derived = self.get(key)
+        if derived is None:
+            keystore.load_account_from_key()
+            derived = {name: getattr(keystore, name) for name in keystore.DERIVED_FIELDS}
+            self.set(key, derived)
+        for name, value in derived.items():
+            setattr(keystore, name, value)
+
+    def wipe(self):
+        count = len(self.entries)
+        self.entries.clear()
+        return count
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class ExpiryScheduler:
+    """Single daemon-wide timer expiring payment requests
+
+    Pending expiries are kept in an indexed binary min-heap, so that both scheduling and cancelling are O(log n),
+    and only one task sleeps until the closest expiry time.
+    """
+
+    def __init__(self):
+        self.heap = []  # [expires_at, (wallet id, request id), wallet]
+        self.positions = {}
+        self.wallet_requests = defaultdict(set)
+        self.wakeup = asyncio.Event()
+        self.running = False
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, wallet, req):
+        key = (id(wallet), req.id)
+        if key in self.positions:
+            self._remove(self.positions[key])
+        expires_at = req.time + req.exp + 1  # to ensure it's already expired at that moment
+        self.heap.append([expires_at, key, wallet])
+        self.positions[key] = len(self.heap) - 1
+        self.wallet_requests[id(wallet)].add(req.id)
+        if self._sift_up(len(self.heap) - 1) == 0:
+            self.wakeup.set()
+
+    def cancel(self, wallet, request_id):
+        idx = self.positions.get((id(wallet), request_id))
+        if idx is None:
+            return False
+        self._remove(idx)
+        requests = self.wallet_requests[id(wallet)]
+        requests.discard(request_id)
+        if not requests:
+            self.wallet_requests.pop(id(wallet), None)
+        return True
+
+    def cancel_wallet(self, wallet):
+        for request_id in list(self.wallet_requests.get(id(wallet), ())):
+            self.cancel(wallet, request_id)
+
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, (_, request_id), wallet = self.heap[0]
+            self.cancel(wallet, request_id)
+            due.append((wallet, request_id))
+        return due
+
+    async def run(self):
+        self.running = True
+        while self.running:
+            self.wakeup.clear()
+            timeout = max(0, self.heap[0][0] - time.time()) if self.heap else None
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            for wallet, request_id in self.pop_due(time.time()):
+                try:
+                    wallet.expire_request(request_id)
+                except Exception:
+                    logger.error(f"Error expiring request {request_id}:")
+                    logger.error(traceback.format_exc())
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def _swap(self, i, j):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.positions[self.heap[i][1]] = i
+        self.positions[self.heap[j][1]] = j
+
+    def _sift_up(self, idx):
+        while idx > 0:
+            parent = (idx - 1) // 2
+            if self.heap[parent][0] <= self.heap[idx][0]:
+                break
+            self._swap(idx, parent)
+            idx = parent
+        return idx
+
+    def _sift_down(self, idx):
+        size = len(self.heap)
+        while True:
+            smallest = idx
+            for child in (2 * idx + 1, 2 * idx + 2):
+                if child < size and self.heap[child][0] < self.heap[smallest][0]:
+                    smallest = child
+            if smallest == idx:
+                return idx
+            self._swap(idx, smallest)
+            idx = smallest
+
+    def _remove(self, idx):
+        del self.positions[self.heap[idx][1]]
+        last = self.heap.pop()
+        if idx < len(self.heap):
+            self.heap[idx] = last
+            self.positions[last[1]] = idx
+            self._sift_down(self._sift_up(idx))
+
+
 STR_TO_BOOL_MAPPING = {
     "true": True,
     "yes": True,
@@ -235,11 +553,18 @@ class KeyStore(metaclass=ABCMeta):
     seed: str = None
     contract: str = None
 
+    # attributes set by load_account_from_key, restored from the daemon's derived key cache
+    DERIVED_FIELDS = ("address", "public_key", "private_key", "seed")
+
     def is_watching_only(self):
         return self.private_key is None
 
     def __post_init__(self):
-        self.load_account_from_key()
+        daemon_ctx.get().derived_keys.load(self)
+
+    def get_key_material(self):
+        # everything load_account_from_key derives from
+        return (type(self).__qualname__, self.key)
 
     @abstractmethod
     def load_account_from_key(self):
@@ -307,34 +632,52 @@ class Wallet:
         self.request_addresses = self.db.get_dict("request_addresses")
         self.running = False
         self.loop = asyncio.get_event_loop()
-        self.synchronized = False
+        self.sync_event = asyncio.Event()
+
+    @property
+    def synchronized(self):
+        return self.sync_event.is_set()
+
+    @synchronized.setter
+    def synchronized(self, value):
+        if value:
+            self.sync_event.set()
+        else:
+            self.sync_event.clear()
 
-    def save_db(self):
-        if self.storage:
+    def save_db(self, force=False):
+        if not self.storage:
+            return
+        if self.storage.is_in_memory_only():
+            # nothing to persist, only drop the change tracking instead of queueing a flush
+            self.db.set_modified(False)
+            return
+        if force or not daemon_ctx.get().FLUSH_INTERVAL:
             self.db.write(self.storage)
+        else:
+            daemon_ctx.get().mark_dirty(self)
 
     async def _start_init_vars(self):
         if self.latest_height == -1:
-            self.latest_height = await self.coin.get_block_number()
+            self.latest_height = await self.coin.get_cached_block_number()
 
-    async def _start_process_pending(self, blocks, current_height):
-        for block in blocks:
-            for tx in block:
-                try:
-                    await daemon_ctx.get().process_transaction(tx)
-                except Exception:
-                    logger.error(f"Error processing transaction {self.coin.get_tx_hash(tx)}:")
-                    logger.error(traceback.format_exc())
+    async def _start_process_pending(self, transactions, current_height):
+        for tx in transactions:
+            try:
+                await daemon_ctx.get().process_transaction(tx)
+            except Exception:
+                logger.error(f"Error processing transaction {self.coin.get_tx_hash(tx)}:")
+                logger.error(traceback.format_exc())
 
-    async def start(self, blocks):
+    async def start(self, transactions):
         first_start = self.latest_height == -1
         await self._start_init_vars()
 
         self.running = True
         # process onchain transactions
-        current_height = await self.coin.get_block_number()
+        current_height = await self.coin.get_cached_block_number()
         if not first_start and not daemon_ctx.get().NO_DOWNTIME_PROCESSING:
-            await self._start_process_pending(blocks, current_height)
+            await self._start_process_pending(transactions, current_height)
 
         self.latest_height = current_height
         for req in self.get_sorted_requests():
@@ -342,10 +685,11 @@ class Wallet:
                 if req.exp > 0 and req.time + req.exp < time.time():
                     self.set_request_status(req.id, PR_EXPIRED)
                 else:
-                    self.loop.create_task(self.expired_task(req))
+                    daemon_ctx.get().expiry_scheduler.schedule(self, req)
         self.synchronized = True
 
     def clear_requests(self):
+        daemon_ctx.get().expiry_scheduler.cancel_wallet(self)
         self.receive_requests.clear()
         self.request_addresses.clear()
         self.save_db()
@@ -400,7 +744,7 @@ class Wallet:
             sent_amount=Decimal(0),
             exp=expiration,
             id=secrets.token_urlsafe(),
-            height=await self.coin.get_block_number(),
+            height=await self.coin.get_cached_block_number(),
         )
 
     def add_payment_request(self, req, save_db=True):
@@ -446,6 +790,7 @@ class Wallet:
         if not req:
             return False
         self.remove_from_detection_dict(req)
+        daemon_ctx.get().expiry_scheduler.cancel(self, req.id)
         self.receive_requests.pop(req.id, None)
         self.save_db()
         return True
@@ -473,6 +818,7 @@ class Wallet:
         self.add_payment_request(req, save_db=False)
         if status in (PR_PAID, PR_EXPIRED):
             self.remove_from_detection_dict(req)
+            daemon_ctx.get().expiry_scheduler.cancel(self, req.id)
         self.save_db()
         return req
 
@@ -486,14 +832,8 @@ class Wallet:
         self.add_payment_request(req)
         return req
 
-    async def expired_task(self, req):
-        left = req.time + req.exp - time.time() + 1  # to ensure it's already expired at that moment
-        if left > 0:
-            await asyncio.sleep(left)
-        req = self.get_request(req.id)
-        if req is None:
-            return
-        self.set_request_status(req.id, PR_EXPIRED)
+    def expire_request(self, key):
+        self.set_request_status(key, PR_EXPIRED)
 
     async def process_new_payment(self, lookup_field, tx, amount, wallet):
         req = self.get_request(lookup_field)
@@ -548,9 +888,12 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
     DIVISIBILITY: int
     BLOCK_TIME: int
     DEFAULT_MAX_SYNC_BLOCKS: int
+    DEFAULT_FETCH_BATCH_SIZE = 1
     AMOUNTGEN_DIVISIBILITY = 8  # Max number of decimal places to use for amounts generation
 
     SPEED_MULTIPLIERS = {"network": 1, "regular": 1.25, "fast": 1.5}
+    STORAGE_MODES = ("json", "journal", "sqlite")
+    WALLET_EVICTION_SUPPORTED = True
 
     VERSION = "4.5.0"  # version of electrum API with which we are "compatible"
 
@@ -567,21 +910,34 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
 
     def __init__(self):
         self._should_check_seed_server = False
+        # the synchronized property is read while BaseDaemon collects RPC handlers
+        self.sync_event = asyncio.Event()
         super().__init__()
         daemon_ctx.set(self)
-        self.latest_blocks = deque(maxlen=self.MAX_SYNC_BLOCKS)
+        self.latest_blocks = RecentBlocks(self.MAX_SYNC_BLOCKS)
         self.config_path = os.path.join(self.get_datadir(), "config")
         self.config = ConfigDB(self.config_path)
+        self.wallet_store = None
+        if self.STORAGE_MODE == "sqlite":
+            self.wallet_store = SQLiteWalletStore(os.path.join(self.get_datadir(), "wallets.sqlite"))
         self.env_update_hooks = {"server": self.update_server}  # TODO: add a way to extend
         # initialize wallet storages
-        self.wallets = {}
+        self.wallets = OrderedDict()  # in least recently used order
         self.addresses = defaultdict(set)
+        self.wallet_params = {}  # wallet key -> (xpub, contract, extra_params) it was loaded with
+        self.evicted_addresses = defaultdict(dict)  # address -> {wallet key: load params} of evicted wallets
+        self.wallet_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
         self.wallet_locks = defaultdict(asyncio.Lock)
-        self.wallets_updates = {}
+        self.updates_log = UpdatesLog(self.POLLING_CAP)
+        self.dirty_wallets = {}
+        self.block_failures = defaultdict(int)
+        self.expiry_scheduler = ExpiryScheduler()
+        self.blocks_per_second = 0.0
+        self.response_cache = ResponseCache(self.RESPONSE_CACHE_SIZE)
+        self.derived_keys = DerivedKeyCache(self.DERIVED_KEYS_CACHE_SIZE, self.DERIVED_KEYS_CACHE_TTL)
         # initialize not yet created network
         self.running = True
         self.loop = None
-        self.synchronized = False
 
     async def update_server(self, start_new=True):
         self.SERVER = self.SERVER.split(",")
@@ -621,6 +977,28 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
                 ) from None
             self.SPEED_MULTIPLIER = self.SPEED_MULTIPLIERS[self.TX_SPEED]
         self.NO_DOWNTIME_PROCESSING = self.env("NO_DOWNTIME_PROCESSING", cast=bool, default=False)
+        self.HEDGE_REQUESTS = self.env("HEDGE_REQUESTS", cast=bool, default=False)
+        self.RESPONSE_CACHE_SIZE = self.env("RESPONSE_CACHE_SIZE", cast=int, default=10000)
+        self.RESPONSE_CACHE_CONFIRMATIONS = self.env("RESPONSE_CACHE_CONFIRMATIONS", cast=int, default=20)
+        self.DERIVED_KEYS_CACHE_SIZE = self.env("DERIVED_KEYS_CACHE_SIZE", cast=int, default=100)
+        self.DERIVED_KEYS_CACHE_TTL = self.env("DERIVED_KEYS_CACHE_TTL", cast=float, default=600)
+        self.connector_settings = ConnectorSettings(
+            pool_size=self.env("RPC_POOL_SIZE", cast=int, default=100),
+            pool_size_per_host=self.env("RPC_POOL_SIZE_PER_HOST", cast=int, default=20),
+            keepalive_timeout=self.env("RPC_KEEPALIVE_TIMEOUT", cast=float, default=30),
+            pool_timeout=self.env("RPC_POOL_TIMEOUT", cast=float, default=30),
+            connect_timeout=self.env("RPC_CONNECT_TIMEOUT", cast=float, default=10),
+            read_timeout=self.env("RPC_READ_TIMEOUT", cast=float, default=60),
+            dns_cache_ttl=self.env("RPC_DNS_CACHE_TTL", cast=int, default=300),
+        )
+        self.FETCH_CONCURRENCY = max(1, self.env("FETCH_CONCURRENCY", cast=int, default=10))
+        self.FETCH_BATCH_SIZE = max(1, self.env("FETCH_BATCH_SIZE", cast=int, default=self.DEFAULT_FETCH_BATCH_SIZE))
+        self.MAX_LOADED_WALLETS = self.env("MAX_LOADED_WALLETS", cast=int, default=0) if self.WALLET_EVICTION_SUPPORTED else 0
+        self.EVICTION_INTERVAL = self.env("EVICTION_INTERVAL", cast=float, default=60)
+        self.FLUSH_INTERVAL = self.env("FLUSH_INTERVAL", cast=float, default=0)
+        self.STORAGE_MODE = self.env("STORAGE_MODE", cast=str, default="json").lower()
+        if self.STORAGE_MODE not in self.STORAGE_MODES:
+            raise ValueError(f"Invalid STORAGE_MODE: {self.STORAGE_MODE}. Valid values: {', '.join(self.STORAGE_MODES)}")
 
     async def on_startup(self, app):
         await super().on_startup(app)
@@ -630,7 +1008,13 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
         if self.latest_height == -1:
             self.latest_height = await self.coin.get_block_number()
         self.loop.create_task(self.process_pending())
+        self.loop.create_task(self.expiry_scheduler.run())
         self.loop.create_task(self.update_seed_servers())
+        if self.FLUSH_INTERVAL:
+            self.loop.create_task(periodic_task(self, self.flush_dirty_wallets, self.FLUSH_INTERVAL))
+        if self.MAX_LOADED_WALLETS:
+            # wallets loaded through batch_load or left idle also need to be evicted without further requests
+            self.loop.create_task(periodic_task(self, self.evict_idle_wallets, self.EVICTION_INTERVAL))
 
     async def maybe_update_seed_server(self, start_new=True):
         if self.SEED_SERVER and self._should_check_seed_server:
@@ -673,6 +1057,8 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
             tx.divisibility = self.DIVISIBILITY
         to = tx.to
         amount = from_wei(tx.value, tx.divisibility)
+        if to in self.evicted_addresses:
+            await self.reload_evicted_wallets(to)
         if to not in self.addresses:
             return
         for wallet in self.addresses[to]:
@@ -693,78 +1079,163 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
             if tx.from_addr in self.wallets[wallet].request_addresses:
                 self.loop.create_task(self.wallets[wallet].process_new_payment(tx.from_addr, tx, amount, wallet))
 
-    async def process_tx_task(self, tx_data, semaphore):
-        async with semaphore:
-            try:
-                result = await self.coin.parse_transactions(tx_data)
-                for tx in result:
-                    await self.process_transaction(tx)
-                return result
-            except Exception:
-                logger.error(f"Error processing transaction {self.coin.get_tx_hash(tx_data)}:")
-                logger.error(traceback.format_exc())
+    def is_watched_transaction(self, tx):
+        return tx.to in self.addresses or tx.to in self.evicted_addresses
+
+    def get_replay_transactions(self, wallet):
+        """Recent transactions a newly loaded wallet has to replay to catch up on downtime"""
+        return self.latest_blocks.get_address_transactions(wallet.address)
+
+    async def fetch_blocks(self, block_numbers):
+        return await self.coin.get_blocks_txes(block_numbers)
+
+    def enqueue_trace(self, block_number):
+        """Schedule tracing of a committed block, must never wait for the tracer"""
+
+    async def prepare_block(self, block_number, block):
+        """Check a fetched block right before it is committed, exceptions count as failed fetches"""
+        return block
+
+    async def commit_block(self, block_number, block):
+        try:
+            await self.trigger_event({"event": "new_block", "height": block_number}, None)
+            self.enqueue_trace(block_number)
+            transactions = await self.coin.parse_block(block)
+            await self.process_block_transactions(transactions)
+            # all transactions are kept, as wallets loaded later replay them
+            self.latest_blocks.append(transactions)
+        except Exception:
+            logger.error(f"Error processing block {block_number}:")
+            logger.error(traceback.format_exc())
 
-    async def process_block(self, start_height, end_height):
-        for block_number in range(start_height, end_height + 1):
+    async def process_block_transactions(self, transactions):
+        for tx in transactions:
+            if not self.is_watched_transaction(tx):
+                continue
             try:
-                await self.trigger_event({"event": "new_block", "height": block_number}, None)
-                if getattr(self, "trace_available", False):
-                    await self.trace_queue.put(block_number)
-                block = await self.coin.get_block_txes(block_number)
-                transactions = []
-                tasks = []
-                semaphore = asyncio.Semaphore(20)
-                for tx_data in block:
-                    tasks.append(self.process_tx_task(tx_data, semaphore))
-                results = await asyncio.gather(*tasks)
-                for res in results:
-                    if res is not None:
-                        transactions.extend(res)
-                self.latest_blocks.append(transactions)
+                await self.process_transaction(tx)
             except Exception:
-                logger.error(f"Error processing block {block_number}:")
+                logger.error(f"Error processing transaction {tx.hash}:")
                 logger.error(traceback.format_exc())
 
-    async def process_block_by_chunks(self, start_height, end_height):
-        tasks = []
-        for block_number in range(start_height, end_height + 1, CHUNK_SIZE):
-            tasks.append(self.process_block(block_number, min(block_number + CHUNK_SIZE - 1, end_height)))
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        if self.VERBOSE:
-            for task in results:
-                if isinstance(task, Exception):
-                    logger.error(get_exception_traceback(task))
+    def should_skip_block(self, block_number, checkpoint):
+        # without checkpoints (rescans) failed blocks are skipped right away, otherwise we retry on next iterations
+        if not checkpoint:
+            return True
+        self.block_failures[block_number] += 1
+        failures = self.block_failures[block_number]
+        if failures >= MAX_BLOCK_FETCH_ATTEMPTS:
+            logger.error(f"Skipping block {block_number} after {failures} failed attempts")
+            return True
+        logger.warning(f"Block {block_number} failed {failures} times, retrying in {self.get_retry_delay(block_number)}s")
+        return False
+
+    def get_retry_delay(self, block_number):
+        # back off while the same block keeps failing
+        failures = self.block_failures.get(block_number, 0)
+        return min(self.BLOCK_TIME * 2**failures, MAX_BLOCK_RETRY_DELAY) if failures else self.BLOCK_TIME
+
+    async def process_blocks(self, start_height, end_height, checkpoint=True):
+        """Fetch blocks in batches with a bounded prefetch window and commit them strictly in order
+
+        With checkpoint enabled, latest_height is persisted after every committed block, and processing stops at the
+        first block which can't be fetched, to be resumed from there on next iteration.
+
+        Returns the last committed height.
+        """
+        committed_height = start_height - 1
+        fetches = {}
+        next_fetch = start_height
+        started = time.monotonic()
+        try:
+            for block_number in range(start_height, end_height + 1):
+                while next_fetch <= end_height and next_fetch < block_number + self.FETCH_CONCURRENCY * self.FETCH_BATCH_SIZE:
+                    batch = range(next_fetch, min(next_fetch + self.FETCH_BATCH_SIZE, end_height + 1))
+                    task = asyncio.ensure_future(self.fetch_blocks(list(batch)))
+                    for idx, batch_block in enumerate(batch):
+                        fetches[batch_block] = (task, idx)
+                    next_fetch = batch.stop
+                task, idx = fetches.pop(block_number)
+                try:
+                    block = (await task)[idx]
+                    if isinstance(block, BaseException):
+                        raise block
+                    block = await self.prepare_block(block_number, block)
+                except Exception:
+                    logger.error(f"Error fetching block {block_number}:")
+                    logger.error(traceback.format_exc())
+                    if not self.should_skip_block(block_number, checkpoint):
+                        break
+                else:
+                    await self.commit_block(block_number, block)
+                self.block_failures.pop(block_number, None)
+                committed_height = block_number
+                if checkpoint:
+                    self.latest_height = block_number
+        finally:
+            for task in {task for task, _ in fetches.values()}:
+                if task.done() and not task.cancelled():
+                    task.exception()  # retrieve it to avoid warnings
+                task.cancel()
+        self.update_sync_stats(committed_height - start_height + 1, time.monotonic() - started)
+        return committed_height
+
+    def update_sync_stats(self, blocks, elapsed):
+        if blocks > 0 and elapsed > 0:
+            self.blocks_per_second = blocks / elapsed
+            logger.debug(f"Processed {blocks} blocks in {elapsed:.2f}s ({self.blocks_per_second:.2f} blocks/s)")
+
+    def get_sync_lag(self):
+        if self.coin._block_number is None:
+            return None
+        return max(0, self.coin._block_number - self.latest_height)
 
     async def process_pending(self):
         while self.running:
             try:
-                current_height = await self.coin.get_block_number()
-                # process at max 300 blocks since last processed block, fetched by chunks
-                await self.process_block_by_chunks(
-                    self.latest_height + 1, min(self.latest_height + self.MAX_SYNC_BLOCKS, current_height)
-                )
-                self.latest_height = current_height
+                current_height = self.coin.update_block_number(await self.coin.get_block_number())
+                # process at max MAX_SYNC_BLOCKS blocks since last processed block
+                end_height = min(self.latest_height + self.MAX_SYNC_BLOCKS, current_height)
+                if await self.process_blocks(self.latest_height + 1, end_height) == end_height:
+                    self.latest_height = current_height
                 self.synchronized = True  # set it once, as we just need to ensure initial sync was done
             except Exception:
                 logger.error("Error processing pending blocks:")
                 logger.error(traceback.format_exc())
-            await asyncio.sleep(self.BLOCK_TIME)
+            await asyncio.sleep(self.get_retry_delay(self.latest_height + 1))
 
     async def trigger_event(self, data, wallet):
         await self.notify_websockets(data, wallet)
         if self.POLLING_CAP == 0:
             return
-        if wallet:
-            self.wallets_updates[wallet].append(data)
-        else:
-            for key in self.wallets.copy():
-                self.wallets_updates[key].append(data)
+        self.updates_log.add(data, wallet or None)
+
+    def mark_dirty(self, wallet):
+        self.dirty_wallets[id(wallet)] = wallet
+
+    def flush_wallet(self, wallet):
+        self.dirty_wallets.pop(id(wallet), None)
+        wallet.save_db(force=True)
+
+    async def flush_dirty_wallets(self):
+        dirty_wallets, self.dirty_wallets = self.dirty_wallets, {}
+        for wallet in dirty_wallets.values():
+            try:
+                wallet.save_db(force=True)
+            except Exception:
+                logger.error(f"Error saving wallet {wallet.storage.path}:")
+                logger.error(traceback.format_exc())
 
     async def on_shutdown(self, app):
         self.running = False
+        self.expiry_scheduler.stop()
         block_number = await self.coin.get_block_number()
         for wallet in list(self.wallets.values()):
             wallet.stop(block_number)
+        await self.flush_dirty_wallets()
+        if self.wallet_store:
+            self.wallet_store.close()
+        self.derived_keys.wipe()
         await self.shutdown_coin(final=True)
         await super().on_shutdown(app)
 
@@ -793,10 +1264,49 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
         os.makedirs(path, exist_ok=True)
         return path
 
+    def create_storage(self, path, in_memory_only=False):
+        if in_memory_only:
+            return Storage(path, in_memory_only=True)
+        if self.STORAGE_MODE == "sqlite":
+            return SQLiteStorage(path, self.wallet_store)
+        if self.STORAGE_MODE == "journal":
+            return JournaledStorage(path)
+        return Storage(path)
+
+    def wallet_exists(self, path):
+        if self.STORAGE_MODE == "sqlite":
+            return self.wallet_store.exists(self.wallet_store.get_key(path))
+        return os.path.exists(path)
+
+    def load_wallet_db(self, storage):
+        return WalletDB(storage.read(), journal=storage.read_journal())
+
     @abstractmethod
     async def load_wallet(self, xpub, contract, diskless=False, extra_params=None):
         pass
 
+    async def open_wallet(self, xpub, contract, diskless=False, extra_params=None):
+        """Load a wallet and record how it was loaded, so that it can be evicted and reloaded later"""
+        if extra_params is None:
+            extra_params = {}
+        wallet_key = self.coin.get_wallet_key(xpub, contract, **extra_params)
+        was_loaded = wallet_key in self.wallets
+        wallet = await self.load_wallet(xpub, contract, diskless=diskless, extra_params=extra_params)
+        if xpub and wallet_key in self.wallets:
+            self.touch_wallet(wallet_key, xpub, contract, extra_params, was_loaded)
+        return wallet
+
+    @property
+    def synchronized(self):
+        return self.sync_event.is_set()
+
+    @synchronized.setter
+    def synchronized(self, value):
+        if value:
+            self.sync_event.set()
+        else:
+            self.sync_event.clear()
+
     async def is_still_syncing(self, wallet=None):
         if self.NO_SYNC_WAIT:
             return False
@@ -808,14 +1318,13 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
         wallet = error = None
         try:
             should_skip = req_method not in self.supported_methods or not self.supported_methods[req_method].requires_network
-            if not self.NO_SYNC_WAIT:
-                while not should_skip and not self.synchronized:  # wait for initial sync to fetch blocks
-                    await asyncio.sleep(0.1)
-            wallet = await self.load_wallet(xpub, contract, diskless=diskless, extra_params=extra_params)
+            if not self.NO_SYNC_WAIT and not should_skip:  # wait for initial sync to fetch blocks
+                await self.wait_for_sync(lambda: self.synchronized, self.sync_event)
+            wallet = await self.open_wallet(xpub, contract, diskless=diskless, extra_params=extra_params)
             if should_skip:
                 return wallet, error
-            while await self.is_still_syncing(wallet):
-                await asyncio.sleep(0.1)
+            if await self.is_still_syncing(wallet):
+                await self.wait_for_sync(wallet.is_synchronized, wallet.sync_event)
         except Exception as e:
             logger.error(traceback.format_exc())
             if req_method not in self.supported_methods or self.supported_methods[req_method].requires_wallet:
@@ -871,6 +1380,7 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
         finally:
             if xpub:
                 self.wallet_locks[wallet_key].release()
+                await self.evict_idle_wallets()
 
     #########
     # Methods
@@ -888,13 +1398,13 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
         expiration = int(expiration) if expiration else None
         req = await self.wallets[wallet].make_payment_request(addr, amount, memo, expiration)
         self.wallets[wallet].add_payment_request(req)
-        self.loop.create_task(self.wallets[wallet].expired_task(req))
+        self.expiry_scheduler.schedule(self.wallets[wallet], req)
         return await self.wallets[wallet].export_request(req)
 
     async def _parse_and_load(self, semaphore, xpub):
         async with semaphore:
             xpub, contract, extra_params = self.parse_xpub(xpub)
-            await self.load_wallet(xpub, contract, diskless=extra_params.get("diskless", False), extra_params=extra_params)
+            await self.open_wallet(xpub, contract, diskless=extra_params.get("diskless", False), extra_params=extra_params)
 
     @rpc
     async def batch_load(self, wallets, background=False, wallet=None):
@@ -916,20 +1426,79 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
         self.wallets[wallet].clear_requests()
         return True
 
+    def touch_wallet(self, key, xpub, contract, extra_params, was_loaded):
+        self.wallet_cache_stats["hits" if was_loaded else "misses"] += 1
+        self.wallets.move_to_end(key)
+        if not extra_params.get("diskless", False) and not extra_params.get("one_time", False):
+            self.wallet_params[key] = (xpub, contract, extra_params.copy())
+            address = self.wallets[key].address
+            if key in self.evicted_addresses.get(address, {}):
+                self.forget_evicted_wallet(address, key)
+
+    def forget_evicted_wallet(self, address, key):
+        self.evicted_addresses[address].pop(key, None)
+        if not self.evicted_addresses[address]:
+            self.evicted_addresses.pop(address, None)
+
+    def is_wallet_idle(self, key):
+        wallet = self.wallets[key]
+        # request_addresses only holds requests which are still waiting for payments
+        return (
+            key in self.wallet_params
+            and wallet.synchronized
+            and not wallet.request_addresses
+            and not self.wallet_locks[key].locked()
+        )
+
+    async def evict_idle_wallets(self):
+        if not self.MAX_LOADED_WALLETS:
+            return
+        # busy wallets are rotated to the end, so that each call only looks at a few least recently used ones
+        for key in list(itertools.islice(self.wallets, EVICTION_SCAN_LIMIT)):
+            if len(self.wallets) <= self.MAX_LOADED_WALLETS:
+                break
+            if not self.is_wallet_idle(key):
+                self.wallets.move_to_end(key)
+                continue
+            address = self.wallets[key].address
+            params = self.wallet_params[key]
+            if await self.close_wallet_impl(key):
+                # keep enough to reload the wallet once something is sent to it
+                self.evicted_addresses[address][key] = params
+                self.wallet_cache_stats["evictions"] += 1
+
+    async def reload_evicted_wallets(self, address):
+        # popped first, as loaded wallets replay latest blocks through process_transaction
+        for key, (xpub, contract, extra_params) in self.evicted_addresses.pop(address, {}).items():
+            if self.wallet_locks[key].locked():
+                # already being loaded (possibly up our own stack, replaying this transaction), which forgets the
+                # evicted entry once done, keep it in case that load fails
+                self.evicted_addresses[address][key] = (xpub, contract, extra_params)
+                continue
+            async with self.wallet_locks[key]:
+                try:
+                    await self.open_wallet(xpub, contract, extra_params=extra_params.copy())
+                except Exception:
+                    logger.error(f"Error reloading wallet {key}:")
+                    logger.error(traceback.format_exc())
+
     async def close_wallet_impl(self, key, locked=False):
         try:
             if not locked:
                 await self.wallet_locks[key].acquire()
             if key not in self.wallets:
                 return False
-            block_number = await self.coin.get_block_number()
+            block_number = await self.coin.get_cached_block_number()
             self.wallets[key].stop(block_number)
-            self.wallets_updates.pop(key, None)
+            self.flush_wallet(self.wallets[key])
+            self.expiry_scheduler.cancel_wallet(self.wallets[key])
+            self.updates_log.remove_wallet(key)
             address = self.wallets[key].address
             self.addresses[address].discard(key)
             if not self.addresses[address]:
                 self.addresses.pop(address, None)
             self.wallets.pop(key, None)
+            self.wallet_params.pop(key, None)
             return True
         finally:
             if not locked:
@@ -941,19 +1510,23 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
         key = wallet or key
         return await self.close_wallet_impl(key, locked=locked)
 
+    @rpc
+    async def wipe_derived_keys(self, wallet=None):
+        return self.derived_keys.wipe()
+
     @rpc
     async def create(self, wallet=None, wallet_path=None):
         seed = self.make_seed()
         if not wallet_path:
             wallet_path = os.path.join(self.get_wallet_path(), seed)
-        storage = Storage(wallet_path)
+        storage = self.create_storage(wallet_path)
         if storage.file_exists():
             raise Exception("Remove the existing wallet first!")
         db = WalletDB("")
         keystore = daemon_ctx.get().KEYSTORE_CLASS(seed)
         db.put("keystore", keystore.dump())
         wallet_obj = self.WALLET_CLASS(self.coin, db, storage)
-        wallet_obj.save_db()
+        wallet_obj.save_db(force=True)
         return {
             "seed": seed,
             "path": wallet_obj.storage.path,
@@ -983,17 +1556,35 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
     def get_tx_size(self, tx_data, wallet=None):
         pass
 
+    async def get_final_tx_data(self, method, tx, fetch, get_confirmations=None):
+        """Return transaction data with its confirmations, serving the data from the response cache once it is final
+
+        Data is cached after RESPONSE_CACHE_CONFIRMATIONS confirmations, while confirmations are computed on every call
+        """
+        get_confirmations = get_confirmations or functools.partial(self.coin.get_confirmations, tx)
+        key = (method, tx)
+        data = self.response_cache.get(key)
+        cached = data is not ResponseCache.MISSING
+        if not cached:
+            data = await fetch()
+        confirmations = await get_confirmations(data)
+        if not cached and confirmations >= self.RESPONSE_CACHE_CONFIRMATIONS:
+            self.response_cache.set(key, data)
+        # callers add fields to the returned dict, the cached one must stay intact
+        return (dict(data) if isinstance(data, dict) else data), confirmations
+
     @rpc(requires_network=True)
     async def get_tx_status(self, tx, wallet=None):
-        data = self.coin.to_dict(await self.coin.get_tx_receipt(tx))
-        data["confirmations"] = await self.coin.get_confirmations(tx, data)
+        async def fetch():
+            return self.coin.to_dict(await self.coin.get_tx_receipt(tx))
+
+        data, confirmations = await self.get_final_tx_data("get_tx_status", tx, fetch)
+        data["confirmations"] = confirmations
         return data
 
     @rpc(requires_wallet=True, requires_network=True)
     def get_updates(self, wallet):
-        updates = self.wallets_updates[wallet]
-        self.wallets_updates[wallet] = deque(maxlen=self.POLLING_CAP)
-        return list(updates)
+        return self.updates_log.pop_updates(wallet)
 
     @rpc(requires_network=True)
     @abstractmethod
@@ -1033,17 +1624,25 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
         is_connected = await self.coin.is_connected()
         if not is_connected:
             return {"connected": False, "path": path, "version": self.VERSION}
-        numblocks = await self.coin.get_block_number()
+        numblocks = self.coin.update_block_number(await self.coin.get_block_number())
         return {
             "blockchain_height": self.latest_height,
             "connected": is_connected,
             "gas_price": await self.getfeerate(),
             "path": path,
             "server": self.coin.current_server(),
+            "providers": self.coin.provider_stats(),
             "server_height": numblocks,
             "spv_nodes": 0,
             "synchronized": self.synchronized,
+            "sync_waiters": self.sync_waiters,
+            "sync_lag": self.get_sync_lag(),
+            "blocks_per_second": round(self.blocks_per_second, 2),
             "total_wallets": len(self.wallets),
+            "evicted_wallets": sum(len(keys) for keys in self.evicted_addresses.values()),
+            "wallet_cache": self.wallet_cache_stats,
+            "response_cache": self.response_cache.stats(),
+            "derived_keys_cache": self.derived_keys.stats(),
             "version": self.VERSION,
         }
 
@@ -1186,7 +1785,7 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
             end_block = start_block
         start_block = int(start_block)
         end_block = int(end_block)
-        await self.process_block_by_chunks(start_block, end_block)
+        await self.process_blocks(start_block, end_block, checkpoint=False)
         return True
 
     def restore_wallet_from_text(self, text, contract=None, path=None, address=None, **kwargs):
@@ -1196,13 +1795,13 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
             keystore = daemon_ctx.get().KEYSTORE_CLASS(text, contract=contract, address=address)
         except Exception as e:
             raise Exception("Invalid key provided") from e
-        storage = Storage(path if path is not NOOP_PATH else None, in_memory_only=path is NOOP_PATH)
+        storage = self.create_storage(path if path is not NOOP_PATH else None, in_memory_only=path is NOOP_PATH)
         if path is not NOOP_PATH and storage.file_exists():
             raise Exception("Remove the existing wallet first!")
         db = WalletDB("")
         db.put("keystore", keystore.dump())
         wallet_obj = self.WALLET_CLASS(self.coin, db, storage)
-        wallet_obj.save_db()
+        wallet_obj.save_db(force=True)
         return wallet_obj
 
     @rpc
@@ -7,8 +7,13 @@ class JSONRPCError(Exception):
 
 
 class RPCProvider:
-    def __init__(self, url):
+    DEFAULT_TIMEOUT = ClientTimeout(total=5 * 60)
+
+    def __init__(self, url, connector_settings=None, pool_metrics=None):
         self.url = url
+        self.connector_settings = connector_settings
+        self.pool_metrics = pool_metrics
+        self.timeout = connector_settings.timeout if connector_settings else self.DEFAULT_TIMEOUT
         self._sessions = {}
 
     @property
@@ -17,11 +22,15 @@ class RPCProvider:
         session = self._sessions.get(loop)
         if session is not None:
             return session
-        self._sessions[loop] = ClientSession()
+        if self.connector_settings:
+            self._sessions[loop] = self.connector_settings.create_session(self.pool_metrics)
+        else:
+            self._sessions[loop] = ClientSession()
         return self._sessions[loop]
 
     async def _close(self) -> None:
-        for session in self._sessions.values():
+        sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
             if session is not None:
                 await session.close()
 
@@ -33,12 +42,12 @@ class RPCProvider:
             loop.run_until_complete(self._close())
 
     async def raw_request(self, method, **kwargs):
-        async with self.session.post(f"{self.url}/{method}", json=kwargs, timeout=ClientTimeout(total=5 * 60)) as response:
+        async with self.session.post(f"{self.url}/{method}", json=kwargs, timeout=self.timeout) as response:
             return await response.json()
 
     async def jsonrpc_request(self, method, **kwargs):
         async with self.session.post(
-            f"{self.url}/json_rpc", json={"method": method, "params": kwargs}, timeout=ClientTimeout(total=5 * 60)
+            f"{self.url}/json_rpc", json={"method": method, "params": kwargs}, timeout=self.timeout
         ) as response:
             data = await response.json()
             if "error" in data:
@@ -1,11 +1,17 @@
 # Thanks to https://github.com/spesmilo/electrum storage implementation
+import contextlib
 import copy
 import json
 import os
+import sqlite3
 import stat
 import threading
 from decimal import Decimal
-from functools import singledispatch
+from functools import lru_cache, singledispatch
+
+import orjson
+
+JOURNAL_GENERATION_KEY = "journal_generation"
 
 
 class DBFileException(Exception):
@@ -31,6 +37,43 @@ class JSONEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
+@lru_cache
+def get_encoder(cls=JSONEncoder, precision=18):
+    return cls(precision=precision)
+
+
+# dataclasses and datetimes go through the encoder hook, like with the stdlib encoder
+ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+def json_dumps(obj, encoder=None, prepare=None):
+    """Serialize obj to a json string with orjson
+
+    Decimal and other custom types are handled by the encoder's ``default`` hook. Values orjson can't represent (integers
+    above 64 bits, custom keys) fall back to the stdlib encoder, so the result always decodes to the same data as
+    ``encoder.encode(obj)``. When ``prepare`` is set, it is applied to obj before falling back, and the fast path only
+    accepts string keys, leaving key conversion to it.
+    """
+    encoder = encoder or get_encoder()
+    options = ORJSON_OPTIONS if prepare else ORJSON_OPTIONS | orjson.OPT_NON_STR_KEYS
+    try:
+        return orjson.dumps(obj, default=encoder.default, option=options).decode()
+    except TypeError:
+        pass
+    return encoder.encode(prepare(obj) if prepare else obj)
+
+
+def to_jsonable(obj, encoder=None):
+    """Convert obj to plain json types, same as ``json.loads(encoder.encode(obj))``"""
+    encoder = encoder or get_encoder()
+    try:
+        # everything orjson could encode fits into 64 bits, so decoding it back with orjson is lossless
+        return orjson.loads(orjson.dumps(obj, default=encoder.default, option=ORJSON_OPTIONS | orjson.OPT_NON_STR_KEYS))
+    except TypeError:
+        pass
+    return json.loads(encoder.encode(obj))
+
+
 class Storage:
     def __init__(self, path, in_memory_only=False):
         self.path = standardize_path(path)
@@ -68,6 +111,274 @@ class Storage:
     def file_exists(self) -> bool:
         return self._file_exists
 
+    def is_in_memory_only(self) -> bool:
+        return self._in_memory_only
+
+    def read_journal(self) -> list:
+        return []
+
+    def can_append(self) -> bool:
+        return False
+
+
+class JournaledStorage(Storage):
+    """Storage keeping a full snapshot plus an append-only journal of changes
+
+    Every flush appends one line (a json list of patches) to ``<path>.journal``, so write cost depends on the size of the
+    change and not on the size of the wallet. When the journal grows too large compared to the snapshot, it is folded back
+    by writing a new snapshot and truncating the journal. Each snapshot carries a generation number, and the journal starts
+    with the generation of the snapshot it applies to, so a journal left over after a crash between snapshot replace and
+    journal truncation is detected as stale and dropped instead of being replayed over newer data.
+    """
+
+    JOURNAL_COMPACT_MIN_SIZE = 256 * 1024
+    JOURNAL_COMPACT_RATIO = 1.0
+
+    def __init__(self, path, in_memory_only=False):
+        super().__init__(path, in_memory_only=in_memory_only)
+        self.journal_path = f"{self.path}.journal" if self.path else None
+        self._snapshot_size = len(self.raw)
+        self.generation = 0
+        self.data = self.raw
+        if self.raw:
+            # broken snapshots are reported when loading the db from the raw string
+            with contextlib.suppress(ValueError):
+                data = json.loads(self.raw)
+                if isinstance(data, dict):
+                    self.generation = data.pop(JOURNAL_GENERATION_KEY, 0)
+                    self.data = data
+        self._journal = []
+        self._journal_size = 0
+        if not self._in_memory_only and self.journal_path and os.path.exists(self.journal_path):
+            self._load_journal()
+
+    def _load_journal(self):
+        with open(self.journal_path, "rb") as f:
+            raw = f.read()
+        valid_size = 0
+        generation = 0  # journals written before generations were introduced belong to un-numbered snapshots
+        for line in raw.splitlines(keepends=True):
+            # a line without newline or a broken one means we crashed during append: drop it and everything after
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except Exception:
+                break
+            if isinstance(record, dict):
+                generation = record.get("generation", 0)
+            else:
+                self._journal.append(record)
+            valid_size += len(line)
+        if generation != self.generation:
+            # the snapshot was replaced but the journal wasn't truncated: its changes are already in the snapshot
+            self._journal = []
+            valid_size = 0
+        if valid_size != len(raw):
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(valid_size)
+                f.flush()
+                os.fsync(f.fileno())
+        self._journal_size = valid_size
+
+    def read(self):
+        return self.data
+
+    def read_journal(self) -> list:
+        journal, self._journal = self._journal, []
+        return journal
+
+    def can_append(self) -> bool:
+        return not self._in_memory_only and self.file_exists()
+
+    def should_compact(self) -> bool:
+        return self._journal_size > max(self.JOURNAL_COMPACT_MIN_SIZE, self._snapshot_size * self.JOURNAL_COMPACT_RATIO)
+
+    def append(self, data: str) -> None:
+        if self._in_memory_only:
+            return
+        line = f"{data}\n"
+        if not self._journal_size:
+            line = f'{{"generation": {self.generation}}}\n{line}'
+        line = line.encode()
+        with open(self.journal_path, "ab") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_size += len(line)
+
+    def write(self, data: str) -> None:
+        if self._in_memory_only:
+            return
+        self.generation += 1
+        data = self._with_generation(data)
+        super().write(data)
+        self._snapshot_size = len(data)
+        if self._journal_size:
+            with open(self.journal_path, "wb") as f:
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_size = 0
+
+    def _with_generation(self, data):
+        # data is an encoded json object: prepend the generation key instead of encoding the whole snapshot again
+        body = data[1:].lstrip()
+        separator = "" if body.startswith("}") else ", "
+        return f'{{"{JOURNAL_GENERATION_KEY}": {self.generation}{separator}{body}'
+
+
+class SQLiteWalletStore:
+    """Single-file store for all wallets of a daemon
+
+    Top-level wallet fields (keystore, version, ...) are kept in one row per wallet, while large dicts like payment requests
+    are split into one row per entry, so that loading is done per wallet and changes update individual rows in place.
+    Wallets are keyed by their path relative to the database directory, so that the data directory can be moved.
+    """
+
+    ROW_DICTS = ("payment_requests", "request_addresses")
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS wallets (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS wallet_items (
+            wallet TEXT NOT NULL,
+            dict TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (wallet, dict, key)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.path = standardize_path(path)
+        self.root = os.path.dirname(self.path)
+        # transactions are managed explicitly by transaction()
+        self.conn = sqlite3.connect(self.path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.executescript(self.SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def get_key(self, path):
+        return os.path.relpath(standardize_path(path), self.root)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.conn.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def exists(self, key):
+        return self.conn.execute("SELECT 1 FROM wallets WHERE key = ?", (key,)).fetchone() is not None
+
+    def read(self, key):
+        row = self.conn.execute("SELECT data FROM wallets WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        data = json.loads(row[0])
+        for dict_name, item_key, value in self.conn.execute(
+            "SELECT dict, key, value FROM wallet_items WHERE wallet = ?", (key,)
+        ):
+            data.setdefault(dict_name, {})[item_key] = json.loads(value)
+        return data
+
+    def _write_items(self, key, dict_name, items):
+        self.conn.execute("DELETE FROM wallet_items WHERE wallet = ? AND dict = ?", (key, dict_name))
+        self.conn.executemany(
+            "INSERT INTO wallet_items (wallet, dict, key, value) VALUES (?, ?, ?, ?)",
+            ((key, dict_name, k, json_dumps(v)) for k, v in items.items()),
+        )
+
+    def write(self, key, data):
+        # row dicts are kept as empty placeholders to preserve their presence in the wallet
+        wallet_data = {k: {} if k in self.ROW_DICTS else v for k, v in data.items()}
+        with self.transaction():
+            self.conn.execute("INSERT OR REPLACE INTO wallets (key, data) VALUES (?, ?)", (key, json_dumps(wallet_data)))
+            for dict_name in self.ROW_DICTS:
+                self._write_items(key, dict_name, data.get(dict_name, {}))
+
+    def _update_json(self, query, update_query, params, patch):
+        row = self.conn.execute(query, params).fetchone()
+        if row is None:
+            return
+        value = json.loads(row[0])
+        apply_patch(value, patch)
+        self.conn.execute(update_query, (json_dumps(value), *params))
+
+    def _apply_item_patch(self, key, dict_name, patch):
+        item_key, *path = patch["path"][1:]
+        if path:
+            self._update_json(
+                "SELECT value FROM wallet_items WHERE wallet = ? AND dict = ? AND key = ?",
+                "UPDATE wallet_items SET value = ? WHERE wallet = ? AND dict = ? AND key = ?",
+                (key, dict_name, item_key),
+                {**patch, "path": path},
+            )
+        elif patch["op"] == "remove":
+            self.conn.execute("DELETE FROM wallet_items WHERE wallet = ? AND dict = ? AND key = ?", (key, dict_name, item_key))
+        else:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO wallet_items (wallet, dict, key, value) VALUES (?, ?, ?, ?)",
+                (key, dict_name, item_key, json_dumps(patch["value"])),
+            )
+
+    def apply_patches(self, key, patches):
+        with self.transaction():
+            for patch in patches:
+                dict_name = patch["path"][0]
+                if dict_name not in self.ROW_DICTS:
+                    self._update_json(
+                        "SELECT data FROM wallets WHERE key = ?", "UPDATE wallets SET data = ? WHERE key = ?", (key,), patch
+                    )
+                elif len(patch["path"]) > 1:
+                    self._apply_item_patch(key, dict_name, patch)
+                else:
+                    self._write_items(key, dict_name, patch.get("value") or {})
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path, store):
+        self.path = standardize_path(path)
+        self.store = store
+        self.key = store.get_key(self.path)
+        self._in_memory_only = False
+        self._file_exists = store.exists(self.key)
+
+    def read(self):
+        if not self.file_exists():
+            return ""
+        return self.store.read(self.key)
+
+    def write(self, data: str) -> None:
+        self.store.write(self.key, json.loads(data))
+        self._file_exists = True
+
+    def can_append(self) -> bool:
+        return self.file_exists()
+
+    def should_compact(self) -> bool:
+        return False
+
+    def append(self, data: str) -> None:
+        self.store.apply_patches(self.key, json.loads(data))
+
+
+def apply_patch(data, patch):
+    *parents, key = patch["path"]
+    for parent in parents:
+        data = data.get(parent) if isinstance(data, dict) else None
+    if not isinstance(data, dict):
+        return
+    if patch["op"] == "remove":
+        data.pop(key, None)
+    else:
+        data[key] = patch["value"]
+
 
 def modifier(func):
     def wrapper(self, *args, **kwargs):
@@ -111,15 +422,30 @@ def _(lst):
     return [string_keys(v) for v in lst]
 
 
+SCALAR_TYPES = (str, int, float, bool, Decimal)
+
+
 class JsonDB:
     def __init__(self, data):
         self.lock = threading.RLock()
         self.data = data
         self._modified = False
+        self._pending_changes = []
+        self._full_write_required = False
 
     def set_modified(self, b):
+        # changes not described by patches can only be persisted by a full write
         with self.lock:
             self._modified = b
+            self._full_write_required = b
+            if not b:
+                self._pending_changes = []
+
+    @locked
+    def add_patch(self, patch):
+        self._modified = True
+        if not self._full_write_required:
+            self._pending_changes.append(patch)
 
     def modified(self):
         return self._modified
@@ -134,13 +460,12 @@ class JsonDB:
     @modifier
     def put(self, key, value):
         try:
-            json.dumps(key, cls=JSONEncoder)
-            json.dumps(value, cls=JSONEncoder)
+            json_dumps([key, value])
         except Exception:
             return False
         if value is not None:
             if self.data.get(key) != value:
-                self.data[key] = copy.deepcopy(value)
+                self.data[key] = value if isinstance(value, SCALAR_TYPES) else copy.deepcopy(value)
                 return True
         elif key in self.data:
             self.data.pop(key)
@@ -149,7 +474,12 @@ class JsonDB:
 
     @locked
     def dump(self) -> str:
-        return json.dumps(string_keys(self.data), cls=JSONEncoder)
+        return json_dumps(self.data, prepare=string_keys)
+
+    @locked
+    def dump_pending_changes(self) -> str:
+        patches = [{**patch, "path": [obj_to_string(k) for k in patch["path"]]} for patch in self._pending_changes]
+        return json_dumps(patches, prepare=string_keys)
 
     def _should_convert_to_stored_dict(self, key) -> bool:
         return True
@@ -157,14 +487,19 @@ class JsonDB:
 
 class StoredObject:
     db = None
+    _path = None
 
     def __setattr__(self, key, value):
-        if self.db:
-            self.db.set_modified(True)
+        if self.db and key != "db" and not key.startswith("_"):
+            if self._path is None:
+                self.db.set_modified(True)
+            else:
+                self.db.add_patch({"op": "replace", "path": self._path + [key], "value": value})
         super().__setattr__(key, value)
 
-    def set_db(self, db):
+    def set_db(self, db, path=None):
         self.db = db
+        self._path = path
 
     def to_json(self):
         d = dict(vars(self))
@@ -179,7 +514,6 @@ class StoredDBProperty:
 
     def __set__(self, obj, value):
         obj.db.put(self.name, value)
-        obj.db.set_modified(True)
         obj.save_db()
 
     def __get__(self, obj, objtype=None):
@@ -212,10 +546,14 @@ class StoredDict(dict):
         self.path = path
         # recursively convert dicts to StoredDict
         for k, v in list(data.items()):
-            self.__setitem__(k, v)
+            self.__setitem__(k, v, patch=False)
+
+    def _add_patch(self, patch):
+        if self.db:
+            self.db.add_patch(patch)
 
     @locked
-    def __setitem__(self, key, v):
+    def __setitem__(self, key, v, patch=True):
         is_new = key not in self
         # early return to prevent unnecessary disk writes
         if not is_new and self[key] == v:
@@ -235,52 +573,60 @@ class StoredDict(dict):
                 v = StoredDict(v, self.db, self.path + [key])
         # set parent of StoredObject
         if isinstance(v, StoredObject):
-            v.set_db(self.db)
+            v.set_db(self.db, self.path + [key])
         # set item
         super().__setitem__(key, v)
-        if self.db:
-            self.db.set_modified(True)
+        if patch:
+            self._add_patch({"op": "replace", "path": self.path + [key], "value": v})
 
     @locked
     def __delitem__(self, key):
         super().__delitem__(key)
-        if self.db:
-            self.db.set_modified(True)
+        self._add_patch({"op": "remove", "path": self.path + [key]})
 
     @locked
     def pop(self, key, v=_RaiseKeyError):
+        exists = key in self
         r = super().pop(key) if v is _RaiseKeyError else super().pop(key, v)
-        if self.db:
-            self.db.set_modified(True)
+        if exists:
+            self._add_patch({"op": "remove", "path": self.path + [key]})
         return r
 
     @locked
     def clear(self):
         super().clear()
-        if self.db:
-            self.db.set_modified(True)
+        if not self.path:
+            if self.db:
+                self.db.set_modified(True)
+            return
+        self._add_patch({"op": "replace", "path": self.path, "value": {}})
 
 
 class WalletDB(JsonDB):
     STORAGE_VERSION: int
     NAME: str = "wallet"
 
-    def __init__(self, raw):
+    def __init__(self, raw, journal=None):
         super().__init__({})
         self.upgraded = False
         if raw:
-            self.load_data(raw)
+            self.load_data(raw, journal=journal)
         else:
             self.put("version", self.STORAGE_VERSION)
         self._after_upgrade_tasks()
 
-    def load_data(self, s):
+    def load_data(self, s, journal=None):
         try:
-            self.data = json.loads(s)
+            self.data = json.loads(s) if isinstance(s, str) else s
         except Exception as e:
             raise DBFileException(f"Cannot read {self.NAME} file. (parsing failed)") from e
         if not isinstance(self.data, dict):
             raise DBFileException(f"Malformed {self.NAME} file (not dict)")
+        # only meaningful to the journaled storage, present when switching from it to another storage mode
+        self.data.pop(JOURNAL_GENERATION_KEY, None)
+        for patches in journal or []:
+            for patch in patches:
+                apply_patch(self.data, patch)
         if self.requires_upgrade():
             self.upgrade()
 
@@ -295,6 +641,7 @@ class WalletDB(JsonDB):
         self.run_upgrades()
         self.put("version", self.STORAGE_VERSION)
         self._after_upgrade_tasks()
+        self.set_modified(True)
 
     def _after_upgrade_tasks(self):
         self.upgraded = True
@@ -351,7 +698,14 @@ class WalletDB(JsonDB):
     def _write(self, storage):
         if not self.modified():
             return
-        storage.write(self.dump())
+        if storage.can_append() and not self._full_write_required:
+            if self._pending_changes:
+                if storage.should_compact():
+                    storage.write(self.dump())
+                else:
+                    storage.append(self.dump_pending_changes())
+        else:
+            storage.write(self.dump())
         self.set_modified(False)
 
     def is_ready_to_be_used(self):
@@ -68,6 +68,29 @@ class TronRPCProvider(AbstractRPCProvider, AsyncHTTPProvider):
     async def send_ping_request(self):
         return await self.send_single_request("wallet/getnowblock")
 
+    def is_read_request(self, method, *args, **kwargs):
+        return not method.startswith("wallet/broadcast")
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_http_client(settings):
+    # httpx has no DNS cache and exposes no pool events, so only limits and timeouts are applied here
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=settings.pool_size,
+            max_keepalive_connections=settings.pool_size_per_host,
+            keepalive_expiry=settings.keepalive_timeout,
+        ),
+        timeout=httpx.Timeout(
+            connect=settings.connect_timeout,
+            read=settings.read_timeout,
+            write=settings.read_timeout,
+            pool=settings.pool_timeout,
+        ),
+    )
+
 
 class MultipleRPCTronProvider(AsyncHTTPProvider):
     def __init__(self, rpc: MultipleProviderRPC, *args, **kwargs):
@@ -196,13 +219,16 @@ class TRXFeatures(BlockchainFeatures):
 
     async def get_confirmations(self, tx_hash, data=None) -> int:
         data = data or await self.get_tx_receipt(tx_hash)
-        height = await self.get_block_number()
+        height = await self.get_cached_block_number()
         block_number = data.get("blockNumber", height + 1) or height + 1
         return max(0, height - block_number + 1)
 
     def current_server(self):
         return self.web3.provider.rpc.current_rpc.endpoint_uri
 
+    def provider_stats(self):
+        return self.web3.provider.rpc.get_stats()
+
 
 @dataclass
 class KeyStore(ETHKeyStore):
@@ -256,6 +282,8 @@ class TRXDaemon(ETHDaemon):
     AMOUNTGEN_DIVISIBILITY = 6
     EIP1559_SUPPORTED = False
     DEFAULT_MAX_SYNC_BLOCKS = 300  # (60/3)=20*60 (a block every 3 seconds, keep up to 15 minutes of data)
+    DEFAULT_FETCH_BATCH_SIZE = 1  # tron http api has no batch requests
+    INGESTION_MODES = ("blocks",)
 
     ARCHIVE_SUPPORTED = False
 
@@ -279,12 +307,12 @@ class TRXDaemon(ETHDaemon):
                 server_list[idx] += "/"
         server_providers = []
         for server in server_list:
-            server_provider = TronRPCProvider(server)
+            server_provider = TronRPCProvider(server, client=create_http_client(self.connector_settings))
             server_provider.make_request = exception_retry_middleware(
                 server_provider.make_request, (httpx.HTTPError, AsyncClientError, TimeoutError, asyncio.TimeoutError)
             )
             server_providers.append(server_provider)
-        multi_provider = MultipleProviderRPC(server_providers)
+        multi_provider = MultipleProviderRPC(server_providers, hedge_requests=self.HEDGE_REQUESTS)
         await multi_provider.start()
         provider = MultipleRPCTronProvider(multi_provider)
         self.coin = TRXFeatures(AsyncTron(provider, conf={"fee_limit": DEFAULT_FEE_LIMIT}))
@@ -313,8 +341,15 @@ class TRXDaemon(ETHDaemon):
 
     @rpc(requires_network=True)
     async def gettransaction(self, tx, wallet=None):
-        data = self.coin.to_dict(await self.coin.get_transaction(tx))
-        data["confirmations"] = await self.coin.get_confirmations(tx)
+        async def fetch():
+            return self.coin.to_dict(await self.coin.get_transaction(tx))
+
+        async def get_confirmations(data):
+            # transaction data has no block number, the (cached once final) receipt has
+            return (await self.get_tx_status(tx))["confirmations"]
+
+        data, confirmations = await self.get_final_tx_data("gettransaction", tx, fetch, get_confirmations)
+        data["confirmations"] = confirmations
         return data
 
     @rpc(requires_wallet=True)
@@ -8,14 +8,16 @@ import time
 import traceback
 from abc import ABCMeta, abstractmethod
 from base64 import b64decode
-from contextlib import contextmanager
+from collections import deque
+from contextlib import contextmanager, suppress
 from dataclasses import dataclass
 from decimal import Decimal
 from typing import Any
 from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
 
-from aiohttp import web
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig, web
 from logger import get_logger
+from storage import json_dumps
 
 logger = get_logger(__name__)
 
@@ -131,10 +133,12 @@ class JsonResponse:
         return self.send_ok_response()
 
     def send_error_response(self):
-        return web.json_response({"jsonrpc": "2.0", "error": {"code": self.code, "message": self.error}, "id": self.id})
+        return web.json_response(
+            {"jsonrpc": "2.0", "error": {"code": self.code, "message": self.error}, "id": self.id}, dumps=json_dumps
+        )
 
     def send_ok_response(self):
-        return web.json_response({"jsonrpc": "2.0", "result": self.result, "id": self.id})
+        return web.json_response({"jsonrpc": "2.0", "result": self.result, "id": self.id}, dumps=json_dumps)
 
 
 async def periodic_task(self, process_func, interval):
@@ -148,6 +152,58 @@ async def periodic_task(self, process_func, interval):
         await asyncio.sleep(max(interval - elapsed, 0))
 
 
+class UpdatesLog:
+    """Bounded event log backing get_updates polling
+
+    Events sent to all wallets are stored once and each wallet reads them through its own cursor, events scoped to a
+    single wallet are kept per wallet until read, so memory is O(events + wallets) instead of O(events * wallets)
+    """
+
+    def __init__(self, cap):
+        self.cap = cap
+        self.seq = 0
+        self.shared_events = deque(maxlen=cap)
+        self.wallet_events = {}
+        self.cursors = {}
+
+    def __contains__(self, wallet):
+        return wallet in self.cursors
+
+    def add_wallet(self, wallet):
+        # wallets only see events published after they were loaded
+        self.cursors[wallet] = self.seq
+        self.wallet_events.pop(wallet, None)
+
+    def remove_wallet(self, wallet):
+        self.cursors.pop(wallet, None)
+        self.wallet_events.pop(wallet, None)
+
+    def add(self, data, wallet=None):
+        if wallet is not None and wallet not in self.cursors:
+            return
+        self.seq += 1
+        if wallet is None:
+            self.shared_events.append((self.seq, data))
+        else:
+            self.wallet_events.setdefault(wallet, deque(maxlen=self.cap)).append((self.seq, data))
+
+    def pop_updates(self, wallet):
+        if wallet not in self.cursors:
+            return []
+        cursor = self.cursors[wallet]
+        events = []
+        for event in reversed(self.shared_events):
+            if event[0] <= cursor:
+                break
+            events.append(event)
+        events.reverse()
+        scoped = self.wallet_events.pop(wallet, None)
+        if scoped:
+            events = sorted(events + list(scoped), key=lambda event: event[0])
+        self.cursors[wallet] = self.seq
+        return [data for _, data in events[-self.cap :]] if self.cap else []
+
+
 class CastingDataclass:
     def __post_init__(self):
         for field in dataclasses.fields(self):
@@ -249,7 +305,114 @@ def modify_payment_url(key, url, amount):
     return urlunparse(parsed)
 
 
+@dataclass
+class ConnectorSettings:
+    """Connection pool and timeout settings for upstream RPC providers
+
+    Requests have no total timeout: a slow node is cut off by the socket read timeout instead, and waiting for a free
+    pool slot is bounded by pool_timeout, so one node can't hold all sockets open for minutes
+    """
+
+    pool_size: int = 100
+    pool_size_per_host: int = 20
+    keepalive_timeout: float = 30
+    pool_timeout: float = 30
+    connect_timeout: float = 10
+    read_timeout: float = 60
+    dns_cache_ttl: int = 300
+
+    @property
+    def timeout(self):
+        return ClientTimeout(
+            total=None, connect=self.pool_timeout, sock_connect=self.connect_timeout, sock_read=self.read_timeout
+        )
+
+    def create_session(self, metrics=None, **kwargs):
+        connector = TCPConnector(
+            limit=self.pool_size,
+            limit_per_host=self.pool_size_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+        trace_configs = [metrics.trace_config()] if metrics is not None else None
+        return ClientSession(connector=connector, timeout=self.timeout, trace_configs=trace_configs, **kwargs)
+
+
+class PoolMetrics:
+    """Connection pool counters of a ClientSession, collected with aiohttp request tracing"""
+
+    def __init__(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.errors = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.pool_waits = 0
+        self.pool_wait_time = 0.0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+
+    def trace_config(self):
+        config = TraceConfig()
+        config.on_request_start.append(self._on_request_start)
+        config.on_request_end.append(self._on_request_end)
+        config.on_request_exception.append(self._on_request_exception)
+        config.on_connection_queued_start.append(self._on_connection_queued_start)
+        config.on_connection_queued_end.append(self._on_connection_queued_end)
+        config.on_connection_create_end.append(self._on_connection_create_end)
+        config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        config.on_dns_cache_hit.append(self._on_dns_cache_hit)
+        config.on_dns_cache_miss.append(self._on_dns_cache_miss)
+        return config
+
+    async def _on_request_start(self, session, ctx, params):
+        self.requests += 1
+        self.in_flight += 1
+
+    async def _on_request_end(self, session, ctx, params):
+        self.in_flight -= 1
+
+    async def _on_request_exception(self, session, ctx, params):
+        self.in_flight -= 1
+        self.errors += 1
+
+    async def _on_connection_queued_start(self, session, ctx, params):
+        self.pool_waits += 1
+        ctx.queued_at = time.monotonic()
+
+    async def _on_connection_queued_end(self, session, ctx, params):
+        self.pool_wait_time += time.monotonic() - getattr(ctx, "queued_at", time.monotonic())
+
+    async def _on_connection_create_end(self, session, ctx, params):
+        self.connections_created += 1
+
+    async def _on_connection_reuseconn(self, session, ctx, params):
+        self.connections_reused += 1
+
+    async def _on_dns_cache_hit(self, session, ctx, params):
+        self.dns_cache_hits += 1
+
+    async def _on_dns_cache_miss(self, session, ctx, params):
+        self.dns_cache_misses += 1
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "errors": self.errors,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "pool_waits": self.pool_waits,
+            "pool_wait_time": round(self.pool_wait_time, 3),
+            "dns_cache_hits": self.dns_cache_hits,
+            "dns_cache_misses": self.dns_cache_misses,
+        }
+
+
 class AbstractRPCProvider(metaclass=ABCMeta):
+    pool_metrics = None
+
     @abstractmethod
     async def send_single_request(self, *args, **kwargs):
         pass
@@ -258,25 +421,100 @@ class AbstractRPCProvider(metaclass=ABCMeta):
     async def send_ping_request(self):
         pass
 
+    async def send_batch_request(self, requests):
+        raise NotImplementedError("Batch requests are not supported by this provider")
+
+    def is_read_request(self, *args, **kwargs):
+        """Whether the request can safely be sent twice, used for hedging"""
+        return False
+
+    def pool_stats(self):
+        return None if self.pool_metrics is None else self.pool_metrics.to_dict()
+
+    async def close(self):
+        """Release connections held by the provider, called when the provider set is stopped"""
+        return
+
+
+class ProviderStats:
+    EWMA_ALPHA = 0.2
+    LATENCY_WINDOW = 100
+
+    def __init__(self):
+        self.latency = None  # EWMA of successful request latency, in seconds
+        self.error_rate = 0.0  # EWMA of failures, 0 to 1
+        self.requests = 0
+        self.errors = 0
+        self.hedged = 0
+        self.hedges_won = 0
+        self.latencies = deque(maxlen=self.LATENCY_WINDOW)
+
+    def record(self, latency=None, error=False):
+        self.requests += 1
+        self.error_rate += self.EWMA_ALPHA * (float(error) - self.error_rate)
+        if error:
+            self.errors += 1
+            return
+        self.latency = latency if self.latency is None else self.latency + self.EWMA_ALPHA * (latency - self.latency)
+        self.latencies.append(latency)
+
+    def record_cancelled(self, elapsed):
+        # a cancelled request would have taken at least elapsed, so it can only raise the estimate
+        if self.latency is None or elapsed > self.latency:
+            self.latency = elapsed if self.latency is None else self.latency + self.EWMA_ALPHA * (elapsed - self.latency)
+
+    def reset_errors(self):
+        self.error_rate = 0.0
+
+    def p95(self):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def to_dict(self):
+        p95 = self.p95()
+        return {
+            "latency_ms": None if self.latency is None else round(self.latency * 1000, 2),
+            "p95_ms": None if p95 is None else round(p95 * 1000, 2),
+            "error_rate": round(self.error_rate, 4),
+            "requests": self.requests,
+            "errors": self.errors,
+            "hedged": self.hedged,
+            "hedges_won": self.hedges_won,
+        }
+
 
 class MultipleProviderRPC(metaclass=ABCMeta):
+    """Route requests to the fastest healthy provider, failing over to the others in latency order
+
+    A provider is unhealthy once it fails more than NEXT_RPC_SWITCH_TIMES times in a row or its error rate EWMA reaches
+    UNHEALTHY_ERROR_RATE, it is only used again after passing RPC_UP_CHECK_TIMES pings in a row.
+    With hedging enabled, read requests are also sent to the next provider if the first one didn't answer within its p95
+    latency, and the first successful response wins.
+    """
+
     providers: list[AbstractRPCProvider]
 
     NEXT_RPC_SWITCH_TIMES = 5
     RPC_UP_CHECK_TIMES = 5
     CHECK_STABLE_RPC_INTERVAL = 5 * 60
+    UNHEALTHY_ERROR_RATE = 0.5
+    HEDGE_MIN_DELAY = 0.05
+    HEDGE_DEFAULT_DELAY = 1
 
     RESET = object()  # sentinel
 
-    def __init__(self, providers: list[AbstractRPCProvider]):
+    def __init__(self, providers: list[AbstractRPCProvider], hedge_requests=False):
         if not isinstance(providers, list):
             raise TypeError("providers must be a list")
         self.providers = providers
         if not self.providers:
             raise ValueError("No urls provided")
+        self.hedge_requests = hedge_requests
         self.current_rpc_idx = 0
         self.failed_stats = [0 for _ in self.providers]
-        self.switch_lock = asyncio.Lock()
+        self.stats = [ProviderStats() for _ in self.providers]
         self.locks = [asyncio.Lock() for _ in self.providers]
         self.running = False
 
@@ -284,27 +522,6 @@ class MultipleProviderRPC(metaclass=ABCMeta):
     def current_rpc(self):
         return self.providers[self.current_rpc_idx]
 
-    def prev_rpc_idx(self, idx):
-        return (idx - 1) % len(self.providers)
-
-    def next_rpc_idx(self, idx):
-        return (idx + 1) % len(self.providers)
-
-    async def prev_rpc(self):
-        async with self.switch_lock:
-            await self._edit_failed_stats(self.current_rpc_idx)
-            self.current_rpc_idx = self.prev_rpc_idx(self.current_rpc_idx)
-            return self.current_rpc
-
-    async def next_rpc(self):
-        async with self.switch_lock:
-            await self._edit_failed_stats(self.current_rpc_idx)
-            self.current_rpc_idx = self.next_rpc_idx(self.current_rpc_idx)
-            return self.current_rpc
-
-    def is_last_rpc(self):
-        return self.current_rpc_idx == len(self.providers) - 1
-
     async def _edit_failed_stats(self, idx, delta=RESET):
         async with self.locks[idx]:
             if delta is self.RESET:
@@ -312,43 +529,116 @@ class MultipleProviderRPC(metaclass=ABCMeta):
             else:
                 self.failed_stats[idx] = max(0, self.failed_stats[idx] + delta)
 
+    def is_healthy(self, idx):
+        return self.failed_stats[idx] <= self.NEXT_RPC_SWITCH_TIMES and self.stats[idx].error_rate < self.UNHEALTHY_ERROR_RATE
+
+    def ranked_rpc_idxs(self):
+        # providers without measurements yet sort first so that they get measured
+        return sorted(
+            range(len(self.providers)),
+            key=lambda idx: (not self.is_healthy(idx), self.stats[idx].latency or 0.0, idx),
+        )
+
+    def get_hedge_delay(self, idx):
+        p95 = self.stats[idx].p95()
+        return self.HEDGE_DEFAULT_DELAY if p95 is None else max(p95, self.HEDGE_MIN_DELAY)
+
+    def get_stats(self):
+        return [
+            {
+                "server": getattr(provider, "endpoint_uri", None) or getattr(provider, "url", None),
+                "current": idx == self.current_rpc_idx,
+                "healthy": self.is_healthy(idx),
+                **self.stats[idx].to_dict(),
+                "pool": provider.pool_stats(),
+            }
+            for idx, provider in enumerate(self.providers)
+        ]
+
     async def send_request(self, *args, **kwargs):
-        has_exception = False
+        order = self.ranked_rpc_idxs()
+        self.current_rpc_idx = order[0]
+        if self.hedge_requests and len(order) > 1 and self.providers[order[0]].is_read_request(*args, **kwargs):
+            return await self._send_hedged(order, *args, **kwargs)
+        return await self._send_with_failover(order, "send_single_request", *args, **kwargs)
+
+    async def send_batch_request(self, requests):
+        order = self.ranked_rpc_idxs()
+        self.current_rpc_idx = order[0]
+        return await self._send_with_failover(order, "send_batch_request", requests)
+
+    async def _send_to(self, rpc_idx, func_name, *args, **kwargs):
+        start = time.monotonic()
         try:
-            start_rpc_idx = self.current_rpc_idx
-            rpc_idx = start_rpc_idx
-            while True:
-                try:
-                    return await self.providers[rpc_idx].send_single_request(*args, **kwargs)
-                except Exception:
-                    await self._edit_failed_stats(rpc_idx, +1)
-                    if self.failed_stats[rpc_idx] > self.NEXT_RPC_SWITCH_TIMES:
-                        await self.next_rpc()
-                    rpc_idx = self.next_rpc_idx(rpc_idx)
-                    if rpc_idx == start_rpc_idx:
-                        raise
+            result = await getattr(self.providers[rpc_idx], func_name)(*args, **kwargs)
+        except asyncio.CancelledError:
+            # lost a hedged race: elapsed time is only a lower bound of its latency, not a successful sample
+            self.stats[rpc_idx].record_cancelled(time.monotonic() - start)
+            raise
         except Exception:
-            has_exception = True
+            self.stats[rpc_idx].record(error=True)
+            await self._edit_failed_stats(rpc_idx, +1)
             raise
+        self.stats[rpc_idx].record(time.monotonic() - start)
+        await self._edit_failed_stats(rpc_idx, -1)
+        return result
+
+    async def _send_with_failover(self, order, func_name, *args, **kwargs):
+        for rpc_idx in order[:-1]:
+            with suppress(Exception):
+                return await self._send_to(rpc_idx, func_name, *args, **kwargs)
+        return await self._send_to(order[-1], func_name, *args, **kwargs)
+
+    async def _send_hedged(self, order, *args, **kwargs):
+        remaining = list(order)
+        pending = {}
+        hedged = False
+        error = None
+
+        def launch():
+            rpc_idx = remaining.pop(0)
+            pending[asyncio.ensure_future(self._send_to(rpc_idx, "send_single_request", *args, **kwargs))] = rpc_idx
+            return rpc_idx
+
+        primary_idx = launch()
+        try:
+            while pending:
+                timeout = self.get_hedge_delay(primary_idx) if not hedged and remaining else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.stats[launch()].hedged += 1
+                    continue
+                for task in done:
+                    rpc_idx = pending.pop(task)
+                    if task.exception() is None:
+                        if rpc_idx != primary_idx:
+                            self.stats[rpc_idx].hedges_won += 1
+                        return task.result()
+                    error = task.exception()
+                if not pending and remaining:  # everything in flight failed, fail over to the next provider
+                    launch()
+            raise error
         finally:
-            if not has_exception:
-                await self._edit_failed_stats(rpc_idx, -1)
+            for task in pending:
+                task.cancel()
+
+    async def check_provider(self, idx):
+        checks = 1 if self.is_healthy(idx) else self.RPC_UP_CHECK_TIMES + 1
+        for _ in range(checks):
+            try:
+                await self._send_to(idx, "send_ping_request")
+            except Exception:
+                return
+        if checks > 1:
+            await self._edit_failed_stats(idx)
+            self.stats[idx].reset_errors()
 
     async def maintain_stable_rpc(self):
+        # refreshes latency of providers not picked by routing, and brings recovered ones back
         while self.running:
             await asyncio.sleep(self.CHECK_STABLE_RPC_INTERVAL)
-            prev_idx = self.current_rpc_idx - 1
-            if prev_idx < 0:
-                continue
-            is_stable = True
-            for _ in range(self.RPC_UP_CHECK_TIMES + 1):
-                try:
-                    await self.providers[prev_idx].send_ping_request()
-                except Exception:
-                    is_stable = False
-                    break
-            if is_stable:
-                await self.prev_rpc()
+            await asyncio.gather(*(self.check_provider(idx) for idx in range(len(self.providers))))
 
     async def start(self):
         self.running = True
@@ -356,3 +646,7 @@ class MultipleProviderRPC(metaclass=ABCMeta):
 
     async def stop(self):
         self.running = False
+        results = await asyncio.gather(*(provider.close() for provider in self.providers), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"Error closing RPC provider: {get_exception_message(result)}")
@@ -1,15 +1,16 @@
 import asyncio
 import binascii
+import functools
 import json
 import os
 import secrets
-import time
 import traceback
-from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from contextvars import ContextVar
 from dataclasses import dataclass
 from datetime import datetime
 from decimal import Decimal
+from multiprocessing import get_context as get_mp_context
 
 from aiohttp import ClientError as AsyncClientError
 from genericprocessor import (
@@ -19,7 +20,6 @@ from genericprocessor import (
     PR_UNPAID,
     BlockchainFeatures,
     BlockProcessorDaemon,
-    WalletDB,
     daemon_ctx,
     decimal_to_string,
     from_wei,
@@ -42,12 +42,21 @@ from monero.transaction import ExtraParser
 from monero.transaction import Transaction as MoneroTransaction
 from monero.wallet import Wallet as MoneroWallet
 from storage import JSONEncoder as StorageJSONEncoder
-from storage import Storage
-from utils import AbstractRPCProvider, MultipleProviderRPC, exception_retry_middleware, load_json_dict, modify_payment_url, rpc
+from storage import get_encoder, to_jsonable
+from utils import (
+    AbstractRPCProvider,
+    MultipleProviderRPC,
+    PoolMetrics,
+    exception_retry_middleware,
+    load_json_dict,
+    modify_payment_url,
+    rpc,
+)
 
 logger = get_logger(__name__)
 
 MAX_FETCH_TXES = 100
+SCAN_WALLET_CACHE_SIZE = 10000
 
 daemon_ctx: ContextVar["XMRDaemon"]
 
@@ -60,6 +69,54 @@ def is_valid_hash(hexhash):
         return
 
 
+@functools.lru_cache(maxsize=SCAN_WALLET_CACHE_SIZE)
+def get_scan_wallet(address, view_key):
+    return MoneroWallet(OfflineWallet(address, view_key=view_key))
+
+
+def get_final_tx_address(address, tx, wallet):
+    ep = ExtraParser(tx.json["extra"])
+    d = ep.parse()
+    svk = binascii.unhexlify(wallet.view_key())
+    encrypted_payment_id = d["nonces"][0][1:]
+    svk_2 = ed25519.scalar_add(svk, svk)
+    svk_4 = ed25519.scalar_add(svk_2, svk_2)
+    svk_8 = ed25519.scalar_add(svk_4, svk_4)
+    shared_secret = bytearray(ed25519.scalarmult(svk_8, tx.pubkeys[0]))
+    shared_secret.append(0x8D)
+    shared_secret = keccak_256(shared_secret).digest()
+    payment_id = bytearray(encrypted_payment_id)
+    for i in range(len(payment_id)):
+        payment_id[i] ^= shared_secret[i]
+    return address_func(address).with_payment_id(binascii.hexlify(payment_id).decode())
+
+
+def scan_tx_outputs(txes, watched, start=0):
+    """Scan monero transactions for outputs paying to watched (address, view key) pairs
+
+    Runs inside scan worker processes, so it only takes and returns picklable data: matches are
+    (tx index, address, final address, amount) tuples and errors are (tx hash, traceback) tuples
+    """
+    matches = []
+    errors = []
+    for index, tx in enumerate(txes, start):
+        for address, view_key in watched:
+            wallet = get_scan_wallet(address, view_key)
+            try:
+                for output in tx.outputs(wallet=wallet):
+                    if output.payment is not None:
+                        final_address = str(get_final_tx_address(address, tx, wallet))
+                        matches.append((index, address, final_address, output.payment.amount))
+            except Exception:
+                errors.append((tx.hash, traceback.format_exc()))
+    return matches, errors
+
+
+def split_evenly(items, parts):
+    size = max(1, -(-len(items) // max(1, parts)))
+    return [(start, items[start : start + size]) for start in range(0, len(items), size)]
+
+
 class JSONEncoder(StorageJSONEncoder):
     def default(self, obj):
         if isinstance(obj, MoneroTransaction):
@@ -73,8 +130,8 @@ class Transaction(BaseTransaction):
 
 
 class MoneroRPC(RPCProvider):
-    def __init__(self, url):
-        super().__init__(url)
+    def __init__(self, url, **kwargs):
+        super().__init__(url, **kwargs)
         self.request = exception_retry_middleware(self.request, (AsyncClientError, TimeoutError, asyncio.TimeoutError))
 
     @staticmethod
@@ -133,6 +190,12 @@ class MoneroRPC(RPCProvider):
             raise Exception(resp["status"])
         return resp.get("transactions", [])
 
+    async def get_mempool_hashes(self):
+        resp = await self.request("raw", "get_transaction_pool_hashes")
+        if resp["status"] != "OK":
+            raise Exception(resp["status"])
+        return resp.get("tx_hashes", [])
+
     async def broadcast(self, tx):
         resp = await self.request("raw", "send_raw_transaction", tx_as_hex=tx)
         if resp["status"] != "OK":
@@ -153,6 +216,12 @@ class MoneroRPCProvider(AbstractRPCProvider, MoneroRPC):
     async def send_ping_request(self):
         return await self.send_single_request("jsonrpc", "get_version")
 
+    def is_read_request(self, kind, method, *args, **kwargs):
+        return method != "send_raw_transaction"
+
+    async def close(self):
+        await self._close()
+
 
 class MultipleRPCMoneroProvider(MoneroRPC):
     def __init__(self, rpc: MultipleProviderRPC, *args, **kwargs):
@@ -162,9 +231,6 @@ class MultipleRPCMoneroProvider(MoneroRPC):
         return await self.rpc.send_request(kind, method, **kwargs)
 
 
-BLOCK_NUMBER_CACHE_TTL = 1.0  # seconds
-
-
 class XMRFeatures(BlockchainFeatures):
     rpc: MoneroRPC
 
@@ -172,17 +238,9 @@ class XMRFeatures(BlockchainFeatures):
         self.rpc = rpc
         self.get_block_safe = self.get_block
         self.get_tx_receipt_safe = self.get_tx_receipt
-        self._block_number_cache = None
-        self._block_number_cache_ts = 0.0
 
     async def get_block_number(self):
-        now = time.monotonic()
-        if self._block_number_cache is not None and now - self._block_number_cache_ts < BLOCK_NUMBER_CACHE_TTL:
-            return self._block_number_cache
-        block_number = (await self.rpc.request("jsonrpc", "get_block_count"))["count"] - 1
-        self._block_number_cache = block_number
-        self._block_number_cache_ts = now
-        return block_number
+        return (await self.rpc.request("jsonrpc", "get_block_count"))["count"] - 1
 
     async def is_connected(self):
         return True
@@ -244,15 +302,18 @@ class XMRFeatures(BlockchainFeatures):
 
     async def get_confirmations(self, tx_hash, data=None) -> int:
         data = data or await self.get_tx_receipt_safe(tx_hash)
-        current_height = await self.get_block_number()
+        current_height = await self.get_cached_block_number()
         return max(0, current_height - (data.height or current_height + 1) + 1)
 
     def to_dict(self, obj):
-        return json.loads(JSONEncoder(precision=daemon_ctx.get().DIVISIBILITY).encode(obj))
+        return to_jsonable(obj, get_encoder(JSONEncoder, daemon_ctx.get().DIVISIBILITY))
 
     def current_server(self):
         return self.rpc.rpc.current_rpc.url
 
+    def provider_stats(self):
+        return self.rpc.rpc.get_stats()
+
 
 class KeyStore(BaseKeyStore):
     address: str = None
@@ -269,6 +330,9 @@ class KeyStore(BaseKeyStore):
         if self.public_key is None:
             raise Exception("Missing secret viewkey required for payments detection")
 
+    def get_key_material(self):
+        return (*super().get_key_material(), self.address)
+
     def add_privkey(self, privkey, check_address=True):
         try:
             if len(privkey.split(" ")) == 1 and len(privkey) % 8 == 0:
@@ -316,6 +380,9 @@ class Wallet(BaseWallet):
     def remove_from_detection_dict(self, req):
         self.request_addresses.pop(req.address, None)
 
+    async def _start_process_pending(self, transactions, current_height):
+        await daemon_ctx.get().scan_transactions(transactions, addresses=[self.address])
+
     async def create_payment_request_object(self, address, amount, message, expiration, timestamp):
         invoice_id = secrets.token_hex(8)
         return Invoice(
@@ -326,17 +393,17 @@ class Wallet(BaseWallet):
             sent_amount=Decimal(0),
             exp=expiration,
             id=invoice_id,
-            height=await self.coin.get_block_number(),
+            height=await self.coin.get_cached_block_number(),
         )
 
-    async def process_new_payment(self, lookup_field, tx, payment, wallet, unconfirmed=False):
+    async def process_new_payment(self, lookup_field, tx, amount, wallet, unconfirmed=False):
         req = self.get_request(lookup_field)
         if req is None or req.status not in (PR_UNPAID, PR_UNCONFIRMED) or (unconfirmed and tx.hash in req.tx_hashes):
             return
         if unconfirmed:
-            req.sent_amount += payment.amount
+            req.sent_amount += amount
         else:
-            req.confirmed_amount += payment.amount
+            req.confirmed_amount += amount
         req.sent_amount = max(req.sent_amount, req.confirmed_amount)
         set_status = PR_UNPAID
         if unconfirmed and req.sent_amount >= req.amount:
@@ -356,6 +423,7 @@ class XMRDaemon(BlockProcessorDaemon):
     MEMPOOL_TIME = 5
 
     DEFAULT_MAX_SYNC_BLOCKS = 100  # 3.3 hours
+    WALLET_EVICTION_SUPPORTED = False  # payments are only found by scanning with loaded wallets' view keys
 
     UNIT = "piconero"
 
@@ -368,16 +436,32 @@ class XMRDaemon(BlockProcessorDaemon):
     def __init__(self):
         super().__init__()
         self.network_const = self.NETWORK_MAPPING.get(self.NET.lower())
-        self.mempool_cache = {}
+        self.mempool_cache = {}  # tx hash -> parsed transactions, for transactions still in the pool
+        self.scan_executor = None
         if not self.network_const:
             raise ValueError(
                 f"Invalid network passed: {self.NET}. Valid choices are {', '.join(self.NETWORK_MAPPING.keys())}."
             )
 
+    def load_env(self):
+        super().load_env()
+        self.INCREMENTAL_MEMPOOL = self.env("INCREMENTAL_MEMPOOL", cast=bool, default=True)
+        # off by default: spawned workers cost memory and pickling, which only pays off on large blocks
+        self.SCAN_PROCESSES = self.env("SCAN_PROCESSES", cast=int, default=1)
+        self.SCAN_PROCESSES_MIN_WORK = self.env("SCAN_PROCESSES_MIN_WORK", cast=int, default=256)
+
     async def on_startup(self, app):
+        if self.SCAN_PROCESSES > 1:
+            # spawn instead of fork: the daemon already runs threads at this point
+            self.scan_executor = ProcessPoolExecutor(max_workers=self.SCAN_PROCESSES, mp_context=get_mp_context("spawn"))
         await super().on_startup(app)
         self.loop.create_task(self.process_mempool())
 
+    async def on_shutdown(self, app):
+        await super().on_shutdown(app)
+        if self.scan_executor is not None:
+            self.scan_executor.shutdown(wait=False, cancel_futures=True)
+
     def create_mempool_tx(self, tx):
         as_json = json.loads(tx["tx_json"])
         fee = as_json.get("rct_signatures", {}).get("txnFee")
@@ -394,27 +478,58 @@ class XMRDaemon(BlockProcessorDaemon):
     async def process_mempool(self):
         while self.running:
             try:
-                mempool = await self.coin.rpc.get_mempool()
-                new_cache = {}
-                for tx_data in mempool:
-                    try:
-                        txes = await self.coin.parse_transactions(self.create_mempool_tx(tx_data))
-                        for tx in txes:
-                            new_cache[tx.hash] = True
-                            if tx.hash in self.mempool_cache:
-                                continue
-                            await self.process_transaction(tx, unconfirmed=True)
-                    except Exception:
-                        logger.error(f"Error processing transaction {self.coin.get_tx_hash(tx_data)}:")
-                        logger.error(traceback.format_exc())
-                self.mempool_cache = new_cache
+                if self.INCREMENTAL_MEMPOOL:
+                    await self.process_mempool_incremental()
+                else:
+                    await self.process_mempool_full()
             except Exception:
                 logger.error("Error processing mempool:")
                 logger.error(traceback.format_exc())
             await asyncio.sleep(self.MEMPOOL_TIME)
 
+    async def process_mempool_incremental(self):
+        pool_hashes = await self.coin.rpc.get_mempool_hashes()
+        # mined and dropped transactions fall out of the cache, pending ones are never fetched or parsed again
+        new_cache = {tx_hash: self.mempool_cache[tx_hash] for tx_hash in pool_hashes if tx_hash in self.mempool_cache}
+        new_hashes = [tx_hash for tx_hash in pool_hashes if tx_hash not in new_cache]
+        new_txes = []
+        if new_hashes:
+            for tx_data in await self.coin.rpc.get_transactions(new_hashes):
+                new_txes.extend(await self.parse_mempool_tx(tx_data, new_cache))
+        self.mempool_cache = new_cache
+        await self.scan_transactions(new_txes, unconfirmed=True)
+
+    async def process_mempool_full(self):
+        new_cache = {}
+        new_txes = []
+        for raw_tx in await self.coin.rpc.get_mempool():
+            tx_hash = raw_tx["id_hash"]
+            if tx_hash in self.mempool_cache:
+                new_cache[tx_hash] = self.mempool_cache[tx_hash]
+                continue
+            new_txes.extend(await self.parse_mempool_tx(self.create_mempool_tx(raw_tx), new_cache))
+        self.mempool_cache = new_cache
+        await self.scan_transactions(new_txes, unconfirmed=True)
+
+    async def parse_mempool_tx(self, tx_data, cache):
+        tx_hash = self.coin.get_tx_hash(tx_data)
+        try:
+            txes = await self.coin.parse_transactions(tx_data)
+        except Exception:
+            logger.error(f"Error processing transaction {tx_hash}:")
+            logger.error(traceback.format_exc())
+            return []
+        cache[tx_hash] = txes
+        return txes
+
     async def create_coin(self, archive=False):
-        multi_provider = MultipleProviderRPC([MoneroRPCProvider(server) for server in self.SERVER])
+        multi_provider = MultipleProviderRPC(
+            [
+                MoneroRPCProvider(server, connector_settings=self.connector_settings, pool_metrics=PoolMetrics())
+                for server in self.SERVER
+            ],
+            hedge_requests=self.HEDGE_REQUESTS,
+        )
         await multi_provider.start()
         provider = MultipleRPCMoneroProvider(multi_provider)
         self.coin = XMRFeatures(provider)
@@ -437,66 +552,89 @@ class XMRDaemon(BlockProcessorDaemon):
         if not xpub:
             return None
 
-        if diskless:
-            wallet = self.restore_wallet_from_text(xpub, path=NOOP_PATH, address=address)
-        else:
-            wallet_dir = self.get_wallet_path()
-            wallet_path = os.path.join(wallet_dir, wallet_key)
-            if not os.path.exists(wallet_path):
-                self.restore(xpub, wallet_path=wallet_path, address=address)
-            storage = Storage(wallet_path)
-            db = WalletDB(storage.read())
-            wallet = self.WALLET_CLASS(self.coin, db, storage)
+        with self.derived_keys.use(diskless or extra_params.get("one_time", False)):
+            if diskless:
+                wallet = self.restore_wallet_from_text(xpub, path=NOOP_PATH, address=address)
+            else:
+                wallet_dir = self.get_wallet_path()
+                wallet_path = os.path.join(wallet_dir, wallet_key)
+                if not self.wallet_exists(wallet_path):
+                    self.restore(xpub, wallet_path=wallet_path, address=address)
+                storage = self.create_storage(wallet_path)
+                db = self.load_wallet_db(storage)
+                wallet = self.WALLET_CLASS(self.coin, db, storage)
         self.wallets[wallet_key] = wallet
-        self.wallets_updates[wallet_key] = deque(maxlen=self.POLLING_CAP)
+        self.updates_log.add_wallet(wallet_key)
         self.addresses[wallet.address].add(wallet_key)
-        await wallet.start(self.latest_blocks.copy())
+        await wallet.start(self.get_replay_transactions(wallet))
         return wallet
 
-    def get_final_tx_address(self, address, tx, wallet):
-        ep = ExtraParser(tx.monero_tx.json["extra"])
-        d = ep.parse()
-        svk = binascii.unhexlify(wallet.view_key())
-        encrypted_payment_id = d["nonces"][0][1:]
-        svk_2 = ed25519.scalar_add(svk, svk)
-        svk_4 = ed25519.scalar_add(svk_2, svk_2)
-        svk_8 = ed25519.scalar_add(svk_4, svk_4)
-        shared_secret = bytearray(ed25519.scalarmult(svk_8, tx.monero_tx.pubkeys[0]))
-        shared_secret.append(0x8D)
-        shared_secret = keccak_256(shared_secret).digest()
-        payment_id = bytearray(encrypted_payment_id)
-        for i in range(len(payment_id)):
-            payment_id[i] ^= shared_secret[i]
-        return address_func(address).with_payment_id(binascii.hexlify(payment_id).decode())
+    def is_watched_transaction(self, tx):
+        # recipients are only known after scanning outputs with wallets' view keys
+        return bool(self.addresses)
+
+    def get_replay_transactions(self, wallet):
+        # no recipient index is possible, but Wallet._start_process_pending only scans them with the wallet's own key
+        return self.latest_blocks.get_all_transactions()
 
     async def process_transaction(self, tx, unconfirmed=False):
-        if tx.divisibility is None:
-            tx.divisibility = self.DIVISIBILITY
-        current_height = await self.coin.get_block_number()
-        # NOTE: do not process locked funds
-        if current_height <= tx.monero_tx.json["unlock_time"]:
-            return
-        for address in self.addresses:
-            try:
-                first_wallet = self.wallets[next(iter(self.addresses[address]))]
-            except StopIteration:
-                continue
-            w = MoneroWallet(
-                OfflineWallet(
-                    address,
-                    view_key=first_wallet.keystore.public_key,
-                )
+        await self.scan_transactions([tx], unconfirmed=unconfirmed)
+
+    async def process_block_transactions(self, transactions):
+        if self.addresses:
+            await self.scan_transactions(transactions)
+
+    def get_watched_keys(self, addresses=None):
+        watched = []
+        for address in self.addresses if addresses is None else addresses:
+            wallet_keys = self.addresses.get(address)
+            if wallet_keys:
+                watched.append((address, self.wallets[next(iter(wallet_keys))].keystore.public_key))
+        return watched
+
+    async def scan_outputs(self, txes, watched):
+        # (transaction, address) pairs to scan, smaller batches are faster in process
+        if self.scan_executor is None or len(txes) * len(watched) < max(2, self.SCAN_PROCESSES_MIN_WORK):
+            return scan_tx_outputs(txes, watched)
+        # split work by transactions first, and by addresses when there are fewer transactions than workers
+        tx_chunks = split_evenly(txes, self.SCAN_PROCESSES)
+        address_chunks = split_evenly(watched, self.SCAN_PROCESSES // len(tx_chunks))
+        results = await asyncio.gather(
+            *(
+                self.loop.run_in_executor(self.scan_executor, scan_tx_outputs, tx_chunk, address_chunk, start)
+                for start, tx_chunk in tx_chunks
+                for _, address_chunk in address_chunks
             )
+        )
+        matches = sorted((match for result in results for match in result[0]), key=lambda match: match[0])
+        errors = [error for result in results for error in result[1]]
+        return matches, errors
+
+    async def scan_transactions(self, txes, unconfirmed=False, addresses=None):
+        current_height = await self.coin.get_cached_block_number()
+        to_scan = []
+        for tx in txes:
+            if tx.divisibility is None:
+                tx.divisibility = self.DIVISIBILITY
+            # NOTE: do not process locked funds
+            if current_height > tx.monero_tx.json["unlock_time"]:
+                to_scan.append(tx)
+        watched = self.get_watched_keys(addresses)
+        if not to_scan or not watched:
+            return
+        matches, errors = await self.scan_outputs([tx.monero_tx for tx in to_scan], watched)
+        for tx_hash, error in errors:
+            logger.error(f"Error processing transaction {tx_hash}:")
+            logger.error(error)
+        for index, address, final_address, amount in matches:
+            tx = to_scan[index]
             try:
-                for output in tx.monero_tx.outputs(wallet=w):
-                    if output.payment is not None:
-                        final_address = self.get_final_tx_address(address, tx, w)
-                        for wallet in self.addresses[address]:
-                            await self.trigger_event({"event": "new_transaction", "tx": tx.hash}, wallet)
-                            if final_address in self.wallets[wallet].request_addresses:
-                                await self.wallets[wallet].process_new_payment(
-                                    final_address, tx, output.payment, wallet, unconfirmed=unconfirmed
-                                )
+                for wallet in self.addresses.get(address, set()).copy():
+                    await self.trigger_event({"event": "new_transaction", "tx": tx.hash}, wallet)
+                    if wallet in self.wallets and final_address in self.wallets[wallet].request_addresses:
+                        await self.wallets[wallet].process_new_payment(
+                            final_address, tx, amount, wallet, unconfirmed=unconfirmed
+                        )
             except Exception:
                 logger.error(f"Error processing transaction {tx.hash}:")
                 logger.error(traceback.format_exc())
@@ -531,13 +669,13 @@ class XMRDaemon(BlockProcessorDaemon):
 
     @rpc(requires_network=True)
     async def gettransaction(self, tx, wallet=None):
-        tx_obj = await self.coin.get_transaction(tx)
+        tx_obj, confirmations = await self.get_final_tx_data("gettransaction", tx, lambda: self.coin.get_transaction(tx))
         data = {
             **tx_obj.json,
             "fee": tx_obj.fee,
             "tx_hash": tx_obj.hash,
             "height": tx_obj.height,
-            "confirmations": await self.coin.get_confirmations(tx, tx_obj),
+            "confirmations": confirmations,
         }
         return self.coin.to_dict(data)
 
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Compare daemon serialization paths: stdlib json round trips vs the storage.json_dumps/to_jsonable layer"""
+
+import json
+import os
+import sys
+import timeit
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "daemons"))
+
+from storage import JsonDB, JSONEncoder, get_encoder, json_dumps, string_keys, to_jsonable
+
+NUMBER = 20
+
+
+def make_wallet_data(requests=5000):
+    return {
+        "keystore": {"type": "address", "address": "0x" + "ab" * 20},
+        "payment_requests": {
+            f"0x{i:040x}": {
+                "address": f"0x{i:040x}",
+                "amount": Decimal(i) / 1000,
+                "message": f"order {i}",
+                "time": 1700000000 + i,
+                "exp": 900,
+                "status": 0,
+                "tx_hashes": [],
+                "contract": None,
+            }
+            for i in range(requests)
+        },
+        "used_addresses": [f"0x{i:040x}" for i in range(requests)],
+        "version": 1,
+    }
+
+
+def make_response(items=1000):
+    return {
+        "jsonrpc": "2.0",
+        "result": [
+            {"hash": f"0x{i:064x}", "value": str(Decimal(i) / 7), "confirmations": i, "from": "0x" + "cd" * 20}
+            for i in range(items)
+        ],
+        "id": 1,
+    }
+
+
+def bench(name, old, new):
+    old_time = timeit.timeit(old, number=NUMBER) / NUMBER
+    new_time = timeit.timeit(new, number=NUMBER) / NUMBER
+    print(f"{name:<24} {old_time * 1000:9.2f}ms {new_time * 1000:9.2f}ms {old_time / new_time:7.2f}x")
+
+
+def main():
+    data = make_wallet_data()
+    response = make_response()
+    db = JsonDB(data)
+    value = data["payment_requests"]["0x" + "0" * 40]
+    encoder = get_encoder(JSONEncoder, 8)
+    print(f"{'benchmark':<24} {'old':>11} {'new':>11} {'speedup':>8}")
+    bench(
+        "JsonDB.dump",
+        lambda: json.dumps(string_keys(data), cls=JSONEncoder),
+        db.dump,
+    )
+    bench(
+        "JsonDB.put x1000",
+        lambda: [(json.dumps("key", cls=JSONEncoder), json.dumps(value, cls=JSONEncoder)) for _ in range(1000)],
+        lambda: [json_dumps(["key", value]) for _ in range(1000)],
+    )
+    bench(
+        "to_dict",
+        lambda: json.loads(JSONEncoder(precision=8).encode(data["payment_requests"])),
+        lambda: to_jsonable(data["payment_requests"], encoder),
+    )
+    bench("JsonResponse", lambda: json.dumps(response), lambda: json_dumps(response))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# Migrates per-file JSON daemon wallets (optionally journaled) into a single sqlite wallets store
+# Usage: walletsmigrate.py <wallets directory> <sqlite database path>
+# Wallets are keyed by their path relative to the database directory, so put the database in the daemon's data directory
+# Example: walletsmigrate.py ~/.bitcart-eth/mainnet/wallets ~/.bitcart-eth/mainnet/wallets.sqlite
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "daemons"))
+
+from storage import JournaledStorage, SQLiteWalletStore, apply_patch
+
+if len(sys.argv) < 3:
+    sys.exit("Usage: walletsmigrate.py <wallets directory> <sqlite database path>")
+
+wallets_dir, database_path = sys.argv[1], sys.argv[2]
+if not os.path.isdir(wallets_dir):
+    sys.exit(f"Wallets directory {wallets_dir} not found")
+
+store = SQLiteWalletStore(database_path)
+migrated = skipped = 0
+for name in sorted(os.listdir(wallets_dir)):
+    path = os.path.join(wallets_dir, name)
+    if not os.path.isfile(path) or name.endswith(".journal") or ".tmp." in name:
+        continue
+    try:
+        storage = JournaledStorage(path)
+        data = storage.read()
+        if isinstance(data, str):
+            data = json.loads(data)
+    except Exception as e:
+        print(f"Skipping {path}: {e}")
+        skipped += 1
+        continue
+    for patches in storage.read_journal():
+        for patch in patches:
+            apply_patch(data, patch)
+    store.write(store.get_key(storage.path), data)
+    migrated += 1
+store.close()
+print(f"Migrated {migrated} wallets, skipped {skipped}")
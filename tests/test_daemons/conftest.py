@@ -0,0 +1,24 @@
+import os
+import pathlib
+import sys
+from typing import Any
+
+import pytest
+
+# daemons are a flat directory of modules importing each other by name, like when they are started as scripts
+DAEMONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "daemons")
+if DAEMONS_DIR not in sys.path:
+    sys.path.insert(0, DAEMONS_DIR)
+
+
+@pytest.fixture
+def eth_daemon(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> Any:
+    pytest.importorskip("web3")
+    from eth import ETHDaemon, ETHFeatures
+    from web3 import AsyncWeb3
+
+    monkeypatch.setenv("ETH_DATA_PATH", str(tmp_path))
+    daemon = ETHDaemon()
+    # offline coin: enough for address handling, any network call fails
+    daemon.coin = ETHFeatures(AsyncWeb3())
+    return daemon
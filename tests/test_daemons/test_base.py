@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import weakref
+from typing import Any
+
+import pytest
+
+ADDRESS = "0x" + "11" * 20
+
+
+def read_response(response: Any) -> Any:
+    return json.loads(response.body)
+
+
+@pytest.mark.anyio
+async def test_batch_request(eth_daemon: Any) -> None:
+    response = await eth_daemon.handle_batch_request(
+        [
+            {"jsonrpc": "2.0", "method": "validateaddress", "params": [ADDRESS], "id": 1},
+            {"jsonrpc": "2.0", "method": "missing_method", "params": [], "id": 2},
+            {"jsonrpc": "2.0", "method": "validateaddress", "params": ["invalid"], "id": 3},
+            {"jsonrpc": "2.0", "params": [], "id": 4},
+            1,
+        ]
+    )
+    assert response.content_type == "application/json"
+    assert read_response(response) == [
+        {"jsonrpc": "2.0", "result": True, "id": 1},
+        {"jsonrpc": "2.0", "error": {"code": -32601, "message": "Procedure not found"}, "id": 2},
+        {"jsonrpc": "2.0", "result": False, "id": 3},
+        {"jsonrpc": "2.0", "error": {"code": -32601, "message": "Procedure not found"}, "id": 4},
+        {"jsonrpc": "2.0", "error": {"code": -32600, "message": "Invalid Request"}, "id": None},
+    ]
+
+
+@pytest.mark.anyio
+async def test_empty_batch_request(eth_daemon: Any) -> None:
+    response = await eth_daemon.handle_batch_request([])
+    assert read_response(response) == {"jsonrpc": "2.0", "error": {"code": -32600, "message": "Invalid Request"}, "id": None}
+
+
+@pytest.mark.anyio
+async def test_batch_notifications(eth_daemon: Any) -> None:
+    response = await eth_daemon.handle_batch_request(
+        [
+            {"jsonrpc": "2.0", "method": "validateaddress", "params": [ADDRESS]},
+            {"jsonrpc": "2.0", "method": "missing_method", "params": []},
+            {"jsonrpc": "2.0", "method": "validateaddress", "params": [ADDRESS], "id": 1},
+            [1],
+        ]
+    )
+    assert read_response(response) == [
+        {"jsonrpc": "2.0", "result": True, "id": 1},
+        {"jsonrpc": "2.0", "error": {"code": -32600, "message": "Invalid Request"}, "id": None},
+    ]
+
+
+@pytest.mark.anyio
+async def test_notifications_only_batch(eth_daemon: Any) -> None:
+    response = await eth_daemon.handle_batch_request(
+        [
+            {"jsonrpc": "2.0", "method": "validateaddress", "params": [ADDRESS]},
+            {"jsonrpc": "2.0", "method": "validateaddress", "params": ["invalid"]},
+        ]
+    )
+    assert response.status == 204
+    assert not response.body
+
+
+@pytest.mark.anyio
+async def test_batch_matches_single_requests(eth_daemon: Any) -> None:
+    request = {"jsonrpc": "2.0", "method": "validateaddress", "params": {"address": ADDRESS}, "id": "a"}
+    single = read_response(await eth_daemon.execute_request_data(dict(request)))
+    assert read_response(await eth_daemon.handle_batch_request([dict(request)])) == [single]
+
+
+class FakeWebsocket:
+    def __init__(self, error: Exception | None = None) -> None:
+        self.closed = False
+        self.sent: list[str] = []
+        self.close_codes: list[int | None] = []
+        self.error = error
+
+    async def send_str(self, data: str) -> None:
+        if self.error is not None:
+            raise self.error
+        self.sent.append(data)
+
+    async def close(self, code: int | None = None, message: bytes = b"") -> None:
+        self.closed = True
+        self.close_codes.append(code)
+
+
+def add_subscriber(daemon: Any, xpub: str | None, queue_size: int = 10) -> Any:
+    from base import WebsocketSubscriber
+
+    subscriber = WebsocketSubscriber(FakeWebsocket(), queue_size)
+    daemon.subscribe_websocket(subscriber, xpub)
+    return subscriber
+
+
+def queued(subscriber: Any) -> list[Any]:
+    return [json.loads(subscriber.queue.get_nowait())["updates"] for _ in range(subscriber.queue.qsize())]
+
+
+@pytest.mark.anyio
+async def test_notifications_fan_out(eth_daemon: Any) -> None:
+    everything = add_subscriber(eth_daemon, None)
+    wallet = add_subscriber(eth_daemon, ADDRESS)
+    other = add_subscriber(eth_daemon, "other")
+    await eth_daemon.notify_websockets({"event": "new_payment"}, ADDRESS)
+    await eth_daemon.notify_websockets({"event": "new_block"}, None)
+    assert queued(everything) == [[{"event": "new_payment"}], [{"event": "new_block"}]]
+    assert queued(wallet) == [[{"event": "new_payment"}], [{"event": "new_block"}]]
+    assert queued(other) == [[{"event": "new_block"}]]
+
+
+@pytest.mark.anyio
+async def test_slow_websocket_disconnected(eth_daemon: Any) -> None:
+    from aiohttp import WSCloseCode
+
+    slow = add_subscriber(eth_daemon, None, queue_size=1)
+    fast = add_subscriber(eth_daemon, None)
+    await eth_daemon.notify_websockets({"event": "new_block", "height": 1}, None)
+    await eth_daemon.notify_websockets({"event": "new_block", "height": 2}, None)
+    await asyncio.sleep(0)
+    assert slow.ws.close_codes == [WSCloseCode.TRY_AGAIN_LATER]
+    assert eth_daemon.ws_subscribers[None] == {fast}
+    assert len(queued(fast)) == 2
+
+
+@pytest.mark.anyio
+async def test_websocket_sender_stops_on_send_error() -> None:
+    from base import WebsocketSubscriber
+
+    subscriber = WebsocketSubscriber(FakeWebsocket(ConnectionResetError("Cannot write to closing transport")), 10)
+    subscriber.send("{}")
+    await asyncio.wait_for(subscriber.run_sender(), 1)
+    assert subscriber.ws.closed
+
+
+@pytest.mark.anyio
+async def test_websocket_handler(eth_daemon: Any) -> None:
+    from aiohttp import BasicAuth, web
+    from aiohttp.test_utils import TestClient, TestServer
+
+    app = web.Application()
+    app["websockets"] = weakref.WeakSet()
+    app.router.add_get("/ws", eth_daemon.handle_websocket)
+    async with TestClient(TestServer(app)) as client:
+        ws = await client.ws_connect("/ws", auth=BasicAuth(eth_daemon.LOGIN, eth_daemon.PASSWORD))
+        await ws.send_json({"xpub": ADDRESS})
+        while ADDRESS not in eth_daemon.ws_subscribers:
+            await asyncio.sleep(0.01)
+        await eth_daemon.notify_websockets({"event": "new_payment"}, ADDRESS)
+        assert (await ws.receive_json(timeout=1))["updates"] == [{"event": "new_payment"}]
+        await ws.close()
+        while eth_daemon.ws_subscribers:
+            await asyncio.sleep(0.01)
+        assert not app["websockets"]
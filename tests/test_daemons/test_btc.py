@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import pathlib
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+import pytest_mock
+
+pytest.importorskip("electrum")
+
+
+class FakeWallet:
+    storage = None
+
+    async def stop(self) -> None:
+        return None
+
+
+@pytest.fixture
+def btc_daemon(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> Any:
+    from btc import BTCDaemon
+
+    monkeypatch.setenv("BTC_DATA_PATH", str(tmp_path))
+    return BTCDaemon()
+
+
+def add_wallet(daemon: Any, key: str) -> FakeWallet:
+    # what load_wallet registers once electrum has opened the wallet
+    wallet = FakeWallet()
+    daemon.wallets[key] = {"wallet": wallet, "cmd": None, "contract": None}
+    daemon.wallet_keys[id(wallet)] = key
+    daemon.updates_log.add_wallet(key)
+    return wallet
+
+
+@pytest.mark.anyio
+async def test_wallet_events_routed_by_wallet_object(btc_daemon: Any, mocker: pytest_mock.MockerFixture) -> None:
+    notify_websockets = mocker.patch.object(btc_daemon, "notify_websockets")
+    add_wallet(btc_daemon, "first")
+    second = add_wallet(btc_daemon, "second")
+    await btc_daemon._process_events("verified", second, "0x01", SimpleNamespace(height=5))
+    event = {"event": "verified_tx", "tx": "0x01", "height": 5}
+    notify_websockets.assert_awaited_once_with(event, "second")
+    assert btc_daemon.updates_log.pop_updates("second") == [event]
+    assert btc_daemon.updates_log.pop_updates("first") == []
+    # events of closed wallets are dropped
+    assert await btc_daemon.close_wallet("second")
+    assert id(second) not in btc_daemon.wallet_keys
+    await btc_daemon._process_events("verified", second, "0x02", SimpleNamespace(height=6))
+    notify_websockets.assert_awaited_once()
@@ -0,0 +1,350 @@
+from __future__ import annotations
+
+import asyncio
+import pathlib
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+import pytest_mock
+
+pytest.importorskip("web3")
+
+ADDRESS = "0x" + "11" * 20
+OTHER_ADDRESS = "0x" + "22" * 20
+CONTRACT = "0x" + "33" * 20
+
+
+@pytest.mark.anyio
+async def test_trace_queue_overflow_goes_to_backlog(eth_daemon: Any, tmp_path: pathlib.Path) -> None:
+    from eth import ETHDaemon
+
+    eth_daemon.trace_available = True
+    eth_daemon.trace_queue = asyncio.Queue(maxsize=2)
+    for block_number in range(1, 6):
+        eth_daemon.enqueue_trace(block_number)
+    assert eth_daemon.trace_queue.qsize() == 2
+    assert eth_daemon.trace_backlog_from == 3
+    # the marker survives restarts
+    assert ETHDaemon().trace_backlog_from == 3
+    traced = [await asyncio.wait_for(eth_daemon.next_trace_block(), 1) for _ in range(5)]
+    assert traced == [1, 2, 3, 4, 5]
+    # backlog is done: the tracer waits on the queue again
+    next_block = asyncio.ensure_future(eth_daemon.next_trace_block())
+    await asyncio.sleep(0)
+    assert eth_daemon.trace_backlog_from is None
+    eth_daemon.enqueue_trace(6)
+    assert await asyncio.wait_for(next_block, 1) == 6
+
+
+@pytest.mark.anyio
+async def test_trace_backlog_follows_new_blocks(eth_daemon: Any) -> None:
+    eth_daemon.trace_available = True
+    eth_daemon.trace_queue = asyncio.Queue(maxsize=1)
+    eth_daemon.enqueue_trace(1)
+    eth_daemon.enqueue_trace(2)
+    assert await eth_daemon.next_trace_block() == 1
+    assert await eth_daemon.next_trace_block() == 2
+    # blocks committed while the backlog is traced are picked up by it
+    eth_daemon.enqueue_trace(3)
+    assert eth_daemon.trace_queue.empty()
+    assert await eth_daemon.next_trace_block() == 3
+
+
+def test_trace_not_enqueued_without_archive_node(eth_daemon: Any) -> None:
+    eth_daemon.enqueue_trace(1)
+    assert eth_daemon.trace_queue.empty()
+    assert eth_daemon.trace_backlog_from is None
+
+
+class FakeBatch:
+    def __init__(self, blocks: dict[int, Any]) -> None:
+        self.blocks = blocks
+        self.requests: list[int] = []
+
+    async def __aenter__(self) -> FakeBatch:
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        return None
+
+    def add(self, block_number: int) -> None:
+        self.requests.append(block_number)
+
+    async def async_execute(self) -> list[Any]:
+        if any(block_number not in self.blocks for block_number in self.requests):
+            raise ValueError("block not found")
+        return [self.blocks[block_number] for block_number in self.requests]
+
+
+@pytest.fixture
+def batch_coin(eth_daemon: Any, mocker: pytest_mock.MockerFixture) -> Any:
+    coin = eth_daemon.coin
+    blocks = {n: {"transactions": [{"hash": f"0x{n:02x}"}]} for n in (1, 2)}
+    coin.batch = FakeBatch(blocks)
+    coin.web3 = SimpleNamespace(
+        batch_requests=lambda: coin.batch,
+        eth=SimpleNamespace(get_block=lambda block_number, full_transactions: block_number),
+    )
+    mocker.patch.object(coin, "get_tx_hash", side_effect=lambda tx: tx["hash"])
+    mocker.patch.object(
+        coin,
+        "get_blocks_receipts",
+        return_value=[[{"transactionHash": f"0x{n:02x}", "status": 1, "logs": []}] for n in (1, 2)],
+    )
+
+    async def get_block(block_number: int, **kwargs: Any) -> Any:
+        if block_number not in blocks:
+            raise ValueError(f"block {block_number} not found")
+        return blocks[block_number]
+
+    mocker.patch.object(coin, "get_block_safe", side_effect=get_block)
+    return coin
+
+
+@pytest.mark.anyio
+async def test_blocks_fetched_in_batches(batch_coin: Any, mocker: pytest_mock.MockerFixture) -> None:
+    receipts = mocker.patch.object(batch_coin, "get_block_receipts_safe")
+    assert await batch_coin.get_blocks_txes([1, 2]) == [
+        [{"hash": "0x01", "status": 1, "logs": []}],
+        [{"hash": "0x02", "status": 1, "logs": []}],
+    ]
+    assert batch_coin.batch.requests == [1, 2]
+    batch_coin.get_blocks_receipts.assert_awaited_once_with([1, 2])
+    batch_coin.get_block_safe.assert_not_called()
+    receipts.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_failed_batch_falls_back_to_single_blocks(batch_coin: Any) -> None:
+    txes, error = await batch_coin.get_blocks_txes([1, 3], receipts=False)
+    # only the missing block fails, the others are fetched one by one
+    assert txes == [{"hash": "0x01"}]
+    assert isinstance(error, ValueError)
+    assert [call.args[0] for call in batch_coin.get_block_safe.await_args_list] == [1, 3]
+
+
+class ChainIdNode:
+    def __init__(self) -> None:
+        self.calls = 0
+
+    @property
+    def chain_id(self) -> Any:
+        self.calls += 1
+        return asyncio.sleep(0, 1)
+
+
+@pytest.mark.anyio
+async def test_chain_id_fetched_once(eth_daemon: Any) -> None:
+    node = ChainIdNode()
+    eth_daemon.coin.web3 = SimpleNamespace(eth=node)
+    assert [await eth_daemon.coin.chain_id() for _ in range(3)] == [1, 1, 1]
+    assert node.calls == 1
+
+
+WATCHED = "0x" + "ab" * 20
+SENDER = "0x" + "44" * 20
+
+
+def trace_call(to: str | None, data: str = "0x", value: str = "0x0", **kwargs: Any) -> dict[str, Any]:
+    return {"type": "CALL", "from": SENDER, "to": to, "input": data, "value": value, **kwargs}
+
+
+def test_trace_outputs(eth_daemon: Any) -> None:
+    watched = eth_daemon.coin.normalize_address(WATCHED)
+    eth_daemon.addresses[watched].add("wallet")
+    debug_data = [
+        {
+            "txHash": "0x01",
+            "result": trace_call(
+                CONTRACT,
+                "0xdeadbeef",
+                calls=[
+                    trace_call(WATCHED, value="0x10"),
+                    {
+                        "type": "DELEGATECALL",
+                        "to": OTHER_ADDRESS,
+                        "input": "0x1234",
+                        "calls": [trace_call(WATCHED, value="0x20"), trace_call(WATCHED, "0x1234", "0x30")],
+                    },
+                    trace_call(ADDRESS, value="0x40"),
+                    {"type": "STATICCALL", "to": WATCHED, "input": "0x"},
+                ],
+            ),
+        },
+        # plain transfers are seen in blocks
+        {"txHash": "0x02", "result": trace_call(WATCHED, value="0x50")},
+        # token contract calls are seen from their events
+        {
+            "txHash": "0x03",
+            "result": trace_call(CONTRACT, "0xa9059cbb" + "00" * 64, calls=[trace_call(WATCHED, value="0x60")]),
+        },
+        {"txHash": "0x04", "result": trace_call(None, "0x6080")},
+    ]
+    assert eth_daemon.coin.find_all_trace_outputs(debug_data) == [
+        ("0x01", CONTRACT, watched, 0x10),
+        ("0x01", CONTRACT, watched, 0x20),
+    ]
+
+
+def test_abi_selectors(eth_daemon: Any) -> None:
+    assert "0xa9059cbb" in eth_daemon.abi_selectors  # transfer(address,uint256)
+    eth_daemon.ABI = [
+        {"type": "function", "name": "mint", "inputs": [{"name": "to", "type": "address"}]},
+        {"name": "burn", "inputs": []},
+        {"type": "event", "name": "Transfer", "inputs": []},
+        {"type": "constructor", "inputs": []},
+    ]
+    # functions only, the type defaults to function in ABI json
+    assert eth_daemon.parse_abi_selectors() == {"0x6a627842", "0x44df8e70"}
+
+
+def test_trace_outputs_without_watched_addresses(eth_daemon: Any) -> None:
+    debug_data = [{"txHash": "0x01", "result": trace_call(CONTRACT, "0xdeadbeef", calls=[trace_call(WATCHED, value="0x10")])}]
+    assert eth_daemon.coin.find_all_trace_outputs(debug_data) == []
+
+
+def test_deep_trace_outputs(eth_daemon: Any) -> None:
+    eth_daemon.addresses[eth_daemon.coin.normalize_address(WATCHED)].add("wallet")
+    depth = 5000
+    call = trace_call(WATCHED, value=hex(depth))
+    for level in reversed(range(1, depth)):
+        call = trace_call(CONTRACT, "0xdeadbeef", calls=[trace_call(WATCHED, value=hex(level)), call])
+    eth_daemon.coin.MAX_TRACE_DEPTH = depth + 1
+    # walked without recursion, in call order
+    values = [value for *_, value in eth_daemon.coin.find_all_trace_outputs([{"txHash": "0x01", "result": call}])]
+    assert values == list(range(1, depth + 1))
+    eth_daemon.coin.MAX_TRACE_DEPTH = 3
+    values = [value for *_, value in eth_daemon.coin.find_all_trace_outputs([{"txHash": "0x01", "result": call}])]
+    assert values == [1, 2]
+
+
+@pytest.mark.anyio
+async def test_traces_processed_in_block_order(eth_daemon: Any, mocker: pytest_mock.MockerFixture) -> None:
+    from genericprocessor import Transaction
+
+    async def trace_block(block_number: int) -> list[Any]:
+        # later blocks finish tracing first
+        await asyncio.sleep(0.01 * (4 - block_number))
+        return [Transaction(f"0x{block_number:02x}", SENDER, ADDRESS, block_number)]
+
+    mocker.patch.object(eth_daemon, "trace_block", side_effect=trace_block)
+    process_transaction = mocker.patch.object(eth_daemon, "process_transaction")
+    eth_daemon.loop = asyncio.get_running_loop()
+    eth_daemon.trace_available = True
+    runner = asyncio.ensure_future(eth_daemon.run_trace_queue())
+    for block_number in (1, 2, 3):
+        eth_daemon.enqueue_trace(block_number)
+    while eth_daemon.trace_height != 3:
+        await asyncio.sleep(0.01)
+    eth_daemon.running = False
+    runner.cancel()
+    assert [call.args[0].hash for call in process_transaction.await_args_list] == ["0x01", "0x02", "0x03"]
+
+
+def token_wallet(address: str, contract: str) -> SimpleNamespace:
+    return SimpleNamespace(address=address, contract_addr=contract)
+
+
+@pytest.fixture
+def logs_daemon(eth_daemon: Any, mocker: pytest_mock.MockerFixture) -> Any:
+    eth_daemon.INGESTION_MODE = "logs"
+    mocker.patch.object(eth_daemon.coin, "get_blocks_txes", side_effect=lambda numbers, **_: [["tx"] for _ in numbers])
+    mocker.patch.object(eth_daemon.coin, "get_transfer_logs", return_value=[])
+    return eth_daemon
+
+
+@pytest.mark.anyio
+async def test_logs_mode_unfiltered_while_catching_up(logs_daemon: Any) -> None:
+    logs_daemon.contracts = {CONTRACT: object()}
+    logs_daemon.wallets["token"] = token_wallet(ADDRESS, CONTRACT)
+    assert await logs_daemon.fetch_blocks([1, 2]) == [["tx"], ["tx"]]
+    logs_daemon.coin.get_transfer_logs.assert_awaited_once_with(1, 2, frozenset([CONTRACT]), None)
+    logs_daemon.synchronized = True
+    logs_daemon.coin.get_blocks_txes.reset_mock()
+    assert await logs_daemon.fetch_blocks([3]) == [[]]
+    logs_daemon.coin.get_blocks_txes.assert_not_called()
+    logs_daemon.coin.get_transfer_logs.assert_awaited_with(3, 3, frozenset([CONTRACT]), frozenset([ADDRESS]))
+
+
+@pytest.mark.anyio
+async def test_logs_mode_unfiltered_without_wallets(logs_daemon: Any) -> None:
+    logs_daemon.synchronized = True
+    assert await logs_daemon.fetch_blocks([1]) == [["tx"]]
+    logs_daemon.coin.get_transfer_logs.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_logs_mode_refetches_blocks_fetched_before_wallet_load(logs_daemon: Any) -> None:
+    logs_daemon.synchronized = True
+    logs_daemon.contracts = {CONTRACT: object()}
+    logs_daemon.wallets["token"] = token_wallet(ADDRESS, CONTRACT)
+    block = (await logs_daemon.fetch_blocks([1]))[0]
+    assert block == []
+    # a native wallet is loaded between fetch and commit
+    logs_daemon.wallets["native"] = token_wallet(OTHER_ADDRESS, None)
+    assert await logs_daemon.prepare_block(1, block) == ["tx"]
+    assert not logs_daemon.logs_filters
+    # no changes: the fetched block is committed as is
+    block = (await logs_daemon.fetch_blocks([2]))[0]
+    logs_daemon.coin.get_blocks_txes.reset_mock()
+    assert await logs_daemon.prepare_block(2, block) is block
+    logs_daemon.coin.get_blocks_txes.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_logs_mode_refetch_failure_is_retried(logs_daemon: Any, mocker: pytest_mock.MockerFixture) -> None:
+    commit = mocker.patch.object(logs_daemon, "commit_block")
+    logs_daemon.synchronized = True
+    logs_daemon.latest_height = 0
+    logs_daemon.contracts = {CONTRACT: object()}
+    logs_daemon.wallets["token"] = token_wallet(ADDRESS, CONTRACT)
+
+    async def get_transfer_logs(*args: Any) -> list[Any]:
+        if "other" in logs_daemon.wallets:
+            raise RuntimeError("node down")
+        # another wallet of the token is loaded while the block is in flight
+        logs_daemon.wallets["other"] = token_wallet(OTHER_ADDRESS, CONTRACT)
+        return []
+
+    logs_daemon.coin.get_transfer_logs.side_effect = get_transfer_logs
+    assert await logs_daemon.process_blocks(1, 1) == 0
+    commit.assert_not_called()
+    assert logs_daemon.latest_height == 0
+    assert logs_daemon.block_failures[1] == 1
+    assert logs_daemon.get_retry_delay(1) > logs_daemon.BLOCK_TIME
+
+
+@pytest.mark.anyio
+async def test_tx_status_cached_once_final(eth_daemon: Any, mocker: pytest_mock.MockerFixture) -> None:
+    get_tx_receipt = mocker.patch.object(eth_daemon.coin, "get_tx_receipt", return_value={"blockNumber": 10})
+    get_confirmations = mocker.patch.object(eth_daemon.coin, "get_confirmations", return_value=5)
+    assert await eth_daemon.get_tx_status("0x01") == {"blockNumber": 10, "confirmations": 5}
+    get_confirmations.return_value = eth_daemon.RESPONSE_CACHE_CONFIRMATIONS
+    await eth_daemon.get_tx_status("0x01")
+    assert get_tx_receipt.await_count == 2
+    # final: only confirmations are computed again
+    get_confirmations.return_value += 1
+    status = await eth_daemon.get_tx_status("0x01")
+    assert status == {"blockNumber": 10, "confirmations": eth_daemon.RESPONSE_CACHE_CONFIRMATIONS + 1}
+    assert get_tx_receipt.await_count == 2
+    status["blockNumber"] = 11
+    assert (await eth_daemon.get_tx_status("0x01"))["blockNumber"] == 10
+
+
+@pytest.mark.anyio
+async def test_readcontract_cached_at_final_blocks(eth_daemon: Any, mocker: pytest_mock.MockerFixture) -> None:
+    mocker.patch.object(eth_daemon.coin, "get_cached_block_number", return_value=100)
+    exec_function = mocker.Mock(call=mocker.AsyncMock(return_value=42))
+    load_function = mocker.patch.object(eth_daemon, "load_contract_exec_function", return_value=exec_function)
+    final_block = 101 - eth_daemon.RESPONSE_CACHE_CONFIRMATIONS
+    for _ in range(2):
+        assert await eth_daemon.readcontract(CONTRACT, "balanceOf", ADDRESS, block_identifier=final_block) == 42
+    assert load_function.await_count == 1
+    # other arguments, recent blocks and the latest state are always read from the node
+    await eth_daemon.readcontract(CONTRACT, "balanceOf", OTHER_ADDRESS, block_identifier=final_block)
+    await eth_daemon.readcontract(CONTRACT, "balanceOf", ADDRESS, block_identifier=final_block + 1)
+    await eth_daemon.readcontract(CONTRACT, "balanceOf", ADDRESS, block_identifier=final_block + 1)
+    await eth_daemon.readcontract(CONTRACT, "balanceOf", ADDRESS)
+    assert load_function.await_count == 5
+    exec_function.call.assert_awaited_with(block_identifier="latest")
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+
+import pytest
+
+# daemon modules need the daemon-base dependency group
+pytest.importorskip("orjson")
+
+from genericprocessor import ExpiryScheduler
+
+
+class FakeWallet:
+    def __init__(self) -> None:
+        self.expired: list[str] = []
+
+    def expire_request(self, request_id: str) -> None:
+        self.expired.append(request_id)
+
+
+def make_request(request_id: str, expires_at: int) -> SimpleNamespace:
+    return SimpleNamespace(id=request_id, time=expires_at - 11, exp=10)
+
+
+def check_heap(scheduler: ExpiryScheduler) -> None:
+    for idx, (expires_at, key, _) in enumerate(scheduler.heap):
+        assert scheduler.positions[key] == idx
+        if idx:
+            assert scheduler.heap[(idx - 1) // 2][0] <= expires_at
+    assert len(scheduler.positions) == len(scheduler.heap)
+
+
+def test_pop_due_in_order_with_cancels() -> None:
+    rng = random.Random(0)
+    scheduler = ExpiryScheduler()
+    wallet = FakeWallet()
+    expected = {}
+    for i in range(200):
+        expires_at = rng.randint(0, 1000)
+        scheduler.schedule(wallet, make_request(str(i), expires_at))
+        expected[str(i)] = expires_at
+    for i in rng.sample(range(200), 50):
+        assert scheduler.cancel(wallet, str(i))
+        expected.pop(str(i))
+    # rescheduling replaces the previous expiry
+    scheduler.schedule(wallet, make_request("0", 2000))
+    expected["0"] = 2000
+    check_heap(scheduler)
+    assert not scheduler.cancel(wallet, "missing")
+    due = [request_id for _, request_id in scheduler.pop_due(1000)]
+    assert set(due) == {k for k, v in expected.items() if v <= 1000}
+    assert [expected[k] for k in due] == sorted(expected[k] for k in due)
+    assert len(scheduler) == 1
+    check_heap(scheduler)
+
+
+def test_cancel_wallet() -> None:
+    scheduler = ExpiryScheduler()
+    wallet, other = FakeWallet(), FakeWallet()
+    for i in range(10):
+        scheduler.schedule(wallet, make_request(str(i), i))
+        scheduler.schedule(other, make_request(str(i), i))
+    scheduler.cancel_wallet(wallet)
+    check_heap(scheduler)
+    assert len(scheduler) == 10
+    assert id(wallet) not in scheduler.wallet_requests
+    assert {w for _, w in scheduler.pop_due(100)} == {str(i) for i in range(10)}
+
+
+@pytest.mark.anyio
+async def test_run_expires_due_requests() -> None:
+    scheduler = ExpiryScheduler()
+    wallet = FakeWallet()
+    task = asyncio.ensure_future(scheduler.run())
+    await asyncio.sleep(0)
+    scheduler.schedule(wallet, make_request("later", int(time.time()) + 3600))
+    scheduler.schedule(wallet, make_request("now", int(time.time()) - 5))
+    for _ in range(100):
+        if wallet.expired:
+            break
+        await asyncio.sleep(0.01)
+    assert wallet.expired == ["now"]
+    assert len(scheduler) == 1
+    scheduler.stop()
+    await asyncio.wait_for(task, 1)
@@ -0,0 +1,410 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import pathlib
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+import pytest_mock
+
+# daemon modules need the daemon-base dependency group
+pytest.importorskip("orjson")
+
+ADDRESS = "0x" + "11" * 20
+OTHER_ADDRESS = "0x" + "22" * 20
+
+
+def read_wallet_file(wallet: Any) -> dict[str, Any]:
+    return json.loads(pathlib.Path(wallet.storage.path).read_text())
+
+
+@pytest.mark.parametrize(
+    ("module", "daemon_class", "requirement"), [("eth", "ETHDaemon", "web3"), ("xmr", "XMRDaemon", "monero")]
+)
+def test_daemon_created_unsynchronized(
+    module: str, daemon_class: str, requirement: str, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    pytest.importorskip(requirement)
+    cls = getattr(__import__(module), daemon_class)
+    monkeypatch.setenv(f"{cls.name}_DATA_PATH", str(tmp_path))
+    daemon = cls()
+    assert not daemon.synchronized
+    assert "getinfo" in daemon.supported_methods
+
+
+@pytest.mark.anyio
+async def test_wait_for_sync_wakes_on_event(eth_daemon: Any) -> None:
+    async def sync_later() -> None:
+        await asyncio.sleep(0.01)
+        eth_daemon.synchronized = True
+
+    task = asyncio.ensure_future(sync_later())
+    await asyncio.wait_for(eth_daemon.wait_for_sync(lambda: eth_daemon.synchronized, eth_daemon.sync_event), 1)
+    await task
+    assert eth_daemon.sync_waiters == 0
+
+
+@pytest.mark.anyio
+async def test_wait_for_sync_timeout(eth_daemon: Any) -> None:
+    eth_daemon.SYNC_TIMEOUT = 0.01
+    with pytest.raises(Exception, match="Timed out"):
+        await eth_daemon.wait_for_sync(lambda: eth_daemon.synchronized, eth_daemon.sync_event)
+    assert eth_daemon.sync_waiters == 0
+
+
+@pytest.mark.anyio
+async def test_wallet_saved_immediately_without_flush_interval(eth_daemon: Any) -> None:
+    wallet = eth_daemon.restore_wallet_from_text(ADDRESS)
+    wallet.latest_height = 100
+    assert read_wallet_file(wallet)["latest_height"] == 100
+    assert not eth_daemon.dirty_wallets
+
+
+@pytest.mark.anyio
+async def test_write_behind_flush(eth_daemon: Any) -> None:
+    eth_daemon.FLUSH_INTERVAL = 1
+    wallet = eth_daemon.restore_wallet_from_text(ADDRESS)
+    wallet.latest_height = 100
+    wallet.latest_height = 101
+    assert "latest_height" not in read_wallet_file(wallet)
+    assert list(eth_daemon.dirty_wallets.values()) == [wallet]
+    await eth_daemon.flush_dirty_wallets()
+    assert read_wallet_file(wallet)["latest_height"] == 101
+    assert not eth_daemon.dirty_wallets
+
+
+@pytest.mark.anyio
+async def test_flush_wallet_forces_write(eth_daemon: Any) -> None:
+    eth_daemon.FLUSH_INTERVAL = 1
+    wallet = eth_daemon.restore_wallet_from_text(ADDRESS)
+    wallet.latest_height = 100
+    eth_daemon.flush_wallet(wallet)
+    assert read_wallet_file(wallet)["latest_height"] == 100
+    assert not eth_daemon.dirty_wallets
+
+
+@pytest.mark.anyio
+async def test_diskless_wallets_not_marked_dirty(eth_daemon: Any) -> None:
+    from genericprocessor import NOOP_PATH
+
+    eth_daemon.FLUSH_INTERVAL = 1
+    wallet = eth_daemon.restore_wallet_from_text(ADDRESS, path=NOOP_PATH)
+    wallet.latest_height = 100
+    assert wallet.latest_height == 100
+    assert not eth_daemon.dirty_wallets
+    assert not wallet.db.modified()
+
+
+class FakeWallet:
+    def __init__(self, address: str) -> None:
+        self.address = address
+        self.synchronized = True
+        self.request_addresses: dict[str, Any] = {}
+        self.stopped_at: int | None = None
+
+    def stop(self, block_number: int) -> None:
+        self.stopped_at = block_number
+
+    def save_db(self, force: bool = False) -> None:
+        pass
+
+
+@pytest.fixture
+def evicting_daemon(eth_daemon: Any, mocker: pytest_mock.MockerFixture) -> Any:
+    async def load_wallet(xpub: str, contract: str | None, diskless: bool = False, extra_params: Any = None) -> Any:
+        key = eth_daemon.coin.get_wallet_key(xpub, contract)
+        if key not in eth_daemon.wallets:
+            eth_daemon.wallets[key] = FakeWallet(xpub)
+            eth_daemon.addresses[xpub].add(key)
+            eth_daemon.updates_log.add_wallet(key)
+        return eth_daemon.wallets[key]
+
+    eth_daemon.MAX_LOADED_WALLETS = 1
+    mocker.patch.object(eth_daemon, "load_wallet", side_effect=load_wallet)
+    mocker.patch.object(eth_daemon.coin, "get_cached_block_number", return_value=100)
+    return eth_daemon
+
+
+@pytest.mark.anyio
+async def test_batch_loaded_wallets_are_evicted(evicting_daemon: Any) -> None:
+    await evicting_daemon.batch_load([ADDRESS, OTHER_ADDRESS])
+    assert set(evicting_daemon.wallet_params) == {ADDRESS, OTHER_ADDRESS}
+    await evicting_daemon.evict_idle_wallets()
+    assert list(evicting_daemon.wallets) == [OTHER_ADDRESS]
+    assert evicting_daemon.evicted_addresses == {ADDRESS: {ADDRESS: (ADDRESS, None, {})}}
+    assert evicting_daemon.wallet_cache_stats == {"hits": 0, "misses": 2, "evictions": 1}
+
+
+@pytest.mark.anyio
+async def test_evicted_wallet_reloaded_on_payment(evicting_daemon: Any) -> None:
+    await evicting_daemon.batch_load([ADDRESS, OTHER_ADDRESS])
+    await evicting_daemon.evict_idle_wallets()
+    await evicting_daemon.reload_evicted_wallets(ADDRESS)
+    assert ADDRESS in evicting_daemon.wallets
+    assert ADDRESS in evicting_daemon.wallet_params
+    assert not evicting_daemon.evicted_addresses
+
+
+@pytest.mark.anyio
+async def test_busy_and_diskless_wallets_not_evicted(evicting_daemon: Any) -> None:
+    await evicting_daemon.batch_load([{"xpub": ADDRESS, "diskless": True}, OTHER_ADDRESS])
+    evicting_daemon.wallets[OTHER_ADDRESS].request_addresses[OTHER_ADDRESS] = "request"
+    await evicting_daemon.evict_idle_wallets()
+    assert set(evicting_daemon.wallets) == {ADDRESS, OTHER_ADDRESS}
+    assert evicting_daemon.wallet_cache_stats["evictions"] == 0
+
+
+@pytest.mark.anyio
+async def test_idle_wallets_evicted_periodically(evicting_daemon: Any) -> None:
+    from utils import periodic_task
+
+    await evicting_daemon.batch_load([ADDRESS, OTHER_ADDRESS])
+    task = asyncio.ensure_future(periodic_task(evicting_daemon, evicting_daemon.evict_idle_wallets, 0.01))
+    await asyncio.sleep(0.05)
+    evicting_daemon.running = False
+    await task
+    assert list(evicting_daemon.wallets) == [OTHER_ADDRESS]
+
+
+def make_block(*recipients: str) -> list[SimpleNamespace]:
+    return [SimpleNamespace(to=recipient) for recipient in recipients]
+
+
+def test_recent_blocks_index_by_address() -> None:
+    from genericprocessor import RecentBlocks
+
+    blocks = RecentBlocks(3)
+    first, second = make_block(ADDRESS, OTHER_ADDRESS), make_block(ADDRESS)
+    blocks.append(first)
+    blocks.append(second)
+    assert len(blocks) == 2
+    assert list(blocks) == [first, second]
+    assert blocks.get_address_transactions(ADDRESS) == [first[0], second[0]]
+    assert blocks.get_address_transactions(OTHER_ADDRESS) == [first[1]]
+    assert blocks.get_address_transactions("0x" + "33" * 20) == []
+    assert blocks.get_all_transactions() == first + second
+
+
+def test_recent_blocks_evict_oldest() -> None:
+    from genericprocessor import RecentBlocks
+
+    blocks = RecentBlocks(2)
+    first, second, third = make_block(ADDRESS, OTHER_ADDRESS), make_block(ADDRESS), make_block(ADDRESS)
+    for block in (first, second, third):
+        blocks.append(block)
+    assert list(blocks) == [second, third]
+    assert blocks.get_address_transactions(ADDRESS) == [second[0], third[0]]
+    # addresses without recent transactions are dropped from the index
+    assert OTHER_ADDRESS not in blocks.by_address
+
+
+def test_recent_blocks_disabled() -> None:
+    from genericprocessor import RecentBlocks
+
+    blocks = RecentBlocks(0)
+    blocks.append(make_block(ADDRESS))
+    assert len(blocks) == 0
+    assert blocks.get_address_transactions(ADDRESS) == []
+
+
+def test_loaded_wallet_replays_own_transactions(eth_daemon: Any) -> None:
+    eth_daemon.latest_blocks.append(make_block(ADDRESS, OTHER_ADDRESS))
+    wallet = SimpleNamespace(address=ADDRESS)
+    assert eth_daemon.get_replay_transactions(wallet) == [eth_daemon.latest_blocks.blocks[0][0]]
+
+
+class FakeKeyStore:
+    DERIVED_FIELDS = ("address", "private_key")
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        self.derivations = 0
+
+    def get_key_material(self) -> tuple[str, ...]:
+        return (self.key,)
+
+    def load_account_from_key(self) -> None:
+        self.derivations += 1
+        self.address = f"address-{self.key}"
+        self.private_key = f"private-{self.key}"
+
+
+def test_derived_key_cache_only_used_when_enabled() -> None:
+    from genericprocessor import DerivedKeyCache
+
+    cache = DerivedKeyCache(10, 60)
+    keystore = FakeKeyStore("a")
+    cache.load(keystore)
+    assert not cache.entries
+    with cache.use():
+        cache.load(keystore)
+        copy = FakeKeyStore("a")
+        cache.load(copy)
+    assert (keystore.derivations, copy.derivations) == (2, 0)
+    assert copy.private_key == "private-a"
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert not cache.enabled
+    with cache.use(enabled=False):
+        assert not cache.enabled
+    disabled = DerivedKeyCache(0, 60)
+    with disabled.use():
+        assert not disabled.enabled
+
+
+def test_derived_key_cache_ttl(mocker: pytest_mock.MockerFixture) -> None:
+    from genericprocessor import DerivedKeyCache
+
+    monotonic = mocker.patch("genericprocessor.time.monotonic", return_value=100.0)
+    cache = DerivedKeyCache(10, 60)
+    with cache.use():
+        cache.load(FakeKeyStore("a"))
+        monotonic.return_value = 159.0
+        assert cache.get(cache.get_key(("a",))) is not None
+        monotonic.return_value = 160.0
+        keystore = FakeKeyStore("a")
+        cache.load(keystore)
+    assert keystore.derivations == 1
+
+
+def test_derived_key_cache_lru_and_wipe() -> None:
+    from genericprocessor import DerivedKeyCache
+
+    cache = DerivedKeyCache(2, 60)
+    with cache.use():
+        for key in ("a", "b"):
+            cache.load(FakeKeyStore(key))
+        cache.load(FakeKeyStore("a"))  # refreshes a, so b is evicted first
+        cache.load(FakeKeyStore("c"))
+    assert list(cache.entries) == [cache.get_key(("a",)), cache.get_key(("c",))]
+    assert cache.wipe() == 2
+    assert not cache.entries
+
+
+@pytest.mark.anyio
+async def test_diskless_wallets_share_derived_keys(eth_daemon: Any) -> None:
+    from genericprocessor import NOOP_PATH
+
+    mnemonic = "test " * 11 + "junk"
+    with eth_daemon.derived_keys.use():
+        first = eth_daemon.restore_wallet_from_text(mnemonic, path=NOOP_PATH)
+        second = eth_daemon.restore_wallet_from_text(mnemonic, path=NOOP_PATH)
+    assert first.address == second.address
+    assert first.keystore.private_key == second.keystore.private_key
+    # the keystore is derived once, every other load is served from the cache
+    assert eth_daemon.derived_keys.misses == 1
+    assert await eth_daemon.wipe_derived_keys() == 1
+
+
+@pytest.mark.anyio
+async def test_request_to_evicted_wallet_with_own_replayed_transaction(
+    eth_daemon: Any, mocker: pytest_mock.MockerFixture
+) -> None:
+    from genericprocessor import Transaction
+
+    eth_daemon.MAX_LOADED_WALLETS = 1
+    eth_daemon.NO_SYNC_WAIT = True
+    mocker.patch.object(eth_daemon.coin, "get_cached_block_number", return_value=100)
+    for address in (ADDRESS, OTHER_ADDRESS):
+        await eth_daemon.execute_request_data({"method": "getmpk", "params": {"xpub": address}, "id": 1})
+    assert list(eth_daemon.wallets) == [OTHER_ADDRESS]
+    assert ADDRESS in eth_daemon.evicted_addresses
+    eth_daemon.latest_blocks.append([Transaction("0x01", OTHER_ADDRESS, ADDRESS, 10**18)])
+    # the wallet replays a transaction to its own address while its lock is held by the request
+    response = await asyncio.wait_for(
+        eth_daemon.execute_request_data({"method": "getmpk", "params": {"xpub": ADDRESS}, "id": 2}), 5
+    )
+    assert json.loads(response.body)["id"] == 2
+    assert ADDRESS in eth_daemon.wallets
+    assert ADDRESS not in eth_daemon.evicted_addresses
+
+
+@pytest.fixture
+def pipeline_daemon(eth_daemon: Any, mocker: pytest_mock.MockerFixture) -> Any:
+    failing = set()
+    committed: list[tuple[int, Any, int]] = []
+
+    async def fetch_blocks(block_numbers: list[int]) -> list[Any]:
+        # later blocks finish first
+        await asyncio.sleep(0.005 * (10 - block_numbers[0]))
+        return [RuntimeError(f"fetch {n}") if n in failing else f"block {n}" for n in block_numbers]
+
+    async def commit_block(block_number: int, block: Any) -> None:
+        committed.append((block_number, block, eth_daemon.latest_height))
+
+    eth_daemon.FETCH_BATCH_SIZE = 1
+    eth_daemon.FETCH_CONCURRENCY = 4
+    eth_daemon.latest_height = 0
+    eth_daemon.failing = failing
+    eth_daemon.committed = committed
+    mocker.patch.object(eth_daemon, "fetch_blocks", side_effect=fetch_blocks)
+    mocker.patch.object(eth_daemon, "commit_block", side_effect=commit_block)
+    return eth_daemon
+
+
+@pytest.mark.anyio
+async def test_blocks_committed_in_order_with_checkpoints(pipeline_daemon: Any) -> None:
+    assert await pipeline_daemon.process_blocks(1, 6) == 6
+    # each block is committed after the previous one was checkpointed
+    assert pipeline_daemon.committed == [(n, f"block {n}", n - 1) for n in range(1, 7)]
+    assert pipeline_daemon.latest_height == 6
+
+
+@pytest.mark.anyio
+async def test_failed_block_stops_processing_and_backs_off(pipeline_daemon: Any) -> None:
+    pipeline_daemon.failing.add(3)
+    assert await pipeline_daemon.process_blocks(1, 5) == 2
+    assert [n for n, _, _ in pipeline_daemon.committed] == [1, 2]
+    assert pipeline_daemon.latest_height == 2
+    first_delay = pipeline_daemon.get_retry_delay(3)
+    assert await pipeline_daemon.process_blocks(3, 5) == 2
+    assert pipeline_daemon.get_retry_delay(3) > first_delay > pipeline_daemon.BLOCK_TIME
+    # gives up on the block after MAX_BLOCK_FETCH_ATTEMPTS
+    assert await pipeline_daemon.process_blocks(3, 5) == 5
+    assert [n for n, _, _ in pipeline_daemon.committed] == [1, 2, 4, 5]
+    assert not pipeline_daemon.block_failures
+    assert pipeline_daemon.get_retry_delay(3) == pipeline_daemon.BLOCK_TIME
+
+
+@pytest.mark.anyio
+async def test_rescan_skips_failed_blocks(pipeline_daemon: Any) -> None:
+    pipeline_daemon.failing.add(2)
+    assert await pipeline_daemon.process_blocks(1, 3, checkpoint=False) == 3
+    assert [n for n, _, _ in pipeline_daemon.committed] == [1, 3]
+    assert pipeline_daemon.latest_height == 0
+
+
+@pytest.mark.anyio
+async def test_chain_tip_cached_for_a_block_time(eth_daemon: Any, mocker: pytest_mock.MockerFixture) -> None:
+    get_block_number = mocker.patch.object(eth_daemon.coin, "get_block_number", return_value=100)
+    monotonic = mocker.patch("genericprocessor.time.monotonic", return_value=1000.0)
+    assert await eth_daemon.coin.get_cached_block_number() == 100
+    get_block_number.return_value = 101
+    monotonic.return_value += eth_daemon.BLOCK_TIME - 1
+    assert await eth_daemon.coin.get_cached_block_number() == 100
+    monotonic.return_value += 1
+    assert await eth_daemon.coin.get_cached_block_number() == 101
+    assert get_block_number.await_count == 2
+    # heights fetched by the block processor refresh the cache
+    eth_daemon.coin.update_block_number(105)
+    assert await eth_daemon.coin.get_cached_block_number() == 105
+    assert get_block_number.await_count == 2
+
+
+def test_response_cache_lru() -> None:
+    from genericprocessor import ResponseCache
+
+    cache = ResponseCache(2)
+    cache.set("a", 1)
+    cache.set("b", None)
+    # a cached None is told apart from a miss
+    assert cache.get("b") is None
+    cache.set("c", 3)
+    # the least recently used entry goes first
+    assert cache.get("a") is ResponseCache.MISSING
+    assert cache.get("c") == 3
+    assert cache.stats() == {"size": 2, "max_size": 2, "hits": 2, "misses": 1, "hit_rate": 0.6667}
+    disabled = ResponseCache(0)
+    disabled.set("a", 1)
+    assert disabled.get("a") is ResponseCache.MISSING
@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import json
+import os
+import pathlib
+import shutil
+from typing import Any
+
+import pytest
+import pytest_mock
+
+# daemon modules need the daemon-base dependency group
+pytest.importorskip("orjson")
+
+from storage import JOURNAL_GENERATION_KEY, JournaledStorage, SQLiteStorage, SQLiteWalletStore, WalletDB
+
+
+class DB(WalletDB):
+    STORAGE_VERSION = 1
+
+
+def load_db(path: pathlib.Path) -> tuple[DB, JournaledStorage]:
+    storage = JournaledStorage(str(path))
+    return DB(storage.read(), journal=storage.read_journal()), storage
+
+
+def create_wallet(path: pathlib.Path) -> tuple[DB, JournaledStorage]:
+    db, storage = load_db(path)
+    db.get_dict("payment_requests")["req"] = {"status": 0, "amount": "1"}
+    db.write(storage)
+    return db, storage
+
+
+def journal_lines(path: pathlib.Path) -> list[Any]:
+    return [json.loads(line) for line in pathlib.Path(f"{path}.journal").read_text().splitlines()]
+
+
+def test_journal_appends_changes(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "wallet"
+    db, storage = create_wallet(path)
+    snapshot = path.read_text()
+    db.get_dict("payment_requests")["req"]["status"] = 1
+    db.write(storage)
+    assert path.read_text() == snapshot
+    assert journal_lines(path) == [
+        {"generation": 1},
+        [{"op": "replace", "path": ["payment_requests", "req", "status"], "value": 1}],
+    ]
+    db, _ = load_db(path)
+    assert db.get_dict("payment_requests")["req"] == {"status": 1, "amount": "1"}
+    assert JOURNAL_GENERATION_KEY not in db.data
+
+
+def test_journal_torn_line_dropped(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "wallet"
+    db, storage = create_wallet(path)
+    db.get_dict("payment_requests")["req"]["status"] = 1
+    db.write(storage)
+    with open(f"{path}.journal", "a") as f:
+        f.write('[{"op": "replace", "path": ["payment_requests", "req", "status"], "val')
+    db, _ = load_db(path)
+    assert db.get_dict("payment_requests")["req"]["status"] == 1
+    assert len(journal_lines(path)) == 2
+
+
+def test_journal_compaction(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "wallet"
+    db, storage = create_wallet(path)
+    storage.JOURNAL_COMPACT_MIN_SIZE = 0
+    for status in range(1, 4):
+        db.get_dict("payment_requests")["req"]["status"] = status
+        db.write(storage)
+    assert storage.generation > 1
+    assert json.loads(path.read_text())[JOURNAL_GENERATION_KEY] == storage.generation
+    db, _ = load_db(path)
+    assert db.get_dict("payment_requests")["req"]["status"] == 3
+
+
+def test_journal_crash_between_snapshot_and_truncation(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "wallet"
+    journal_path = f"{path}.journal"
+    db, storage = create_wallet(path)
+    db.get_dict("payment_requests")["req"]["status"] = 1
+    db.write(storage)
+    db.get_dict("payment_requests")["req"]["status"] = 0
+    db.write(storage)
+    stale_journal = pathlib.Path(journal_path).read_bytes()
+    # compaction replaces the snapshot, then we "crash" before the journal is truncated
+    storage.JOURNAL_COMPACT_MIN_SIZE = 0
+    db.get_dict("payment_requests")["req"]["status"] = 1
+    db.write(storage)
+    pathlib.Path(journal_path).write_bytes(stale_journal)
+    db, storage = load_db(path)
+    assert db.get_dict("payment_requests")["req"]["status"] == 1
+    assert os.path.getsize(journal_path) == 0
+    # new changes start a journal for the current snapshot
+    db.get_dict("payment_requests")["req"]["status"] = 2
+    db.write(storage)
+    db, _ = load_db(path)
+    assert db.get_dict("payment_requests")["req"]["status"] == 2
+
+
+def test_journal_without_generation_applies_to_old_snapshot(tmp_path: pathlib.Path) -> None:
+    path = tmp_path / "wallet"
+    path.write_text(json.dumps({"version": 1, "payment_requests": {"req": {"status": 0}}}))
+    patch = {"op": "replace", "path": ["payment_requests", "req", "status"], "value": 1}
+    pathlib.Path(f"{path}.journal").write_text(json.dumps([patch]) + "\n")
+    db, _ = load_db(path)
+    assert db.get_dict("payment_requests")["req"]["status"] == 1
+
+
+def load_sqlite_db(path: pathlib.Path, store: SQLiteWalletStore) -> tuple[DB, SQLiteStorage]:
+    storage = SQLiteStorage(str(path), store)
+    return DB(storage.read(), journal=storage.read_journal()), storage
+
+
+def test_sqlite_store_roundtrip(tmp_path: pathlib.Path) -> None:
+    store = SQLiteWalletStore(str(tmp_path / "wallets.sqlite"))
+    db, storage = load_sqlite_db(tmp_path / "wallets" / "wallet", store)
+    assert not storage.file_exists()
+    db.put("keystore", {"key": "xpub"})
+    db.get_dict("payment_requests")["req"] = {"status": 0}
+    db.write(storage)
+    assert storage.key == os.path.join("wallets", "wallet")
+    assert store.conn.execute("SELECT dict, key FROM wallet_items").fetchall() == [("payment_requests", "req")]
+    db.get_dict("payment_requests")["req"]["status"] = 1
+    db.get_dict("payment_requests")["req2"] = {"status": 0}
+    db.put("keystore", {"key": "xpub2"})
+    db.write(storage)
+    db, storage = load_sqlite_db(tmp_path / "wallets" / "wallet", store)
+    assert storage.file_exists()
+    assert db.get("keystore") == {"key": "xpub2"}
+    assert db.get_dict("payment_requests") == {"req": {"status": 1}, "req2": {"status": 0}}
+    del db.get_dict("payment_requests")["req"]
+    db.write(storage)
+    assert store.read(storage.key)["payment_requests"] == {"req2": {"status": 0}}
+    store.close()
+
+
+def test_sqlite_store_writes_in_one_transaction(tmp_path: pathlib.Path) -> None:
+    store = SQLiteWalletStore(str(tmp_path / "wallets.sqlite"))
+    statements: list[str] = []
+    store.conn.set_trace_callback(statements.append)
+    store.write("wallet", {"version": 1, "payment_requests": {"a": {}, "b": {}}})
+    assert statements[0] == "BEGIN"
+    assert statements[-1] == "COMMIT"
+    assert statements.count("COMMIT") == 1
+    store.close()
+
+
+def test_sqlite_store_rolls_back_failed_write(tmp_path: pathlib.Path, mocker: pytest_mock.MockerFixture) -> None:
+    store = SQLiteWalletStore(str(tmp_path / "wallets.sqlite"))
+    store.write("wallet", {"version": 1, "payment_requests": {"a": {"status": 0}}})
+    mocker.patch.object(store, "_write_items", side_effect=RuntimeError("crash"))
+    with pytest.raises(RuntimeError):
+        store.write("wallet", {"version": 2, "payment_requests": {"b": {"status": 0}}})
+    assert store.read("wallet") == {"version": 1, "payment_requests": {"a": {"status": 0}}}
+    store.close()
+
+
+def test_sqlite_store_survives_datadir_move(tmp_path: pathlib.Path) -> None:
+    datadir = tmp_path / "old"
+    datadir.mkdir()
+    store = SQLiteWalletStore(str(datadir / "wallets.sqlite"))
+    db, storage = load_sqlite_db(datadir / "wallets" / "wallet", store)
+    db.put("keystore", {"key": "xpub"})
+    db.write(storage)
+    store.close()
+    new_datadir = tmp_path / "new"
+    shutil.move(str(datadir), str(new_datadir))
+    store = SQLiteWalletStore(str(new_datadir / "wallets.sqlite"))
+    db, storage = load_sqlite_db(new_datadir / "wallets" / "wallet", store)
+    assert storage.file_exists()
+    assert db.get("keystore") == {"key": "xpub"}
+    store.close()
+
+
+def test_wallets_migration_script(tmp_path: pathlib.Path) -> None:
+    import subprocess
+    import sys
+
+    wallets_dir = tmp_path / "wallets"
+    wallets_dir.mkdir()
+    db, storage = create_wallet(wallets_dir / "journaled")
+    db.get_dict("payment_requests")["req"]["status"] = 1
+    db.write(storage)
+    create_wallet(wallets_dir / "plain")
+    (wallets_dir / "broken").write_text("{")
+    script = pathlib.Path(__file__).parents[2] / "scripts" / "walletsmigrate.py"
+    database = tmp_path / "wallets.sqlite"
+    result = subprocess.run(
+        [sys.executable, str(script), str(wallets_dir), str(database)], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.splitlines()[-1] == "Migrated 2 wallets, skipped 1"
+    store = SQLiteWalletStore(str(database))
+    # pending journal changes are applied, keys are relative to the database directory
+    assert store.read(os.path.join("wallets", "journaled"))["payment_requests"] == {"req": {"status": 1, "amount": "1"}}
+    assert store.read(os.path.join("wallets", "plain"))["payment_requests"] == {"req": {"status": 0, "amount": "1"}}
+    assert not store.exists(os.path.join("wallets", "broken"))
+    store.close()
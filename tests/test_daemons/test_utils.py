@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import asyncio
+import pathlib
+from typing import Any
+
+import pytest
+
+# daemon modules need the daemon-base dependency group
+pytest.importorskip("orjson")
+
+
+class SleepingProvider:
+    def __init__(self, delay: float, result: Any) -> None:
+        self.delay = delay
+        self.result = result
+
+    async def send_single_request(self, *args: Any, **kwargs: Any) -> Any:
+        await asyncio.sleep(self.delay)
+        return self.result
+
+    def is_read_request(self, *args: Any, **kwargs: Any) -> bool:
+        return True
+
+
+def make_rpc(*providers: SleepingProvider) -> Any:
+    from utils import MultipleProviderRPC
+
+    return MultipleProviderRPC(list(providers), hedge_requests=True)  # type: ignore[arg-type]
+
+
+def test_cancelled_requests_only_raise_latency() -> None:
+    from utils import ProviderStats
+
+    stats = ProviderStats()
+    stats.record_cancelled(0.5)
+    assert stats.latency == 0.5
+    stats.record_cancelled(0.1)
+    assert stats.latency == 0.5
+    stats.record_cancelled(1.5)
+    assert stats.latency == pytest.approx(0.7)
+    assert stats.requests == 0
+    assert stats.p95() is None
+
+
+@pytest.mark.anyio
+async def test_hedge_loser_not_recorded_as_success() -> None:
+    rpc = make_rpc(SleepingProvider(1, "slow"), SleepingProvider(0, "fast"))
+    rpc.HEDGE_DEFAULT_DELAY = 0.01
+    assert await rpc.send_request("eth_blockNumber") == "fast"
+    await asyncio.sleep(0)  # let the cancelled primary request finish
+    primary, hedge = rpc.stats
+    assert primary.requests == 0
+    assert not primary.latencies
+    assert primary.latency is not None
+    assert primary.latency >= 0.01
+    assert primary.hedged == 0
+    assert (hedge.requests, hedge.hedged, hedge.hedges_won) == (1, 1, 1)
+
+
+@pytest.mark.anyio
+async def test_requests_routed_to_fastest_healthy_provider() -> None:
+    from utils import MultipleProviderRPC
+
+    slow, fast = SleepingProvider(0.05, "slow"), SleepingProvider(0, "fast")
+    rpc = MultipleProviderRPC([slow, fast])  # type: ignore[list-item]
+    # providers are measured first, then the fastest one gets the requests
+    assert [await rpc.send_request("eth_blockNumber") for _ in range(3)] == ["slow", "fast", "fast"]
+    assert rpc.ranked_rpc_idxs() == [1, 0]
+    for _ in range(4):
+        rpc.stats[1].record(error=True)
+    assert not rpc.is_healthy(1)
+    assert await rpc.send_request("eth_blockNumber") == "slow"
+    assert rpc.current_rpc is slow
+
+
+def test_updates_log_shared_and_scoped_events() -> None:
+    from utils import UpdatesLog
+
+    log = UpdatesLog(10)
+    log.add({"event": "before"})
+    log.add_wallet("a")
+    log.add_wallet("b")
+    log.add({"event": "new_block", "height": 1})
+    log.add({"event": "new_payment"}, wallet="a")
+    log.add({"event": "new_block", "height": 2})
+    assert log.pop_updates("a") == [
+        {"event": "new_block", "height": 1},
+        {"event": "new_payment"},
+        {"event": "new_block", "height": 2},
+    ]
+    assert log.pop_updates("a") == []
+    assert log.pop_updates("b") == [{"event": "new_block", "height": 1}, {"event": "new_block", "height": 2}]
+    # shared events are stored once, whatever the number of wallets
+    assert len(log.shared_events) == 3
+    assert not log.wallet_events
+
+
+def test_updates_log_cap() -> None:
+    from utils import UpdatesLog
+
+    log = UpdatesLog(3)
+    log.add_wallet("a")
+    for height in range(5):
+        log.add({"height": height})
+    for height in range(5):
+        log.add({"scoped": height}, wallet="a")
+    assert log.pop_updates("a") == [{"scoped": 2}, {"scoped": 3}, {"scoped": 4}]
+    assert UpdatesLog(0).pop_updates("a") == []
+
+
+def test_updates_log_unknown_and_removed_wallets() -> None:
+    from utils import UpdatesLog
+
+    log = UpdatesLog(10)
+    log.add({"event": "ignored"}, wallet="a")
+    assert "a" not in log
+    assert log.pop_updates("a") == []
+    log.add_wallet("a")
+    log.add({"event": "new_payment"}, wallet="a")
+    log.remove_wallet("a")
+    assert "a" not in log
+    assert not log.wallet_events
+    log.add_wallet("a")
+    assert log.pop_updates("a") == []
+
+
+class BatchProvider:
+    def __init__(self, error: Exception | None = None) -> None:
+        self.error = error
+        self.batches: list[Any] = []
+
+    async def send_batch_request(self, requests: list[Any]) -> list[Any]:
+        self.batches.append(requests)
+        if self.error is not None:
+            raise self.error
+        return [{"result": params} for _, params in requests]
+
+
+@pytest.mark.anyio
+async def test_batch_request_fails_over() -> None:
+    from utils import MultipleProviderRPC
+
+    failing, working = BatchProvider(ConnectionError("down")), BatchProvider()
+    rpc = MultipleProviderRPC([failing, working])  # type: ignore[list-item]
+    requests = [("eth_getBlockByNumber", ["0x1"]), ("eth_getBlockByNumber", ["0x2"])]
+    assert await rpc.send_batch_request(requests) == [{"result": ["0x1"]}, {"result": ["0x2"]}]
+    # the whole batch goes to one provider, the next one only gets it on failure
+    assert failing.batches == working.batches == [requests]
+    assert rpc.failed_stats == [1, 0]
+    assert (rpc.stats[0].errors, rpc.stats[1].requests) == (1, 1)
+
+
+def test_connector_settings_from_env(monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path) -> None:
+    pytest.importorskip("web3")
+    from eth import ETHDaemon
+
+    monkeypatch.setenv("ETH_DATA_PATH", str(tmp_path))
+    monkeypatch.setenv("ETH_RPC_POOL_SIZE_PER_HOST", "2")
+    monkeypatch.setenv("ETH_RPC_READ_TIMEOUT", "5")
+    settings = ETHDaemon().connector_settings
+    assert (settings.pool_size, settings.pool_size_per_host) == (100, 2)
+    # no total timeout, slow nodes are cut off by the read timeout
+    assert settings.timeout.total is None
+    assert settings.timeout.sock_read == 5
+
+
+@pytest.mark.anyio
+async def test_pool_metrics() -> None:
+    from aiohttp import ClientConnectionError, web
+    from aiohttp.test_utils import TestServer
+    from utils import ConnectorSettings, PoolMetrics
+
+    async def handler(request: web.Request) -> web.Response:
+        await asyncio.sleep(0.05)
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    metrics = PoolMetrics()
+    async with TestServer(app) as server, ConnectorSettings(pool_size_per_host=1).create_session(metrics) as session:
+
+        async def get(url: Any) -> str:
+            async with session.get(url) as response:
+                return await response.text()
+
+        with pytest.raises(ClientConnectionError):
+            await get("http://127.0.0.1:1/")
+        # the second request waits for the single connection of the pool and reuses it
+        assert await asyncio.gather(get(server.make_url("/")), get(server.make_url("/"))) == ["ok", "ok"]
+    assert metrics.to_dict() | {"pool_wait_time": 0} == {
+        "requests": 3,
+        "in_flight": 0,
+        "errors": 1,
+        "connections_created": 1,
+        "connections_reused": 1,
+        "pool_waits": 1,
+        "pool_wait_time": 0,
+        "dns_cache_hits": 0,
+        "dns_cache_misses": 0,
+    }
+    assert metrics.pool_wait_time > 0
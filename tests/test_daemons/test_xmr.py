@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import binascii
+import os
+import pathlib
+import pickle
+from decimal import Decimal
+
+import pytest
+import pytest_mock
+
+pytest.importorskip("monero")
+
+from monero import ed25519
+from monero.keccak import keccak_256
+from monero.seed import Seed
+from monero.transaction import Transaction
+
+AMOUNT = 1_500_000_000_000  # 1.5 XMR
+
+
+def make_payment(seed: Seed, index: int) -> Transaction:
+    """Build a v1 transaction paying AMOUNT to the seed's main address"""
+    view_key = binascii.unhexlify(seed.secret_view_key())
+    spend_key = binascii.unhexlify(seed.public_spend_key())
+    tx_secret = ed25519.scalar_reduce(os.urandom(32))
+    tx_public = ed25519.scalarmult_B(tx_secret)
+    view_key_8 = view_key
+    for _ in range(3):
+        view_key_8 = ed25519.scalar_add(view_key_8, view_key_8)
+    shared_secret = ed25519.scalarmult(view_key_8, tx_public)
+    # output index 0, varint encoded
+    output_secret = ed25519.scalar_reduce(keccak_256(shared_secret + b"\x00").digest())
+    output_key = ed25519.edwards_add(ed25519.scalarmult_B(output_secret), spend_key)
+    extra = [1, *tx_public, 2, 9, 1, *os.urandom(8)]
+    return Transaction(
+        hash=f"{index:064x}",
+        json={
+            "vin": [{"key": {}}],
+            "vout": [{"amount": AMOUNT, "target": {"key": output_key.hex()}}],
+            "extra": extra,
+            "unlock_time": 0,
+        },
+    )
+
+
+@pytest.fixture
+def seed() -> Seed:
+    return Seed()
+
+
+def test_scan_tx_outputs_on_pickled_inputs(seed: Seed) -> None:
+    from xmr import scan_tx_outputs
+
+    address = str(seed.public_address())
+    other_address = str(Seed().public_address())
+    txes = [make_payment(seed, 0), make_payment(Seed(), 1), make_payment(seed, 2)]
+    watched = [(address, seed.secret_view_key()), (other_address, Seed().secret_view_key())]
+    # the same round trip inputs and results take to and from scan worker processes
+    matches, errors = pickle.loads(pickle.dumps(scan_tx_outputs(*pickle.loads(pickle.dumps((txes, watched, 10))))))
+    assert not errors
+    assert [(index, match_address, amount) for index, match_address, _, amount in matches] == [
+        (10, address, Decimal("1.5")),
+        (12, address, Decimal("1.5")),
+    ]
+    assert all(final_address.startswith("4") and final_address != address for _, _, final_address, _ in matches)
+
+
+@pytest.mark.anyio
+async def test_scan_outputs_in_process_by_default(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch, mocker: pytest_mock.MockerFixture, seed: Seed
+) -> None:
+    from xmr import XMRDaemon
+
+    monkeypatch.setenv("XMR_DATA_PATH", str(tmp_path))
+    daemon = XMRDaemon()
+    assert daemon.SCAN_PROCESSES == 1
+    daemon.scan_executor = mocker.Mock()
+    txes = [make_payment(seed, 0)]
+    matches, errors = await daemon.scan_outputs(txes, [(str(seed.public_address()), seed.secret_view_key())])
+    # below the work threshold nothing is sent to worker processes
+    daemon.scan_executor.submit.assert_not_called()
+    assert [match[0] for match in matches] == [0]
+    assert not errors
+
+
+def test_scan_worker_process(seed: Seed) -> None:
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    from xmr import scan_tx_outputs
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        matches, errors = executor.submit(
+            scan_tx_outputs, [make_payment(seed, 0)], [(str(seed.public_address()), seed.secret_view_key())]
+        ).result(timeout=60)
+    assert not errors
+    assert [match[0] for match in matches] == [0]
+
+
+@pytest.mark.anyio
+async def test_incremental_mempool(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch, mocker: pytest_mock.MockerFixture
+) -> None:
+    from xmr import XMRDaemon
+
+    monkeypatch.setenv("XMR_DATA_PATH", str(tmp_path))
+    daemon = XMRDaemon()
+    broken = {"c"}
+
+    async def parse_transactions(tx_hash: str) -> list[str]:
+        if tx_hash in broken:
+            raise ValueError("invalid transaction")
+        return [f"output of {tx_hash}"]
+
+    rpc = mocker.Mock(get_mempool_hashes=mocker.AsyncMock(), get_transactions=mocker.AsyncMock(side_effect=list))
+    daemon.coin = mocker.Mock(rpc=rpc, get_tx_hash=str, parse_transactions=parse_transactions)
+    scan_transactions = mocker.patch.object(daemon, "scan_transactions")
+
+    rpc.get_mempool_hashes.return_value = ["a", "b", "c"]
+    await daemon.process_mempool_incremental()
+    rpc.get_transactions.assert_awaited_with(["a", "b", "c"])
+    scan_transactions.assert_awaited_with(["output of a", "output of b"], unconfirmed=True)
+    # only transactions not seen yet are fetched, failed ones are tried again
+    broken.clear()
+    rpc.get_mempool_hashes.return_value = ["b", "c", "d"]
+    await daemon.process_mempool_incremental()
+    rpc.get_transactions.assert_awaited_with(["c", "d"])
+    scan_transactions.assert_awaited_with(["output of c", "output of d"], unconfirmed=True)
+    assert list(daemon.mempool_cache) == ["b", "c", "d"]
+    # mined transactions leave the cache
+    rpc.get_transactions.reset_mock()
+    rpc.get_mempool_hashes.return_value = ["d"]
+    await daemon.process_mempool_incremental()
+    rpc.get_transactions.assert_not_called()
+    scan_transactions.assert_awaited_with([], unconfirmed=True)
+    assert daemon.mempool_cache == {"d": ["output of d"]}